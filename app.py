@@ -1,17 +1,31 @@
 import os
+import re
 import json
+import hashlib
 
 from datetime import datetime
 
-from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify, abort
+from functools import wraps
+
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify, abort, stream_with_context, make_response
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_moment import Moment
 from flask_migrate import Migrate
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import selectinload
+from werkzeug.exceptions import HTTPException
 
 import config
-from models import setup_db, Actor, Movie, ActorMovie
-from auth import AuthError, requires_auth
+import metrics
+from profiler import QueryProfiler
+from models import setup_db, pool_status, replica_router, use_replica, use_primary, Actor, Movie, ActorMovie, FILTER_OPERATORS, table_versions, table_name, change_listeners, row_change_listeners, commit_changes, notify_row_change
+from auth import AuthError, requires_auth, requires_token, check_permissions, jwks_store, token_cache
+from export import export_rows, EXPORT_FORMATS
+from cache import create_response_cache, create_row_cache
+from serializers import json_response, rows_to_dicts, JSON_MIMETYPE
 
 app = Flask(__name__)
 
@@ -23,53 +37,775 @@ cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
 db = setup_db(app)
 
+response_cache = create_response_cache(app.config)
+
+def invalidate_response_cache(model):
+    if response_cache is not None:
+        response_cache.invalidate(table_name(model))
+
+change_listeners.append(invalidate_response_cache)
+
+row_cache = create_row_cache(app.config)
+
+def invalidate_embedding_records(model):
+    # records embedding others (a movie with its cast) are tagged with their tables
+    if row_cache is not None:
+        row_cache.invalidate(table_name(model))
+
+def invalidate_row(model, id):
+    if row_cache is not None:
+        row_cache.invalidate(row_cache.row_tag(table_name(model), id))
+
+change_listeners.append(invalidate_embedding_records)
+row_change_listeners.append(invalidate_row)
+
+def collect_cache_metrics():
+    '''
+    Samples of the response cache counters for GET /metrics
+    '''
+    samples = []
+    if response_cache is not None:
+        stats = response_cache.stats()
+        samples += [
+            ('response_cache_hits_total', 'counter', 'Responses served from the response cache.', stats['hits']),
+            ('response_cache_misses_total', 'counter', 'Responses built because they were not cached.', stats['misses']),
+            ('response_cache_evictions_total', 'counter', 'Responses evicted from the lru backend.', stats['evictions'])
+        ]
+    if row_cache is not None:
+        stats = row_cache.stats()
+        samples += [
+            ('row_cache_hits_total', 'counter', 'Single records served from the row cache.', stats['hits']),
+            ('row_cache_misses_total', 'counter', 'Single records read because they were not cached.', stats['misses'])
+        ]
+    return samples
+
+metrics.registry.collectors.append(collect_cache_metrics)
+
+# time spent in the database, reported per request
+event.listen(Engine, "before_cursor_execute", metrics.before_cursor_execute)
+event.listen(Engine, "after_cursor_execute", metrics.after_cursor_execute)
+
+profiler = QueryProfiler(budgets=app.config["QUERY_BUDGETS"], slow_query_ms=app.config["SLOW_QUERY_MS"],
+                         n_plus_one_threshold=app.config["N_PLUS_ONE_THRESHOLD"],
+                         enabled=app.config["SQL_PROFILER"])
+event.listen(Engine, "before_cursor_execute", profiler.before_cursor_execute)
+event.listen(Engine, "after_cursor_execute", profiler.after_cursor_execute)
+
+# Set after a write so the client reads its own writes from the primary
+# while the replicas catch up
+READ_PRIMARY_COOKIE = "read_primary"
+# POST endpoints that only read and so do not set it
+READ_ONLY_POSTS = ("post_batch",)
+
+@app.before_request
+def start_timer():
+    metrics.start_request()
+    profiler.start_request()
+
+@app.before_request
+def route_reads():
+    if (replica_router.binds and request.method in ("GET", "HEAD")
+            and not request.cookies.get(READ_PRIMARY_COOKIE)):
+        use_replica()
+
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE,OPTIONS')
+    if (replica_router.binds and replica_router.sticky_seconds
+            and request.method in ("POST", "PATCH", "DELETE") and request.endpoint not in READ_ONLY_POSTS
+            and response.status_code < 400):
+        response.set_cookie(READ_PRIMARY_COOKIE, "1", max_age=replica_router.sticky_seconds, httponly=True)
+    return metrics.finish_request(response, request.endpoint, request.method)
+
+@app.teardown_request
+def finish_profile(exception):
+    # runs even when an exception skipped after_request, so the profile
+    # of a failed request never carries over to the next one
+    profiler.finish_request(request.endpoint)
+
+FILTER_PARAM = re.compile(r"^(\w+)\[(\w+)\]$")
+
+def get_sort_args(model, args=None):
+    '''
+    Reads the sort parameter, a comma separated list of fields with a "-"
+    prefix for descending order (e.g. sort=-release_date,title)
+    '''
+    args = request.args if args is None else args
+    sort = []
+    for field in args.get("sort", "").split(","):
+        field = field.strip()
+        if not field:
+            continue
+
+        descending = field.startswith("-")
+        field = field.lstrip("-")
+        if field not in model.sort_fields:
+            abort(400)
+
+        sort.append((field, descending))
+
+    return sort
+
+def get_filter_args(model, args=None):
+    '''
+    Reads the field=value and field[op]=value filters of a listing. Only
+    the model's filter_fields can be filtered on, with the operators eq, ne,
+    gt, gte, lt and lte.
+    '''
+    args = request.args if args is None else args
+    filters = []
+    for key, value in args.items(multi=True):
+        match = FILTER_PARAM.match(key)
+        field, op = match.groups() if match else (key, "eq")
+
+        if field not in model.filter_fields:
+            if match:
+                abort(400)
+            continue
+
+        if op not in FILTER_OPERATORS:
+            abort(400)
+
+        try:
+            filters.append((field, op, model.filter_fields[field](value)))
+        except ValueError:
+            abort(400)
+
+    return filters
+
+def get_fields_args(model, args=None):
+    '''
+    Reads the fields parameter, a comma separated sparse fieldset among the
+    model's public_fields (e.g. fields=id,name). Defaults to every field.
+    '''
+    args = request.args if args is None else args
+    fields = [field.strip() for field in args.get("fields", "").split(",") if field.strip()]
+    if not fields:
+        return list(model.public_fields)
+
+    if any(field not in model.public_fields for field in fields):
+        abort(400)
+
+    return fields
+
+def parse_ids(values):
+    '''
+    Returns the ids of a lookup without duplicates, in the requested order,
+    or aborts with 400 when one is not an integer (booleans and floats
+    such as true or 1.5 included)
+    '''
+    ids = list(values)
+    if any(type(value) is not int for value in ids):
+        abort(400)
+
+    return list(dict.fromkeys(ids))
+
+def get_ids_args(args=None):
+    '''
+    Reads the ids parameter, a comma separated list of at most
+    MAX_BATCH_SIZE ids (e.g. ids=3,1,2), None when it is not given
+    '''
+    args = request.args if args is None else args
+    if "ids" not in args:
+        return None
+
+    try:
+        ids = parse_ids(int(value) for value in args["ids"].split(",") if value.strip())
+    except ValueError:
+        abort(400)
+    if not ids or len(ids) > app.config["MAX_BATCH_SIZE"]:
+        abort(400)
+
+    return ids
+
+def format_records(records, fields, relationship=None):
+    '''
+    Formats ORM records keeping only the requested fields, embedding the
+    given relationship (e.g. "actors" through Movie.format_actors) if any
+    '''
+    if relationship:
+        keys = fields + [relationship]
+        formatted = [getattr(record, "format_" + relationship)() for record in records]
+    else:
+        keys = fields
+        formatted = [record.format() for record in records]
+
+    return [{key: item[key] for key in keys} for item in formatted]
+
+def get_page_args(model, sort=(), args=None):
+    '''
+    Reads the limit, after and offset pagination parameters of a listing.
+    The limit is capped at MAX_PAGE_SIZE.
+    '''
+    args = request.args if args is None else args
+    try:
+        limit = int(args.get("limit", app.config["DEFAULT_PAGE_SIZE"]))
+        after = args.get("after")
+        after = model.parse_cursor(after, sort) if after is not None else None
+        offset = int(args.get("offset", 0))
+    except ValueError:
+        abort(400)
+
+    if limit < 1 or offset < 0:
+        abort(400)
+
+    return min(limit, app.config["MAX_PAGE_SIZE"]), after, offset
+
+def wants_minimal():
+    '''
+    True when the client asked for only the changed record, either with
+    ?return=minimal or a Prefer: return=minimal header
+    '''
+    return (request.args.get("return") == "minimal"
+            or "return=minimal" in request.headers.get("Prefer", ""))
+
+def record_etag(record):
+    '''
+    Strong ETag of a single record, from its id and updated_at
+    '''
+    return "{}-{}".format(record.id, record.updated_at.isoformat())
+
+def minimal_response(key, record):
+    '''
+    Returns only the created or changed record, tagged with its ETag
+    '''
+    response = json_response({
+        "success": True,
+        "id": record.id,
+        key: record.format()
+    }, etag=record_etag(record))
+    response.headers["Preference-Applied"] = "return=minimal"
     return response
 
+def collection_etag(*models):
+    '''
+    Strong ETag of a read from the tables of models, derived from the request
+    URL and the version counters of those tables only
+    '''
+    return versions_etag(request.full_path, table_versions(*models))
+
+def versions_etag(full_path, versions):
+    '''
+    Hashes a request URL (path and query string) with table versions
+    '''
+    return hashlib.sha1((full_path + json.dumps(versions, sort_keys=True)).encode()).hexdigest()
+
+def not_modified(etag):
+    '''
+    Returns a 304 Not Modified response when If-None-Match matches etag, else None
+    '''
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+def conditional_response(body, etag):
+    '''
+    Returns a 200 response of an already serialized JSON body tagged with etag
+    '''
+    response = Response(body, 200, mimetype=JSON_MIMETYPE)
+    response.set_etag(etag)
+    return response
+
+def cached_response(dependencies):
+    '''
+    Serves a read endpoint from the response cache, keyed by endpoint, query
+    parameters and the caller's permissions. dependencies returns the models
+    the response is read from; a change to any of them invalidates it.
+    Misses are built from the primary, never from a replica.
+    '''
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(jwt, *args, **kwargs):
+            if response_cache is None:
+                return f(jwt, *args, **kwargs)
+
+            key = response_cache.make_key(request.endpoint, request.path, request.args.items(multi=True),
+                                          jwt.get("permissions", []))
+            cached = response_cache.get(key)
+            if cached is not None:
+                etag, body = cached
+                return not_modified(etag) or conditional_response(body, etag)
+
+            # a lagging replica could cache data older than the generations
+            use_primary()
+            tags = [table_name(model) for model in dependencies()]
+            generations = response_cache.generations(tags)
+
+            response = make_response(f(jwt, *args, **kwargs))
+            etag, weak = response.get_etag()
+            if response.status_code == 200 and etag and not weak:
+                response_cache.set(key, etag, response.get_data(), tags, generations)
+
+            return response
+
+        return wrapper
+    return cached_response_decorator
+
+def record_response(model, key, record_id, include=None):
+    '''
+    Serves a single record, with the records of its include relationship
+    embedded if given, from the row cache. A cache hit costs no database
+    round trip; on a miss the record is looked up in the session's identity
+    map before the primary database.
+    '''
+    try:
+        record_id = int(record_id)
+    except ValueError:
+        abort(404)
+
+    name = table_name(model)
+    if row_cache is not None:
+        cache_key = row_cache.make_key(name, record_id, include)
+        cached = row_cache.get(cache_key)
+        if cached is not None:
+            etag, body = cached
+            return not_modified(etag) or conditional_response(body, etag)
+
+        tags = [row_cache.row_tag(name, record_id)]
+        if include:
+            related = getattr(model, include).property
+            tags += [table_name(related.secondary), table_name(related.mapper.class_)]
+        use_primary()
+        generations = row_cache.generations(tags)
+
+    options = [selectinload(getattr(model, include))] if include else []
+    record = model.find(record_id, options=options)
+
+    if not record:
+        abort(404)
+
+    etag = record_etag(record)
+    if include:
+        embedded = ",".join(record_etag(item) for item in getattr(record, include))
+        etag += "-" + hashlib.sha1(embedded.encode()).hexdigest()[:16]
+        data = getattr(record, "format_" + include)()
+    else:
+        data = record.format()
+
+    response = not_modified(etag)
+    if response:
+        return response
+
+    response = json_response({
+        "success": True,
+        key: data
+    }, etag=etag)
+
+    if row_cache is not None:
+        row_cache.set(cache_key, etag, response.get_data(), tags, generations)
+
+    return response
+
+def actor_tables():
+    if request.args.get("include") == "movies":
+        return Actor, ActorMovie, Movie
+    return Actor,
+
+def movie_tables():
+    if request.args.get("include") == "actors":
+        return Movie, ActorMovie, Actor
+    return Movie,
+
+def cast_tables():
+    return Actor, ActorMovie, Movie
+
+def read_bulk_rows():
+    '''
+    Yields (row number, row, error) for every row of a bulk import body,
+    either a JSON array or an NDJSON stream with one object per line
+    '''
+    if request.mimetype in ("application/x-ndjson", "application/ndjson"):
+        number = 0
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line), None
+            except ValueError:
+                yield number, None, "invalid JSON"
+            number += 1
+        return
+
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list):
+        abort(400)
+
+    for number, row in enumerate(rows):
+        yield number, row, None
+
+def bulk_import(model):
+    '''
+    Validates the rows of a bulk import and inserts them in batches of
+    batch_size rows with one commit per batch. Invalid rows are reported
+    without aborting the rest of the import.
+    '''
+    try:
+        batch_size = int(request.args.get("batch_size", app.config["BULK_BATCH_SIZE"]))
+    except ValueError:
+        abort(400)
+
+    if batch_size < 1:
+        abort(400)
+
+    batch_size = min(batch_size, app.config["MAX_BULK_BATCH_SIZE"])
+
+    inserted = 0
+    errors = []
+    batch = []
+
+    def flush():
+        try:
+            model.bulk_insert([values for number, values in batch])
+            return len(batch)
+        except SQLAlchemyError:
+            db.session.rollback()
+
+        # isolate the rows the database rejected
+        count = 0
+        for number, values in batch:
+            try:
+                model.bulk_insert([values])
+                count += 1
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                errors.append({"row": number, "error": str(e.orig if hasattr(e, "orig") else e)})
+        return count
+
+    for number, row, error in read_bulk_rows():
+        if error is None:
+            try:
+                batch.append((number, model.parse(row)))
+            except ValueError as e:
+                error = str(e)
+
+        if error is not None:
+            errors.append({"row": number, "error": error})
+
+        if len(batch) >= batch_size:
+            inserted += flush()
+            batch = []
+
+    if batch:
+        inserted += flush()
+
+    errors.sort(key=lambda error: error["row"])
+
+    return json_response({
+        "success": True,
+        "inserted": inserted,
+        "failed": len(errors),
+        "errors": errors
+    })
+
 @app.route("/", methods=["GET"])
 def index():
     return("Welcome to The Movie Company!")
 
 @app.route("/actors", methods=["GET"], endpoint="get_actors")
 @requires_auth('view:actor')
+@cached_response(actor_tables)
 def get_actors(jwt):
+    sort = get_sort_args(Actor)
+    filters = get_filter_args(Actor)
+    limit, after, offset = get_page_args(Actor, sort)
+    fields = get_fields_args(Actor)
+    ids = get_ids_args()
+    q = request.args.get("q", "").strip()
+    include_movies = request.args.get("include") == "movies"
+    options = [selectinload(Actor.movies)] if include_movies else []
+
+    etag = collection_etag(Actor, ActorMovie, Movie) if include_movies else collection_etag(Actor)
+    response = not_modified(etag)
+    if response:
+        return response
+
     try:
-        actors = Actor.query.all()
+        if ids is not None:
+            # lookup of the requested ids in their order, without pagination
+            records, missing = Actor.get_many(ids, options=options, fields=None if include_movies else fields)
+            pagination = {"missing": missing}
+            formatted = format_records(records, fields, "movies") if include_movies else rows_to_dicts(fields, records)
+        elif q:
+            actors, next_offset = Actor.search(q, limit, offset=offset, options=options, filters=filters)
+            pagination = {"next_offset": next_offset}
+            formatted = format_records(actors, fields, "movies" if include_movies else None)
+        elif include_movies:
+            actors, next_cursor = Actor.page(limit, after=after, offset=offset, options=options,
+                                             filters=filters, sort=sort)
+            pagination = {"next_cursor": next_cursor}
+            formatted = format_records(actors, fields, "movies")
+        else:
+            # read-only listing: select the columns and serialize the result
+            # tuples without building ORM objects
+            rows, next_cursor = Actor.page(limit, after=after, offset=offset,
+                                            filters=filters, sort=sort, fields=fields)
+            pagination = {"next_cursor": next_cursor}
+            formatted = rows_to_dicts(fields, rows)
 
         data = {
             "success": True,
-            "actors": [actor.format() for actor in actors]
+            "actors": formatted
             }
+        data.update(pagination)
 
-        return json.dumps(data), 200
+        return json_response(data, etag=etag)
 
     except:
-        return json.dumps({
+        return json_response({
             "success": False,
             "error": "An error occurred"
-        }), 500
+        }, 500)
 
 @app.route("/movies", methods=["GET"], endpoint="get_movies")
 @requires_auth('view:movie')
+@cached_response(movie_tables)
 def get_movies(jwt):
+    sort = get_sort_args(Movie)
+    filters = get_filter_args(Movie)
+    limit, after, offset = get_page_args(Movie, sort)
+    fields = get_fields_args(Movie)
+    ids = get_ids_args()
+    q = request.args.get("q", "").strip()
+    include_actors = request.args.get("include") == "actors"
+    options = [selectinload(Movie.actors)] if include_actors else []
+
+    etag = collection_etag(Movie, ActorMovie, Actor) if include_actors else collection_etag(Movie)
+    response = not_modified(etag)
+    if response:
+        return response
+
     try:
-        movies = Movie.query.all()
+        if ids is not None:
+            # lookup of the requested ids in their order, without pagination
+            records, missing = Movie.get_many(ids, options=options, fields=None if include_actors else fields)
+            pagination = {"missing": missing}
+            formatted = format_records(records, fields, "actors") if include_actors else rows_to_dicts(fields, records)
+        elif q:
+            movies, next_offset = Movie.search(q, limit, offset=offset, options=options, filters=filters)
+            pagination = {"next_offset": next_offset}
+            formatted = format_records(movies, fields, "actors" if include_actors else None)
+        elif include_actors:
+            movies, next_cursor = Movie.page(limit, after=after, offset=offset, options=options,
+                                             filters=filters, sort=sort)
+            pagination = {"next_cursor": next_cursor}
+            formatted = format_records(movies, fields, "actors")
+        else:
+            # read-only listing: select the columns and serialize the result
+            # tuples without building ORM objects
+            rows, next_cursor = Movie.page(limit, after=after, offset=offset,
+                                            filters=filters, sort=sort, fields=fields)
+            pagination = {"next_cursor": next_cursor}
+            formatted = rows_to_dicts(fields, rows)
 
         data = {
             "success": True,
-            "movies": [movie.format() for movie in movies]
+            "movies": formatted
             }
+        data.update(pagination)
+
+        return json_response(data, etag=etag)
+
+    except:
+        return json_response({
+            "success": False,
+            "error": "An error occurred"
+        }, 500)
+
+# key of a POST /batch body -> (model, permission)
+BATCH_MODELS = {
+    "actors": (Actor, "view:actor"),
+    "movies": (Movie, "view:movie")
+}
+
+@app.route("/batch", methods=["POST"], endpoint="post_batch")
+@requires_token
+def post_batch(jwt):
+    '''
+    Looks up actors and movies by id in one request, e.g.
+    {"actors": [3, 1], "movies": [2]}, with one query per type. Every type
+    requires its view permission and at most MAX_BATCH_SIZE ids are allowed.
+    '''
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data or any(key not in BATCH_MODELS for key in data):
+        abort(400)
+
+    lookups = {}
+    for key, values in data.items():
+        if not isinstance(values, list):
+            abort(400)
+        check_permissions(BATCH_MODELS[key][1], jwt)
+        lookups[key] = parse_ids(values)
+
+    if sum(len(ids) for ids in lookups.values()) > app.config["MAX_BATCH_SIZE"]:
+        abort(400)
+
+    try:
+        result = {"success": True, "missing": {}}
+        for key, ids in lookups.items():
+            model = BATCH_MODELS[key][0]
+            fields = list(model.public_fields)
+            records, missing = model.get_many(ids, fields=fields) if ids else ([], [])
+            result[key] = rows_to_dicts(fields, records)
+            result["missing"][key] = missing
 
-        return json.dumps(data, default=str), 200
+        return json_response(result)
 
     except:
-        return json.dumps({
+        return json_response({
+            "success": False,
+            "error": "An error occurred"
+        }, 500)
+
+# (type, op) of a POST /batch/mutations operation -> permission
+MUTATION_PERMISSIONS = {
+    ("actors", "create"): "post:actor",
+    ("actors", "patch"): "patch:actor",
+    ("actors", "delete"): "delete:actor",
+    ("movies", "create"): "post:movie",
+    ("movies", "patch"): "patch:movie",
+    ("movies", "delete"): "delete:movie",
+    ("castings", "create"): "patch:movie",
+    ("castings", "delete"): "patch:movie"
+}
+
+def get_record_id(value):
+    '''
+    Returns the id of a batch operation, aborting with 400 when it is not
+    an integer (booleans, floats and numeric strings included)
+    '''
+    if type(value) is not int:
+        abort(400)
+
+    return value
+
+def apply_mutation(operation, tables, rows):
+    '''
+    Applies one operation of a batch in the current transaction without
+    committing it. The tables it changed are added to tables and the
+    (model, id) of the records it updated or deleted to rows.
+    '''
+    kind, op = operation["type"], operation["op"]
+    data = operation.get("data") or {}
+    if not isinstance(data, dict):
+        abort(400)
+
+    if kind == "castings":
+        movie_id, actor_id = get_record_id(data.get("movie_id")), get_record_id(data.get("actor_id"))
+        movie = Movie.find(movie_id, options=[selectinload(Movie.actors)])
+        actor = Actor.find(actor_id)
+
+        if not movie or not actor:
+            abort(404)
+
+        if op == "create":
+            if actor in movie.actors:
+                abort(422)
+            movie.add_actor(actor, commit=False)
+        else:
+            if actor not in movie.actors:
+                abort(404)
+            movie.remove_actor(actor, commit=False)
+
+        tables.append(ActorMovie)
+        return {"movie_id": movie_id, "actor_id": actor_id}
+
+    model = BATCH_MODELS[kind][0]
+    if op == "create":
+        try:
+            record = model(**model.parse(data))
+        except ValueError:
+            abort(400)
+        record.insert(commit=False)
+        db.session.flush()
+        tables.append(model)
+        return {"id": record.id}
+
+    record_id = get_record_id(operation.get("id"))
+    record = model.find(record_id)
+
+    if not record:
+        abort(404)
+
+    if op == "patch":
+        try:
+            values = model.parse(data)
+        except ValueError:
+            abort(400)
+        for field, value in values.items():
+            setattr(record, field, value)
+        record.update(commit=False)
+        tables.append(model)
+    else:
+        record.delete(commit=False)
+        tables.extend([model, ActorMovie])
+
+    rows.append((model, record_id))
+    return {"id": record_id}
+
+def mutation_error(index, code):
+    messages = {400: "Bad request", 404: "Resource not found", 422: "unprocessable"}
+    return json_response({
+        "success": False,
+        "error": code,
+        "message": messages.get(code, "An error occurred"),
+        "operation": index
+    }, code)
+
+@app.route("/batch/mutations", methods=["POST"], endpoint="post_batch_mutations")
+@requires_token
+def post_batch_mutations(jwt):
+    '''
+    Applies a list of create, patch and delete operations on actors, movies
+    and castings in a single transaction with one commit, e.g.
+    {"operations": [{"op": "patch", "type": "actors", "id": 3, "data": {...}}]}.
+    The permissions of every operation are checked before any runs; when
+    one fails nothing is committed and its index is reported.
+    '''
+    data = request.get_json(silent=True)
+    operations = data.get("operations") if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations or len(operations) > app.config["MAX_BATCH_SIZE"]:
+        abort(400)
+
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or (operation.get("type"), operation.get("op")) not in MUTATION_PERMISSIONS:
+            return mutation_error(index, 400)
+        check_permissions(MUTATION_PERMISSIONS[(operation["type"], operation["op"])], jwt)
+
+    tables = []
+    rows = []
+    results = []
+    for index, operation in enumerate(operations):
+        try:
+            result = apply_mutation(operation, tables, rows)
+            db.session.flush()
+        except HTTPException as e:
+            db.session.rollback()
+            return mutation_error(index, e.code)
+        except SQLAlchemyError:
+            db.session.rollback()
+            return mutation_error(index, 422)
+
+        result.update({"op": operation["op"], "type": operation["type"]})
+        results.append(result)
+
+    try:
+        commit_changes(*dict.fromkeys(tables))
+    except SQLAlchemyError:
+        db.session.rollback()
+        return json_response({
             "success": False,
             "error": "An error occurred"
-        }), 500
+        }, 500)
+
+    for model, record_id in rows:
+        notify_row_change(model, record_id)
+
+    return json_response({
+        "success": True,
+        "results": results
+    })
 
 @app.route("/actors", methods=["POST"], endpoint="post_actor")
 @requires_auth('post:actor')
@@ -84,16 +820,19 @@ def post_actors(jwt):
         actor = Actor(name=name, age=age, gender=gender)
         actor.insert()
 
-        return json.dumps({
+        if wants_minimal():
+            return minimal_response("actor", actor)
+
+        return json_response({
             "success": True,
             "actors": [actor.format() for actor in Actor.query.all()]
-        }), 200
+        })
 
     except:
-        return json.dumps({
+        return json_response({
             "success": False,
             "error": "An error occured"
-        }), 500
+        }, 500)
 
 @app.route("/movies", methods=["POST"], endpoint="post_movie")
 @requires_auth('post:movie')
@@ -108,16 +847,203 @@ def post_movies(jwt):
         movie = Movie(title=title, release_date=release_date)
         movie.insert()
 
-        return json.dumps({
+        if wants_minimal():
+            return minimal_response("movie", movie)
+
+        return json_response({
             "success": True,
             "movies": [movie.format() for movie in Movie.query.all()]
-        }, default=str), 200
+        })
 
     except:
-        return json.dumps({
+        return json_response({
             "success": False,
             "error": "An error occured"
-        }), 500
+        }, 500)
+
+@app.route("/actors/bulk", methods=["POST"], endpoint="post_actors_bulk")
+@requires_auth('post:actor')
+def post_actors_bulk(jwt):
+    return bulk_import(Actor)
+
+@app.route("/movies/bulk", methods=["POST"], endpoint="post_movies_bulk")
+@requires_auth('post:movie')
+def post_movies_bulk(jwt):
+    return bulk_import(Movie)
+
+def export_response(name):
+    '''
+    Streams a whole table as NDJSON (default) or CSV with chunked transfer encoding
+    '''
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+
+    response = Response(stream_with_context(export_rows(name, fmt)), mimetype=EXPORT_FORMATS[fmt])
+    response.headers["Content-Disposition"] = "attachment; filename={}.{}".format(name, fmt)
+    return response
+
+@app.route("/actors/export", methods=["GET"], endpoint="export_actors")
+@requires_auth('view:actor')
+def export_actors(jwt):
+    return export_response("actors")
+
+@app.route("/movies/export", methods=["GET"], endpoint="export_movies")
+@requires_auth('view:movie')
+def export_movies(jwt):
+    return export_response("movies")
+
+@app.route("/castings/export", methods=["GET"], endpoint="export_castings")
+@requires_auth('view:movie')
+def export_castings(jwt):
+    return export_response("castings")
+
+@app.route("/movies/<movie_id>/actors", methods=["GET"], endpoint="get_movie_actors")
+@requires_auth('view:movie')
+@cached_response(cast_tables)
+def get_movie_actors(jwt, movie_id):
+
+    etag = collection_etag(Movie, ActorMovie, Actor)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    movie = Movie.query.options(selectinload(Movie.actors)).filter_by(id=movie_id).one_or_none()
+
+    if not movie:
+        abort(404)
+
+    return json_response({
+        "success": True,
+        "movie": movie.format_actors()
+    }, etag=etag)
+
+@app.route("/actors/<actor_id>/movies", methods=["GET"], endpoint="get_actor_movies")
+@requires_auth('view:actor')
+@cached_response(cast_tables)
+def get_actor_movies(jwt, actor_id):
+
+    etag = collection_etag(Actor, ActorMovie, Movie)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    actor = Actor.query.options(selectinload(Actor.movies)).filter_by(id=actor_id).one_or_none()
+
+    if not actor:
+        abort(404)
+
+    return json_response({
+        "success": True,
+        "actor": actor.format_movies()
+    }, etag=etag)
+
+@app.route("/actors/<actor_id>", methods=["GET"], endpoint="get_actor")
+@requires_auth('view:actor')
+def get_actor(jwt, actor_id):
+    return record_response(Actor, "actor", actor_id)
+
+@app.route("/movies/<movie_id>", methods=["GET"], endpoint="get_movie")
+@requires_auth('view:movie')
+def get_movie(jwt, movie_id):
+    include = "actors" if request.args.get("include") == "actors" else None
+    return record_response(Movie, "movie", movie_id, include)
+
+@app.route("/movies/<movie_id>/actors", methods=["POST"], endpoint="post_movie_actor")
+@requires_auth('patch:movie')
+def post_movie_actors(jwt, movie_id):
+
+    movie = Movie.query.options(selectinload(Movie.actors)).filter_by(id=movie_id).one_or_none()
+
+    if not movie:
+        abort(404)
+
+    data = request.get_json(silent=True) or {}
+    actor = Actor.query.filter_by(id=data.get("actor_id")).one_or_none()
+
+    if not actor:
+        abort(422)
+
+    if actor in movie.actors:
+        abort(422)
+
+    try:
+        movie.add_actor(actor)
+
+        return json_response({
+            "success": True,
+            "movie": movie.format_actors()
+        })
+
+    except:
+        return json_response({
+            "success": False,
+            "error": "An error occured"
+        }, 500)
+
+@app.route("/movies/<movie_id>/actors/<actor_id>", methods=["DELETE"], endpoint="delete_movie_actor")
+@requires_auth('patch:movie')
+def delete_movie_actors(jwt, movie_id, actor_id):
+
+    movie = Movie.query.options(selectinload(Movie.actors)).filter_by(id=movie_id).one_or_none()
+
+    if not movie:
+        abort(404)
+
+    actor = next((actor for actor in movie.actors if str(actor.id) == actor_id), None)
+
+    if not actor:
+        abort(404)
+
+    try:
+        movie.remove_actor(actor)
+
+        return json_response({
+            "success": True,
+            "movie": movie.format_actors()
+        })
+
+    except:
+        return json_response({
+            "success": False,
+            "error": "An error occured"
+        }, 500)
+
+def bulk_delete(model):
+    '''
+    Deletes the records named by the ids parameter, or matching the filters
+    of the query string, with set-based DELETE statements. One of the two
+    is required, so a bare DELETE never empties a table.
+    '''
+    ids = get_ids_args()
+    filters = get_filter_args(model)
+    if (ids is None) == (not filters):
+        abort(400)
+
+    try:
+        deleted = model.bulk_delete(ids=ids, filters=filters, chunk_size=app.config["MAX_BATCH_SIZE"])
+
+        return json_response({
+            "success": True,
+            "deleted": deleted
+        })
+
+    except:
+        db.session.rollback()
+        return json_response({
+            "success": False,
+            "error": "An error occured"
+        }, 500)
+
+@app.route("/actors", methods=["DELETE"], endpoint="delete_actors_bulk")
+@requires_auth('delete:actor')
+def delete_actors_bulk(jwt):
+    return bulk_delete(Actor)
+
+@app.route("/movies", methods=["DELETE"], endpoint="delete_movies_bulk")
+@requires_auth('delete:movie')
+def delete_movies_bulk(jwt):
+    return bulk_delete(Movie)
 
 @app.route("/actors/<actor_id>", methods=["DELETE"], endpoint="delete_actor")
 @requires_auth('delete:actor')
@@ -131,16 +1057,16 @@ def delete_actors(jwt, actor_id):
     try:
         actor.delete()
 
-        return json.dumps({
+        return json_response({
             "success": True,
             "delete": actor_id
-        }), 200
+        })
 
     except:
-        return json.dumps({
+        return json_response({
             "success": False,
             "error": "An error occured"
-        }), 500
+        }, 500)
 
 @app.route("/movies/<movie_id>", methods=["DELETE"], endpoint="delete_movie")
 @requires_auth('delete:movie')
@@ -151,16 +1077,16 @@ def delete_movies(jwt, movie_id):
     try:
         movie.delete()
 
-        return json.dumps({
+        return json_response({
             "success": True,
             "delete": movie_id
-        }), 200
+        })
 
     except:
-        return json.dumps({
+        return json_response({
             "success": False,
             "error": "An error occured"
-        }), 500
+        }, 500)
 
 
 @app.route("/actors/<actor_id>", methods=["PATCH"], endpoint="patch_actor")
@@ -185,16 +1111,19 @@ def patch_actors(jwt, actor_id):
 
         actor.update()
 
-        return json.dumps({
+        if wants_minimal():
+            return minimal_response("actor", actor)
+
+        return json_response({
             "success": True,
             "actors": [actor.format() for actor in Actor.query.all()]
-        }), 200
+        })
 
     except:
-        return json.dumps({
+        return json_response({
             "success": False,
             "error": "An error occured"
-        }), 500
+        }, 500)
 
 @app.route("/movies/<movie_id>", methods=["PATCH"], endpoint="patch_movie")
 @requires_auth('patch:movie')
@@ -216,19 +1145,71 @@ def patch_movies(jwt, movie_id):
 
         movie.update()
 
-        return json.dumps({
+        if wants_minimal():
+            return minimal_response("movie", movie)
+
+        return json_response({
             "success": True,
             "movies": [movie.format() for movie in Movie.query.all()]
-        }, default=str), 200
+        })
 
     except:
-        return json.dumps({
+        return json_response({
             "success": False,
             "error": "An error occured"
-        }), 500
+        }, 500)
+
+
+@app.route("/health/cache", methods=["GET"])
+def cache_health():
+    return jsonify({
+        "success": True,
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "row_cache": row_cache.stats() if row_cache is not None else None,
+        "token_cache": {
+            "hits": token_cache.hits,
+            "misses": token_cache.misses,
+            "size": len(token_cache.entries)
+        }
+    })
+
+@app.route("/health/db", methods=["GET"])
+def db_health():
+    '''
+    Reports whether a connection can be checked out and used, along with
+    the occupancy and wait statistics of the connection pool
+    '''
+    healthy = True
+    try:
+        with db.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    except SQLAlchemyError:
+        healthy = False
+
+    return json_response({
+        "success": healthy,
+        "pool": pool_status(db.engine.pool),
+        "replicas": replica_router.status()
+    }, 200 if healthy else 503)
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
 
 ## Error Handling
+@app.errorhandler(PoolTimeoutError)
+def pool_exhausted(error):
+    response = jsonify({
+        "success": False,
+        "error": 503,
+        "message": "Database connections exhausted"
+    })
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+
 @app.errorhandler(422)
 def unprocessable(error):
     return jsonify({
@@ -263,4 +1244,6 @@ def handle_auth_error(e):
     return response
 
 if __name__ == '__main__':
+    # load the Auth0 signing keys in the background and keep them fresh
+    jwks_store.start()
     app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
@@ -0,0 +1,268 @@
+'''
+Async entry point serving the same API as app.py under an ASGI server:
+
+    uvicorn asgi:application --workers 4
+
+The read-heavy listings (GET /actors and GET /movies without q, include or ids)
+are answered by coroutines reading through SQLAlchemy's asyncio engine
+(asyncpg on PostgreSQL, aiosqlite on SQLite), so a worker keeps serving
+other requests while it waits on the database. JWT verification, which may
+have to fetch the key set, runs in a thread on a token cache miss. Every
+other route is passed to the Flask app in app.py through a WSGI adapter,
+so both modes share their handlers, auth and caches.
+
+Requires the pinned set of requirements-asgi.txt, whose Quart 0.14 is the
+last release running on the Werkzeug 1.0 that app.py depends on:
+
+    pip install -r requirements-asgi.txt
+'''
+import asyncio
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from quart import Quart, Response, request
+from sqlalchemy import select
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.exceptions import HTTPException
+
+import auth
+import config
+import app as app_module
+from app import get_sort_args, get_filter_args, get_fields_args, get_page_args, versions_etag
+from auth import AuthError, parse_auth_header, check_permissions, verify_decode_jwt, token_cache
+from models import Actor, Movie, TableVersion, table_name
+from serializers import dumps, rows_to_dicts, JSON_MIMETYPE
+
+# Drivers of the asyncio engine, by the scheme of SQLALCHEMY_DATABASE_URI
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+# path -> (model, response key, endpoint name in app.py, permission)
+ASYNC_LISTINGS = {
+    '/actors': (Actor, 'actors', 'get_actors', 'view:actor'),
+    '/movies': (Movie, 'movies', 'get_movies', 'view:movie')
+}
+
+async_app = Quart(__name__)
+engine = None
+
+
+def async_database_url(url):
+    '''
+    Returns url with the driver of the asyncio engine, e.g.
+    postgresql://... becomes postgresql+asyncpg://...
+    '''
+    scheme, rest = url.split('://', 1)
+    return ASYNC_DRIVERS.get(scheme.split('+')[0], scheme) + '://' + rest
+
+
+def async_engine_options():
+    '''
+    Returns the engine options of config.py in the form the asyncio drivers take
+    '''
+    options = {
+        'pool_pre_ping': config.DB_POOL_PRE_PING,
+        'pool_recycle': config.DB_POOL_RECYCLE
+    }
+    if not config.SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        options.update({
+            'pool_size': config.DB_POOL_SIZE,
+            'max_overflow': config.DB_MAX_OVERFLOW,
+            'pool_timeout': config.DB_POOL_TIMEOUT
+        })
+    if config.SQLALCHEMY_DATABASE_URI.startswith('postgres') and config.DB_STATEMENT_TIMEOUT:
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(config.DB_STATEMENT_TIMEOUT)}}
+    return options
+
+
+@async_app.before_serving
+async def create_engine():
+    global engine
+    engine = create_async_engine(async_database_url(config.SQLALCHEMY_DATABASE_URI), **async_engine_options())
+
+
+@async_app.before_serving
+async def start_jwks_refresh():
+    # the store is looked up when serving starts, as tests replace it
+    auth.jwks_store.start()
+
+
+@async_app.after_serving
+async def dispose_engine():
+    await engine.dispose()
+
+
+@async_app.after_serving
+async def stop_jwks_refresh():
+    auth.jwks_store.stop()
+
+
+async def authenticate(permission):
+    '''
+    Returns the payload of the request's bearer token if it grants
+    permission, with the same checks and token cache as requires_auth
+    '''
+    token = parse_auth_header(request.headers.get('Authorization', None))
+    cached = token_cache.get(token)
+    if cached is None:
+        cached = token_cache.put(token, await asyncio.to_thread(verify_decode_jwt, token))
+
+    payload, permissions = cached
+    check_permissions(permission, payload, permissions)
+    return payload
+
+
+async def read_versions(connection, *models):
+    '''
+    Returns {table name: version} like models.table_versions, on an async connection
+    '''
+    names = [table_name(model) for model in models]
+    versions = dict.fromkeys(names, 0)
+    result = await connection.execute(
+        select(TableVersion.c.name, TableVersion.c.version).where(TableVersion.c.name.in_(names)))
+    versions.update(result.all())
+    return versions
+
+
+@async_app.after_request
+async def after_request(response):
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
+    response.headers.add('Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE,OPTIONS')
+    return response
+
+
+def json_body(body, status=200, etag=None):
+    response = Response(body, status, mimetype=JSON_MIMETYPE)
+    if etag:
+        response.set_etag(etag)
+    return response
+
+
+def not_modified(etag):
+    if request.if_none_match.contains(etag):
+        response = Response('', 304)
+        response.set_etag(etag)
+        return response
+
+
+async def listing(path):
+    '''
+    Serves GET /actors or GET /movies from column-projected rows, with the
+    filters, sort, fields, pagination, ETag and response cache of app.py
+    '''
+    model, key, endpoint, permission = ASYNC_LISTINGS[path]
+    jwt = await authenticate(permission)
+
+    args = request.args
+    sort = get_sort_args(model, args)
+    filters = get_filter_args(model, args)
+    limit, after, offset = get_page_args(model, sort, args)
+    fields = get_fields_args(model, args)
+
+    cache = app_module.response_cache
+    cache_key = tags = generations = None
+    if cache is not None:
+        cache_key = cache.make_key(endpoint, request.path, args.items(multi=True), jwt.get('permissions', []))
+        cached = cache.get(cache_key)
+        if cached is not None:
+            etag, body = cached
+            return not_modified(etag) or json_body(body, etag=etag)
+
+        tags = [table_name(model)]
+        generations = cache.generations(tags)
+
+    async with engine.connect() as connection:
+        etag = versions_etag(request.full_path, await read_versions(connection, model))
+        response = not_modified(etag)
+        if response:
+            return response
+
+        # soft-deleted rows are hidden by a session event of models.py, which
+        # this connection bypasses
+        statement = model.projection(limit, after, offset, filters, sort, fields).where(model.deleted_at.is_(None))
+        result = await connection.execute(statement)
+        rows, next_cursor = model.paginate(result.all(), limit, sort)
+
+    body = dumps({
+        "success": True,
+        key: rows_to_dicts(fields, rows),
+        "next_cursor": next_cursor
+    })
+
+    if cache is not None:
+        cache.set(cache_key, etag, body, tags, generations)
+
+    return json_body(body, etag=etag)
+
+
+@async_app.route('/actors', methods=['GET'])
+async def get_actors():
+    return await listing('/actors')
+
+
+@async_app.route('/movies', methods=['GET'])
+async def get_movies():
+    return await listing('/movies')
+
+
+## Error Handling
+@async_app.errorhandler(AuthError)
+async def handle_auth_error(e):
+    return json_body(dumps(e.error), e.status_code)
+
+
+@async_app.errorhandler(HTTPException)
+async def handle_http_error(e):
+    messages = {400: "Bad request", 404: "Resource not found", 422: "unprocessable"}
+    return json_body(dumps({
+        "success": False,
+        "error": e.code,
+        "message": messages.get(e.code, e.name)
+    }), e.code)
+
+
+@async_app.errorhandler(PoolTimeoutError)
+async def pool_exhausted(error):
+    response = json_body(dumps({
+        "success": False,
+        "error": 503,
+        "message": "Database connections exhausted"
+    }), 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+def serves_async(scope):
+    '''
+    True for the requests async_app answers itself: plain GET listings
+    without the q search, include embedding or ids lookup
+    '''
+    if scope['method'] not in ('GET', 'HEAD') or scope['path'] not in ASYNC_LISTINGS:
+        return False
+
+    args = parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+    return not any(name in args for name in ('q', 'include', 'ids'))
+
+
+class Dispatcher:
+    '''
+    ASGI application sending the requests serves_async accepts to async_app
+    and every other request to the Flask app
+    '''
+    def __init__(self, async_app, wsgi_app):
+        self.async_app = async_app
+        self.wsgi_app = WsgiToAsgi(wsgi_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or serves_async(scope):
+            # async_app also handles the lifespan events opening the engine
+            await self.async_app(scope, receive, send)
+        else:
+            await self.wsgi_app(scope, receive, send)
+
+
+application = Dispatcher(async_app, app_module.app)
@@ -1,14 +1,39 @@
+import os
+import re
 import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
+import metrics
+
 # Change these as per your auth0 account variables
 AUTH0_DOMAIN = 'coffechats.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstonecast'
 
+# Where the signing keys are loaded from. JWKS_PATH (a local JSON file) takes
+# precedence over JWKS_URL so the API can be pointed at a stand-in key set.
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_PATH = os.environ.get('JWKS_PATH')
+# Seconds to keep a key set when the response carries no Cache-Control max-age
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+# Minimum seconds between two re-fetches triggered by an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+# Verified tokens are remembered until they expire, bounded by these limits
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 300))
+
+logger = logging.getLogger(__name__)
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -20,12 +45,243 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS Key Store
+'''
+JWKSKeyStore
+Keeps the signing keys in memory, indexed by kid, so verifying a token
+does not need a round trip to Auth0.
+'''
+class JWKSKeyStore:
+    def __init__(self, url=JWKS_URL, path=JWKS_PATH, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL, timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.path = path
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.keys = {}
+        self.expires_at = 0
+        self.last_fetch = 0
+        self.fetch_count = 0
+        self._lock = threading.Lock()
+        # notified whenever a fetch finishes, successfully or not
+        self._fetched = threading.Condition(self._lock)
+        self._fetching = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def fetch(self):
+        '''
+        Returns the raw key set and how many seconds it may be cached for
+        '''
+        if self.path:
+            with open(self.path) as f:
+                return json.load(f), self.ttl
+
+        response = urlopen(self.url, timeout=self.timeout)
+        ttl = self.ttl
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        if match:
+            ttl = int(match.group(1))
+
+        return json.loads(response.read()), ttl
+
+    def refresh(self):
+        '''
+        Replaces the stored keys with a freshly fetched key set. The fetch
+        runs without holding the lock, which only guards the swap.
+        '''
+        with self._lock:
+            self.last_fetch = time.monotonic()
+            self.fetch_count += 1
+            self._fetching = True
+
+        try:
+            with metrics.timed('auth_jwks'):
+                jwks, ttl = self.fetch()
+
+            keys = {}
+            for key in jwks['keys']:
+                keys[key['kid']] = {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key['use'],
+                    'n': key['n'],
+                    'e': key['e']
+                }
+
+            with self._lock:
+                self.keys = keys
+                self.expires_at = time.monotonic() + ttl
+        finally:
+            with self._lock:
+                self._fetching = False
+                self._fetched.notify_all()
+
+    def get_key(self, kid):
+        '''
+        Returns the key for kid. A miss waits up to timeout seconds for a
+        fetch in progress, then re-fetches the key set itself: at most once
+        every min_refresh_interval seconds, or right away while the store
+        holds no keys at all (before the first successful fetch).
+        '''
+        key = self.keys.get(kid)
+        if key:
+            return key
+
+        with self._lock:
+            self._fetched.wait_for(lambda: not self._fetching, timeout=self.timeout)
+            key = self.keys.get(kid)
+            due = (key is None and not self._fetching
+                   and (not self.keys or time.monotonic() - self.last_fetch >= self.min_refresh_interval))
+            if due:
+                # claims the fetch, so concurrent misses wait for it instead
+                self.last_fetch = time.monotonic()
+                self._fetching = True
+
+        if due:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Unable to fetch JWKS from %s', self.path or self.url)
+            key = self.keys.get(kid)
+
+        return key
+
+    def start(self):
+        '''
+        Starts the background thread which fills the store and keeps it fresh
+        '''
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            # every thread gets its own event, so a thread still finishing
+            # after stop() never picks up the event of its successor
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop,), name='jwks-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the background thread, waiting up to timeout seconds for a
+        fetch in progress to finish
+        '''
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stop.set()
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(self.timeout)
+
+    def _run(self, stop):
+        while not stop.is_set():
+            try:
+                self.refresh()
+                delay = max(self.expires_at - time.monotonic(), self.min_refresh_interval)
+            except Exception:
+                # Keep serving the keys we already have and retry shortly
+                logger.exception('Unable to refresh JWKS from %s', self.path or self.url)
+                delay = self.min_refresh_interval
+
+            stop.wait(delay)
+
+
+jwks_store = JWKSKeyStore()
+
+
+## Verified Token Cache
+'''
+TokenCache
+Bounded LRU of verified payloads keyed by the SHA-256 digest of the token,
+so repeated requests with the same bearer token skip signature verification.
+'''
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        '''
+        Returns (payload, permissions) for a cached token or None
+        '''
+        key = self.digest(token)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] <= time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, token, payload):
+        '''
+        Stores a verified payload until the token's exp, at most ttl seconds,
+        and returns (payload, permissions)
+        '''
+        expires_at = time.time() + self.ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+
+        permissions = None
+        if 'permissions' in payload:
+            permissions = frozenset(payload['permissions'])
+
+        key = self.digest(token)
+        with self._lock:
+            self.entries[key] = (payload, permissions, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        return payload, permissions
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+token_cache = TokenCache()
+
+
+def collect_metrics():
+    '''
+    Samples of the key store and token cache counters for GET /metrics
+    '''
+    return [
+        ('jwks_fetches_total', 'counter', 'Fetches of the JWKS key set.', jwks_store.fetch_count),
+        ('token_cache_hits_total', 'counter', 'Tokens found in the verified token cache.', token_cache.hits),
+        ('token_cache_misses_total', 'counter', 'Tokens verified because they were not cached.', token_cache.misses),
+        ('token_cache_entries', 'gauge', 'Tokens in the verified token cache.', len(token_cache.entries))
+    ]
+
+
+metrics.registry.collectors.append(collect_metrics)
+
+
 ## Auth Header
 
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
+    """Returns the bearer token of an Authorization header value
+    """
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -55,27 +311,31 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     '''
     Returns true if the user has sufficient permissions to perform the action or raises an error.
 
         Parameters:
             permission (str): string permission (i.e. 'post:drink')
             payload (dict): decoded jwt payload
+            permissions (frozenset): precomputed permissions of the payload, if known
 
         Returns:
             True: if user has the permission needed
             AuthError: if the use is not permitted to perform the action
     '''
 
-    if 'permissions' not in payload:
-        raise AuthError(
-            {
-                'code': 'invalid_permissions',
-                'description': 'User does not have any roles/permissions attached'
-            }, 401)
+    if permissions is None:
+        if 'permissions' not in payload:
+            raise AuthError(
+                {
+                    'code': 'invalid_permissions',
+                    'description': 'User does not have any roles/permissions attached'
+                }, 401)
+
+        permissions = payload["permissions"]
 
-    if permission not in payload["permissions"]:
+    if permission not in permissions:
         raise AuthError(
             {
                 'code': 'invalid_permissions',
@@ -96,10 +356,13 @@ def verify_decode_jwt(token):
             payload (dict): decoded json web token with its components
     '''
 
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
 
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -107,25 +370,18 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
 
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with metrics.timed('auth_verify'):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://' + AUTH0_DOMAIN + '/'
+                )
 
             return payload
 
@@ -150,12 +406,23 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
+def get_verified_payload(token):
+    '''
+    Returns (payload, permissions) for a token, verifying its signature only
+    when it is not already in the token cache
+    '''
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+
+    return token_cache.put(token, verify_decode_jwt(token))
+
 '''
     @INPUTS
         permission: string permission (i.e. 'post:drink')
 
     it calls the get_token_auth_header method to get the token
-    it calls the verify_decode_jwt method to decode the jwt
+    it calls the get_verified_payload method to decode the jwt (cached per token)
     it calls the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
 '''
@@ -163,10 +430,27 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with metrics.timed('auth_header'):
+                token = get_token_auth_header()
+            payload, permissions = get_verified_payload(token)
+            check_permissions(permission, payload, permissions)
             return f(payload, *args, **kwargs)
 
         return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+    return requires_auth_decorator
+
+'''
+    it calls the get_token_auth_header method to get the token
+    it calls the get_verified_payload method to decode the jwt (cached per token)
+    it checks no permission, the decorated method checks the ones its request needs
+    return the decorator which passes the decoded payload to the decorated method
+'''
+def requires_token(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with metrics.timed('auth_header'):
+            token = get_token_auth_header()
+        payload, permissions = get_verified_payload(token)
+        return f(payload, *args, **kwargs)
+
+    return wrapper
\ No newline at end of file
@@ -0,0 +1,107 @@
+'''
+Compares the query plans and timings of the casting, release date and name
+lookups before and after the indexes of migration 5b7e2c9d4a61.
+
+    python benchmarks/actor_movie_indexes.py --url sqlite:///bench.db --castings 200000
+
+The tables are created from the models in the given database, which must be
+empty (the default is a temporary SQLite file).
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import db, Actor, Movie, ActorMovie  # noqa: E402
+
+QUERIES = {
+    'cast of a movie': (
+        'SELECT actor_id FROM actor_movie WHERE movie_id = :id', lambda n: {'id': random.randint(1, n['movies'])}),
+    'filmography of an actor': (
+        'SELECT movie_id FROM actor_movie WHERE actor_id = :id', lambda n: {'id': random.randint(1, n['actors'])}),
+    'movies released in a month': (
+        'SELECT id FROM movies WHERE release_date >= :start AND release_date < :end',
+        lambda n: {'start': date(2000, 1, 1), 'end': date(2000, 2, 1)}),
+    'actors by name prefix': (
+        'SELECT id FROM actors WHERE name >= :start AND name < :end',
+        lambda n: {'start': 'Actor 12', 'end': 'Actor 13'}),
+}
+
+NEW_INDEXES = [
+    index for table in (ActorMovie, Actor.__table__, Movie.__table__) for index in table.indexes
+]
+
+
+def seed(engine, counts):
+    db.metadata.create_all(engine, tables=[Actor.__table__, Movie.__table__, ActorMovie])
+    for index in NEW_INDEXES:
+        index.drop(engine)
+
+    with engine.begin() as conn:
+        conn.execute(Actor.__table__.insert(), [
+            {'id': i, 'name': 'Actor {}'.format(i), 'age': 20 + i % 60, 'gender': 'Female' if i % 2 else 'Male'}
+            for i in range(1, counts['actors'] + 1)
+        ])
+        conn.execute(Movie.__table__.insert(), [
+            {'id': i, 'title': 'Movie {}'.format(i), 'release_date': date(1970, 1, 1) + timedelta(days=i % 20000)}
+            for i in range(1, counts['movies'] + 1)
+        ])
+        castings = set()
+        while len(castings) < counts['castings']:
+            castings.add((random.randint(1, counts['actors']), random.randint(1, counts['movies'])))
+        conn.execute(ActorMovie.insert(), [{'actor_id': a, 'movie_id': m} for a, m in castings])
+
+
+def explain(conn, sql, params):
+    if conn.dialect.name == 'sqlite':
+        rows = conn.execute(text('EXPLAIN QUERY PLAN ' + sql), params)
+        return [row[-1] for row in rows]
+    return [row[0] for row in conn.execute(text('EXPLAIN ' + sql), params)]
+
+
+def measure(engine, counts, repeat):
+    results = {}
+    with engine.connect() as conn:
+        for name, (sql, params) in QUERIES.items():
+            plan = explain(conn, sql, params(counts))
+            start = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(text(sql), params(counts)).fetchall()
+            results[name] = (plan, (time.perf_counter() - start) / repeat * 1000)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='database URL, a temporary SQLite file by default')
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--castings', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    url = args.url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'indexes.db')
+    engine = create_engine(url)
+    counts = {'actors': args.actors, 'movies': args.movies, 'castings': args.castings}
+
+    seed(engine, counts)
+    before = measure(engine, counts, args.repeat)
+    for index in NEW_INDEXES:
+        index.create(engine)
+    after = measure(engine, counts, args.repeat)
+
+    for name in QUERIES:
+        print('== {}'.format(name))
+        print('  before: {:8.3f} ms  {}'.format(before[name][1], ' | '.join(before[name][0])))
+        print('  after:  {:8.3f} ms  {}'.format(after[name][1], ' | '.join(after[name][0])))
+
+
+if __name__ == '__main__':
+    main()
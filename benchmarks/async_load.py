@@ -0,0 +1,180 @@
+'''
+Compares the sync (gunicorn app:app) and async (uvicorn asgi:application)
+entry points under many concurrent connections, 1000 by default, each
+sending GET requests in a loop for a fixed duration.
+
+By default both servers are started on a seeded SQLite file with a local
+signing key standing in for Auth0 and the response cache disabled, so
+every request reaches the database:
+
+    python benchmarks/async_load.py --connections 1000 --duration 20 --workers 4
+
+Already running servers can be measured instead by passing both base URLs
+(e.g. --sync-url http://127.0.0.1:8000) and a --token they accept.
+
+The async mode needs: pip install -r requirements-asgi.txt
+'''
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from suite import local_signer, percentile  # noqa: E402
+
+
+def seed(env, rows):
+    script = (
+        "from app import app, db\n"
+        "from models import Actor\n"
+        "with app.app_context():\n"
+        "    db.create_all()\n"
+        "    Actor.bulk_insert([{'name': 'Actor %%d' %% i, 'age': 20 + i %% 60, 'gender': 'Female'}"
+        " for i in range(%d)])\n" % rows
+    )
+    subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, check=True)
+
+
+async def read_response(reader):
+    '''
+    Reads one HTTP/1.1 response and returns (status, keep_alive)
+    '''
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+
+    # HTTP/1.0 servers close the connection unless told otherwise
+    length, keep_alive = 0, status_line.startswith(b'HTTP/1.1')
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            keep_alive = value == 'keep-alive'
+
+    await reader.readexactly(length)
+    return int(status_line.split()[1]), keep_alive
+
+
+async def client(url, token, deadline, latencies, errors):
+    parts = urlsplit(url)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    request = ('GET {} HTTP/1.1\r\nHost: {}\r\nAuthorization: Bearer {}\r\n\r\n'
+               .format(path, parts.netloc, token)).encode()
+
+    reader = writer = None
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(parts.hostname, parts.port)
+            writer.write(request)
+            await writer.drain()
+            status, keep_alive = await read_response(reader)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            errors.append(type(e).__name__)
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.05)
+            continue
+
+        if status == 200:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(str(status))
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+
+    if writer is not None:
+        writer.close()
+
+
+async def run_load(url, token, connections, duration):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[client(url, token, deadline, latencies, errors) for _ in range(connections)])
+    return latencies, errors
+
+
+def wait_until_listening(url, timeout=30):
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            asyncio.run(asyncio.wait_for(asyncio.open_connection(parts.hostname, parts.port), 1))
+            return
+        except (OSError, asyncio.TimeoutError):
+            time.sleep(0.2)
+    raise RuntimeError('server at {} did not start'.format(url))
+
+
+def report(mode, latencies, errors, duration):
+    print('{:<6} {:>9.0f} req/s  p50 {:>7.1f} ms  p95 {:>7.1f} ms  p99 {:>7.1f} ms  errors {}'.format(
+        mode, len(latencies) / duration, percentile(latencies, 0.5) * 1e3,
+        percentile(latencies, 0.95) * 1e3, percentile(latencies, 0.99) * 1e3, len(errors)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--path', default='/actors?limit=20')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=10000, help='actors seeded when starting the servers')
+    parser.add_argument('--sync-url', help='measure a running sync server instead of starting one')
+    parser.add_argument('--async-url', help='measure a running async server instead of starting one')
+    parser.add_argument('--token', default=os.environ.get('TOKEN'), help='bearer token for running servers')
+    args = parser.parse_args()
+    if bool(args.sync_url) != bool(args.async_url):
+        parser.error('pass both --sync-url and --async-url, or neither')
+
+    servers = []
+    targets = {'sync': args.sync_url, 'async': args.async_url}
+    token = args.token
+
+    if not args.sync_url:
+        directory = tempfile.mkdtemp()
+        database_url = 'sqlite:///' + os.path.join(directory, 'load.db')
+        jwks_path, sign = local_signer(directory)
+        token = sign(['view:actor', 'view:movie'])
+        env = dict(os.environ, DATABASE_URL=database_url, JWKS_PATH=jwks_path, RESPONSE_CACHE_BACKEND='none')
+        seed(env, args.rows)
+
+        commands = {
+            'sync': ['gunicorn', 'app:app', '--workers', str(args.workers), '--bind', '127.0.0.1:8101',
+                     '--backlog', str(max(2048, args.connections))],
+            'async': ['uvicorn', 'asgi:application', '--workers', str(args.workers), '--port', '8102',
+                      '--backlog', str(max(2048, args.connections)), '--log-level', 'warning']
+        }
+        ports = {'sync': 8101, 'async': 8102}
+        for mode, command in commands.items():
+            servers.append(subprocess.Popen(command, cwd=ROOT, env=env))
+            targets[mode] = 'http://127.0.0.1:{}'.format(ports[mode])
+
+    try:
+        print('{} connections for {:.0f}s against {}'.format(args.connections, args.duration, args.path))
+        for mode in ('sync', 'async'):
+            url = targets[mode].rstrip('/') + args.path
+            wait_until_listening(url)
+            latencies, errors = asyncio.run(run_load(url, token, args.connections, args.duration))
+            report(mode, latencies, errors, args.duration)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''
+Drives more concurrent workers than the connection pool can serve and
+checks that the pool behaves under exhaustion: checkouts never exceed
+pool_size + max_overflow, waiting workers either get a released
+connection or fail after pool_timeout, and every connection is returned.
+
+    python benchmarks/pool_exhaustion.py --workers 50 --pool-size 5 --max-overflow 5
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text  # noqa: E402
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError  # noqa: E402
+
+from models import InstrumentedQueuePool, pool_status  # noqa: E402
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--workers', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=10, help='checkouts per worker')
+    parser.add_argument('--pool-size', type=int, default=5)
+    parser.add_argument('--max-overflow', type=int, default=5)
+    parser.add_argument('--pool-timeout', type=float, default=0.5)
+    parser.add_argument('--hold', type=float, default=0.05, help='seconds each checkout keeps its connection')
+    args = parser.parse_args()
+
+    url = args.url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'pool.db')
+    connect_args = {'check_same_thread': False} if url.startswith('sqlite') else {}
+    engine = create_engine(url, poolclass=InstrumentedQueuePool, pool_size=args.pool_size,
+                           max_overflow=args.max_overflow, pool_timeout=args.pool_timeout,
+                           pool_pre_ping=True, connect_args=connect_args)
+
+    limit = args.pool_size + args.max_overflow
+    lock = threading.Lock()
+    waits, timeouts, errors = [], [], []
+    peak = [0]
+
+    def worker():
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            try:
+                with engine.connect() as connection:
+                    waited = time.perf_counter() - start
+                    with lock:
+                        waits.append(waited)
+                        peak[0] = max(peak[0], engine.pool.checkedout())
+                    connection.execute(text('SELECT 1'))
+                    time.sleep(args.hold)
+            except PoolTimeoutError:
+                with lock:
+                    timeouts.append(time.perf_counter() - start)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+
+    threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    status = pool_status(engine.pool)
+    print('workers={} checkouts={} pool_size={} max_overflow={} pool_timeout={}s'.format(
+        args.workers, args.workers * args.requests, args.pool_size, args.max_overflow, args.pool_timeout))
+    print('served {} in {:.2f}s, {:.0f}/s'.format(len(waits), elapsed, len(waits) / elapsed))
+    print('wait p50 {:.1f} ms  p95 {:.1f} ms  p99 {:.1f} ms'.format(
+        percentile(waits, 0.5) * 1e3, percentile(waits, 0.95) * 1e3, percentile(waits, 0.99) * 1e3))
+    print('timed out {} (after {:.2f}s at most), errors {}'.format(
+        len(timeouts), max(timeouts, default=0), len(errors)))
+    print('peak checked out {} of {}, pool after load: {}'.format(peak[0], limit, status))
+
+    # the pool must stay bounded, fail waiting checkouts within the timeout
+    # (plus scheduling slack) and get every connection back
+    failures = []
+    if peak[0] > limit:
+        failures.append('checked out {} connections, limit is {}'.format(peak[0], limit))
+    if timeouts and max(timeouts) > args.pool_timeout + 1:
+        failures.append('a checkout waited {:.2f}s past pool_timeout'.format(max(timeouts)))
+    if status['checked_out'] != 0:
+        failures.append('{} connections were not returned'.format(status['checked_out']))
+    if errors:
+        failures.append('unexpected errors: {}'.format(errors[:3]))
+
+    engine.dispose()
+    for failure in failures:
+        print('FAIL', failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
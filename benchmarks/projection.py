@@ -0,0 +1,74 @@
+'''
+Compares the per-row CPU time and peak memory of listing actors through ORM
+objects and format() with selecting the columns and serializing the result
+tuples, as GET /actors does.
+
+    python benchmarks/projection.py --rows 100000
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'projection.db'))
+
+from flask import Flask  # noqa: E402
+
+import serializers  # noqa: E402
+from models import setup_db, db, Actor  # noqa: E402
+
+FIELDS = list(Actor.public_fields)
+
+
+def orm_format():
+    return serializers.dumps({'success': True, 'actors': [actor.format() for actor in Actor.query.order_by(Actor.id)]})
+
+
+def projected_rows():
+    rows = db.session.query(*[getattr(Actor, field) for field in FIELDS]).order_by(Actor.id).all()
+    return serializers.dumps({'success': True, 'actors': serializers.rows_to_dicts(FIELDS, rows)})
+
+
+def measure(function, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    db.session.expunge_all()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(timings) / rows * 1e6, peak / rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app)
+
+    with app.app_context():
+        db.create_all()
+        if Actor.query.count() < args.rows:
+            db.session.execute(Actor.__table__.delete())
+            Actor.bulk_insert([{'name': 'Actor {}'.format(i), 'age': 20 + i % 60, 'gender': 'Female'}
+                               for i in range(args.rows)])
+
+        for name, function in (('orm_format', orm_format), ('projected_rows', projected_rows)):
+            cpu, memory = measure(function, args.rows, args.repeat)
+            print('{:15} {:8.2f} us/row {:10.0f} peak bytes/row'.format(name, cpu, memory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+Compares the serialization throughput of the movie listing payload:
+
+    format_stdlib   Movie.format() dicts encoded with json.dumps(default=str)
+    format_fast     Movie.format() dicts encoded with serializers.dumps
+    rows_fast       result tuples turned into dicts and encoded with serializers.dumps
+
+    python benchmarks/serialization.py --rows 100000
+'''
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serializers  # noqa: E402
+from models import Movie  # noqa: E402
+
+KEYS = ('id', 'title', 'release_date')
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = [(i, 'Movie {}'.format(i), date(1970, 1, 1) + timedelta(days=i % 20000)) for i in range(1, args.rows + 1)]
+    movies = []
+    for id, title, release_date in rows:
+        movie = Movie(title=title, release_date=release_date)
+        movie.id = id
+        movies.append(movie)
+
+    cases = {
+        'format_stdlib': lambda: json.dumps({'success': True, 'movies': [m.format() for m in movies]}, default=str),
+        'format_fast': lambda: serializers.dumps({'success': True, 'movies': [m.format() for m in movies]}),
+        'rows_fast': lambda: serializers.dumps({'success': True, 'movies': serializers.rows_to_dicts(KEYS, rows)}),
+    }
+
+    print('encoder: {}'.format('orjson' if serializers.orjson is not None else 'json'))
+    for name, function in cases.items():
+        seconds = best_of(args.repeat, function)
+        print('{:14} {:10.1f} ms {:12.0f} rows/s'.format(name, seconds * 1000, args.rows / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,473 @@
+'''
+Reproducible benchmark of every route of app.py. Seeds a database with
+actors, movies and castings, signs tokens with a local key published as a
+stub JWKS, drives each route through the Flask test client and/or a real
+gunicorn server, and writes p50/p95/p99 latency and throughput per route
+as JSON, so runs on different commits can be compared:
+
+    python benchmarks/suite.py --actors 100000 --movies 20000 --castings 500000 --output base.json
+    git checkout my-branch
+    python benchmarks/suite.py --actors 100000 --movies 20000 --castings 500000 --baseline base.json
+
+The database defaults to a temporary SQLite file; pass --url for a local
+PostgreSQL database (its tables are dropped and re-created unless --reuse
+is given). Seeding and request parameters derive from --seed, so two runs
+with the same arguments issue the same requests. Mutating routes use
+?return=minimal so their timings do not grow with the size of the tables.
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import date, timedelta
+from http.client import HTTPConnection
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+VIEWER = ['view:actor', 'view:movie']
+PRODUCER = VIEWER + ['post:actor', 'delete:actor', 'patch:actor', 'patch:movie', 'post:movie', 'delete:movie']
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def local_signer(directory, kid='benchmark'):
+    '''
+    Writes a JWKS file for a fresh RSA key to directory and returns its path
+    with a function signing tokens for a list of permissions
+    '''
+    import rsa
+    from jose import jwk, jwt
+
+    import auth
+
+    private_key = rsa.newkeys(2048)[1].save_pkcs1().decode()
+    public_key = jwk.construct(private_key, 'RS256').public_key().to_dict()
+    public_key.update({'kid': kid, 'use': 'sig'})
+
+    path = os.path.join(directory, 'jwks.json')
+    with open(path, 'w') as f:
+        json.dump({'keys': [public_key]}, f)
+
+    def sign(permissions, subject='benchmark|user'):
+        return jwt.encode({
+            'sub': subject,
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'aud': auth.API_AUDIENCE,
+            'exp': int(time.time()) + 24 * 3600,
+            'permissions': list(permissions)
+        }, private_key, algorithm='RS256', headers={'kid': kid})
+
+    return path, sign
+
+
+def seed(url, actors, movies, castings, rng, reuse=False, batch_size=10000):
+    '''
+    Creates the tables in url and fills them with generated rows in batches
+    '''
+    from sqlalchemy import create_engine, func, select
+
+    from models import db, Actor, Movie, ActorMovie
+
+    engine = create_engine(url)
+    if reuse:
+        with engine.connect() as connection:
+            if connection.execute(select(func.count()).select_from(Actor.__table__)).scalar():
+                engine.dispose()
+                return
+    else:
+        db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+
+    def insert(table, rows):
+        batch = []
+        with engine.begin() as connection:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    connection.execute(table.insert(), batch)
+                    batch = []
+            if batch:
+                connection.execute(table.insert(), batch)
+
+    genders = ['Female', 'Male']
+    insert(Actor.__table__, ({'id': i, 'name': 'Actor {}'.format(i), 'age': rng.randint(18, 90),
+                              'gender': genders[i % 2]} for i in range(1, actors + 1)))
+    insert(Movie.__table__, ({'id': i, 'title': 'Movie {}'.format(i),
+                              'release_date': date(1950, 1, 1) + timedelta(days=rng.randint(0, 27000))}
+                             for i in range(1, movies + 1)))
+
+    # distinct (movie, actor) pairs drawn from the whole grid
+    pairs = rng.sample(range(actors * movies), min(castings, actors * movies))
+    insert(ActorMovie, ({'movie_id': pair // actors + 1, 'actor_id': pair % actors + 1} for pair in pairs))
+
+    if engine.dialect.name == 'postgresql':
+        # continue the id sequences after the explicit ids
+        with engine.begin() as connection:
+            for table in ('actors', 'movies'):
+                connection.exec_driver_sql(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), (SELECT max(id) FROM {0}))".format(table))
+    engine.dispose()
+
+
+class Case:
+    '''
+    A benchmarked route. prepare(client, i) runs untimed before the timed
+    requests (e.g. creating the record a DELETE removes) and returns the
+    (method, path, body) of the i-th request.
+    '''
+
+    def __init__(self, name, permissions, prepare, share=1.0):
+        self.name = name
+        self.permissions = permissions
+        self.prepare = prepare
+        # fraction of --requests issued for this route
+        self.share = share
+
+
+def build_cases(sizes, rng):
+    actors, movies = sizes['actors'], sizes['movies']
+
+    def actor_id():
+        return rng.randint(1, actors)
+
+    def movie_id():
+        return rng.randint(1, movies)
+
+    def new_actor(client, i):
+        status, data = client.request('POST', '/actors?return=minimal',
+                                      {'name': 'Bench actor {}'.format(i), 'age': 30, 'gender': 'Female'})
+        return data['id']
+
+    def new_movie(client, i):
+        status, data = client.request('POST', '/movies?return=minimal',
+                                      {'title': 'Bench movie {}'.format(i), 'release_date': '2020-01-01'})
+        return data['id']
+
+    def cast(client, i):
+        movie, actor = movie_id(), new_actor(client, i)
+        client.request('POST', '/movies/{}/actors'.format(movie), {'actor_id': actor})
+        return movie, actor
+
+    def bulk(kind):
+        def prepare(client, i):
+            if kind == 'actors':
+                rows = [{'name': 'Bulk actor {} {}'.format(i, n), 'age': 40, 'gender': 'Male'} for n in range(100)]
+            else:
+                rows = [{'title': 'Bulk movie {} {}'.format(i, n), 'release_date': '2010-05-05'} for n in range(100)]
+            return 'POST', '/{}/bulk'.format(kind), rows
+        return prepare
+
+    return [
+        Case('index', [], lambda c, i: ('GET', '/', None)),
+        Case('get_actors', VIEWER, lambda c, i: ('GET', '/actors?limit=50&after={}'.format(actor_id()), None)),
+        Case('get_actors_sorted', VIEWER, lambda c, i: (
+            'GET', '/actors?sort=-age&gender=Female&age[gte]={}&limit=50'.format(rng.randint(18, 80)), None)),
+        Case('get_actors_search', VIEWER, lambda c, i: ('GET', '/actors?q=actor {}'.format(actor_id()), None)),
+        Case('get_actors_include', VIEWER, lambda c, i: (
+            'GET', '/actors?include=movies&limit=20&after={}'.format(actor_id()), None)),
+        Case('get_movies', VIEWER, lambda c, i: ('GET', '/movies?limit=50&after={}'.format(movie_id()), None)),
+        Case('get_movies_include', VIEWER, lambda c, i: (
+            'GET', '/movies?include=actors&limit=20&after={}'.format(movie_id()), None)),
+        Case('get_actor', VIEWER, lambda c, i: ('GET', '/actors/{}'.format(actor_id()), None)),
+        Case('get_movie_include', VIEWER, lambda c, i: ('GET', '/movies/{}?include=actors'.format(movie_id()), None)),
+        Case('get_actors_ids', VIEWER, lambda c, i: (
+            'GET', '/actors?ids={}'.format(','.join(str(actor_id()) for _ in range(100))), None)),
+        Case('post_batch', VIEWER, lambda c, i: (
+            'POST', '/batch', {'actors': [actor_id() for _ in range(100)], 'movies': [movie_id() for _ in range(100)]})),
+        Case('get_movie_actors', VIEWER, lambda c, i: ('GET', '/movies/{}/actors'.format(movie_id()), None)),
+        Case('get_actor_movies', VIEWER, lambda c, i: ('GET', '/actors/{}/movies'.format(actor_id()), None)),
+        Case('post_actor', PRODUCER, lambda c, i: (
+            'POST', '/actors?return=minimal', {'name': 'New actor {}'.format(i), 'age': 25, 'gender': 'Male'})),
+        Case('post_movie', PRODUCER, lambda c, i: (
+            'POST', '/movies?return=minimal', {'title': 'New movie {}'.format(i), 'release_date': '2021-03-04'})),
+        Case('patch_actor', PRODUCER, lambda c, i: (
+            'PATCH', '/actors/{}?return=minimal'.format(actor_id()),
+            {'name': 'Renamed actor {}'.format(i), 'age': 33, 'gender': 'Female'})),
+        Case('patch_movie', PRODUCER, lambda c, i: (
+            'PATCH', '/movies/{}?return=minimal'.format(movie_id()),
+            {'title': 'Renamed movie {}'.format(i), 'release_date': '1999-09-09'})),
+        Case('post_movie_actor', PRODUCER, lambda c, i: (
+            'POST', '/movies/{}/actors'.format(movie_id()), {'actor_id': new_actor(c, i)})),
+        Case('delete_movie_actor', PRODUCER, lambda c, i: (
+            'DELETE', '/movies/{}/actors/{}'.format(*cast(c, i)), None)),
+        Case('delete_actor', PRODUCER, lambda c, i: ('DELETE', '/actors/{}'.format(new_actor(c, i)), None)),
+        Case('delete_movie', PRODUCER, lambda c, i: ('DELETE', '/movies/{}'.format(new_movie(c, i)), None)),
+        Case('post_batch_mutations', PRODUCER, lambda c, i: ('POST', '/batch/mutations', {'operations': [
+            {'op': 'patch', 'type': 'actors', 'id': actor_id(),
+             'data': {'name': 'Batch actor {} {}'.format(i, n), 'age': 44, 'gender': 'Male'}} for n in range(50)]})),
+        Case('delete_actors_bulk', PRODUCER, lambda c, i: (
+            'DELETE', '/actors?ids={}'.format(','.join(str(new_actor(c, i * 10 + n)) for n in range(10))), None)),
+        Case('post_actors_bulk', PRODUCER, bulk('actors'), share=0.1),
+        Case('post_movies_bulk', PRODUCER, bulk('movies'), share=0.1),
+        Case('export_actors', VIEWER, lambda c, i: ('GET', '/actors/export?format=ndjson', None), share=0.02),
+        Case('export_movies', VIEWER, lambda c, i: ('GET', '/movies/export?format=csv', None), share=0.02),
+        Case('export_castings', VIEWER, lambda c, i: ('GET', '/castings/export', None), share=0.02),
+        Case('health_cache', [], lambda c, i: ('GET', '/health/cache', None)),
+        Case('health_db', [], lambda c, i: ('GET', '/health/db', None)),
+        Case('metrics', [], lambda c, i: ('GET', '/metrics', None)),
+    ]
+
+
+class TestClientTarget:
+    '''
+    Sends requests through the Flask test client, in process
+    '''
+    name = 'test_client'
+
+    def __init__(self):
+        from app import app
+        self.client = app.test_client()
+        self.token = None
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Authorization': 'Bearer ' + (token or self.token)} if (token or self.token) else {}
+        res = self.client.open(path, method=method, json=body, headers=headers)
+        data = res.get_data()
+        return res.status_code, json.loads(data) if res.mimetype == 'application/json' and data else None
+
+    def close(self):
+        pass
+
+
+class HTTPTarget:
+    '''
+    Sends requests over HTTP, with one keep-alive connection per thread
+    '''
+    name = 'gunicorn'
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.token = None
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, token=None):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = HTTPConnection(self.host, self.port, timeout=60)
+
+        headers = {}
+        if token or self.token:
+            headers['Authorization'] = 'Bearer ' + (token or self.token)
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        try:
+            connection.request(method, path, payload, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, ConnectionError):
+            connection.close()
+            self.local.connection = None
+            raise
+
+        if response.getheader('Content-Type', '').startswith('application/json') and data:
+            return response.status, json.loads(data)
+        return response.status, None
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+
+
+def run_case(target, case, requests, concurrency, sign, warmup=0):
+    '''
+    Prepares and then times the requests of a case, split over concurrency
+    threads, and returns its statistics. The warmup requests run first,
+    untimed, so loading keys and caches does not count.
+    '''
+    target.token = sign(case.permissions) if case.permissions else None
+    for i in range(requests, requests + warmup):
+        target.request(*case.prepare(target, i))
+    prepared = [case.prepare(target, i) for i in range(requests)]
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def worker(chunk):
+        for method, path, body in chunk:
+            start = time.perf_counter()
+            try:
+                status, data = target.request(method, path, body)
+            except Exception as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors.append(status)
+        target.close()
+
+    threads = [threading.Thread(target=worker, args=(prepared[n::concurrency],)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'error_statuses': sorted(set(map(str, errors))),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        'throughput_rps': round(len(latencies) / wall, 1) if wall else 0.0
+    }
+
+
+def start_gunicorn(env, workers, port):
+    server = subprocess.Popen(['gunicorn', 'app:app', '--workers', str(workers), '--bind', '127.0.0.1:{}'.format(port)],
+                              cwd=ROOT, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            connection = HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            connection.close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError('gunicorn exited with status {}'.format(server.returncode))
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    '''
+    Prints the change of p50 and p95 of every route against a previous run
+    '''
+    for target, routes in results['results'].items():
+        previous = baseline.get('results', {}).get(target, {})
+        for name, stats in routes.items():
+            if name not in previous:
+                continue
+            changes = []
+            for key in ('p50_ms', 'p95_ms'):
+                before = previous[name][key]
+                change = (stats[key] - before) / before * 100 if before else 0.0
+                changes.append('{} {:.2f} -> {:.2f} ms ({:+.0f}%)'.format(key[:3], before, stats[key], change))
+            print('{:<12} {:<20} {}'.format(target, name, '  '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='database URL, a temporary SQLite file by default')
+    parser.add_argument('--reuse', action='store_true', help='keep an already seeded database')
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--castings', type=int, default=50000)
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed requests per route')
+    parser.add_argument('--target', choices=['test_client', 'gunicorn', 'both'], default='test_client')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads against gunicorn')
+    parser.add_argument('--port', type=int, default=8111)
+    parser.add_argument('--cache', choices=['none', 'lru'], default='none', help='response cache backend')
+    parser.add_argument('--routes', help='comma separated subset of the routes to run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSON file to write, stdout by default')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    url = args.url or 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    sizes = {'actors': args.actors, 'movies': args.movies, 'castings': args.castings}
+
+    # config and auth read their settings when they are imported, and the
+    # gunicorn workers inherit them
+    os.environ.update({
+        'DATABASE_URL': url,
+        'JWKS_PATH': os.path.join(directory, 'jwks.json'),
+        'RESPONSE_CACHE_BACKEND': args.cache
+    })
+    jwks_path, sign = local_signer(directory)
+
+    start = time.perf_counter()
+    seed(url, args.actors, args.movies, args.castings, random.Random(args.seed), reuse=args.reuse)
+    print('seeded in {:.1f}s'.format(time.perf_counter() - start), file=sys.stderr)
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'database': url.split(':', 1)[0],
+            'sizes': sizes,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'workers': args.workers,
+            'cache': args.cache,
+            'seed': args.seed
+        },
+        'results': {}
+    }
+
+    targets = ['test_client', 'gunicorn'] if args.target == 'both' else [args.target]
+    for name in targets:
+        server = None
+        if name == 'gunicorn':
+            server = start_gunicorn(dict(os.environ), args.workers, args.port)
+            target, concurrency = HTTPTarget('127.0.0.1', args.port), args.concurrency
+        else:
+            target, concurrency = TestClientTarget(), 1
+
+        # the same request sequence for every target and run
+        cases = build_cases(sizes, random.Random(args.seed))
+        if args.routes:
+            cases = [case for case in cases if case.name in args.routes.split(',')]
+
+        try:
+            routes = results['results'][name] = {}
+            for case in cases:
+                requests = max(1, int(args.requests * case.share))
+                routes[case.name] = run_case(target, case, requests, concurrency, sign,
+                                             min(args.warmup, requests))
+                print('{:<12} {:<20} {}'.format(name, case.name, routes[case.name]), file=sys.stderr)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
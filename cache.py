@@ -0,0 +1,222 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class LRUBackend:
+    '''
+    In-process LRU cache of bytes values with tag based invalidation.
+    Each process has its own copy, so with several gunicorn workers an
+    invalidation only reaches the worker which handled the write; use the
+    Redis backend for multi-process deployments.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.generations = {}
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                self._discard(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, tags=()):
+        with self._lock:
+            self._discard(key)
+            self.entries[key] = (value, time.monotonic() + self.ttl, tuple(tags))
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._discard(next(iter(self.entries)))
+                self.evictions += 1
+
+    def generation(self, tag):
+        return self.generations.get(tag, 0)
+
+    def invalidate(self, tag):
+        with self._lock:
+            self.generations[tag] = self.generations.get(tag, 0) + 1
+            for key in self.tags.pop(tag, ()):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+
+
+class RedisBackend:
+    '''
+    Cache backend storing values in Redis (or any client with the same
+    get/set/delete/sadd/smembers/expire/incr/scan_iter methods), shared by
+    all workers. Tags are Redis sets of the keys cached under them, expiring
+    with the last entry added to them.
+    '''
+
+    def __init__(self, client, ttl=60, prefix='casting:cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        # Redis evicts keys on its own, the count is reported by INFO stats
+        self.evictions = 0
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, tags=()):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            self.client.sadd(tag_key, self.prefix + key)
+            self.client.expire(tag_key, self.ttl)
+
+    def generation(self, tag):
+        return int(self.client.get(self.prefix + 'generation:' + tag) or 0)
+
+    def invalidate(self, tag):
+        self.client.incr(self.prefix + 'generation:' + tag)
+        tag_key = self.prefix + 'tag:' + tag
+        keys = list(self.client.smembers(tag_key))
+        self.client.delete(tag_key, *keys)
+
+    def clear(self):
+        # generation counters are kept so they never go back to a value a
+        # response still being built has read
+        generations = self.prefix + 'generation:'
+        keys = [key for key in self.client.scan_iter(match=self.prefix + '*', count=1000)
+                if not (key.decode() if isinstance(key, bytes) else key).startswith(generations)]
+        for start in range(0, len(keys), 1000):
+            self.client.delete(*keys[start:start + 1000])
+
+
+class ResponseCache:
+    '''
+    Caches serialized response bodies with their ETag per (endpoint, query
+    parameters, permission set), tagged with the tables they were read from
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(endpoint, path, args, permissions):
+        parts = [endpoint, path, repr(sorted(args)), repr(sorted(permissions))]
+        return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        '''
+        Returns (etag, body) of a cached response or None
+        '''
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        etag, body = value.split(b'\n', 1)
+        return etag.decode(), body
+
+    def generations(self, tags):
+        return [self.backend.generation(tag) for tag in tags]
+
+    def set(self, key, etag, body, tags, generations):
+        '''
+        Stores a response unless one of its tags was invalidated since
+        generations were read, i.e. while the response was being built
+        '''
+        if self.generations(tags) != generations:
+            return
+        self.backend.set(key, etag.encode() + b'\n' + body, tags)
+
+    def invalidate(self, tag):
+        self.backend.invalidate(tag)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions
+        }
+
+
+class RowCache(ResponseCache):
+    '''
+    Caches serialized single records with their ETag per (table, primary
+    key, embedded relationship). Entries are tagged with their row, which
+    the update() and delete() methods of the models invalidate, and with
+    the tables of any embedded records.
+    '''
+
+    @staticmethod
+    def make_key(name, id, include=None):
+        return 'row:{}:{}:{}'.format(name, id, include or '')
+
+    @staticmethod
+    def row_tag(name, id):
+        return '{}:{}'.format(name, id)
+
+
+def create_backend(config, maxsize, prefix):
+    '''
+    Returns the backend selected by RESPONSE_CACHE_BACKEND ('lru', 'redis'
+    or 'none'), None when caching is disabled
+    '''
+    backend = config.get('RESPONSE_CACHE_BACKEND', 'none')
+    ttl = config.get('RESPONSE_CACHE_TTL', 60)
+
+    if backend == 'none':
+        return None
+
+    if backend == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RESPONSE_CACHE_BACKEND is 'redis' (the default when REDIS_URL is set) "
+                               "but the redis package is not installed, run pip install -r requirements.txt")
+        return RedisBackend(redis.Redis.from_url(config.get('REDIS_URL') or 'redis://localhost:6379/0'), ttl=ttl, prefix=prefix)
+
+    return LRUBackend(maxsize=maxsize, ttl=ttl)
+
+
+def create_response_cache(config):
+    '''
+    Returns the response cache, None when caching is disabled
+    '''
+    backend = create_backend(config, config.get('RESPONSE_CACHE_SIZE', 1024), 'casting:cache:')
+    return ResponseCache(backend) if backend is not None else None
+
+
+def create_row_cache(config):
+    '''
+    Returns the cache of single records, on the same kind of backend as the
+    response cache but with its own entries, None when caching is disabled
+    '''
+    backend = create_backend(config, config.get('ROW_CACHE_SIZE', 10000), 'casting:rows:')
+    return RowCache(backend) if backend is not None else None
@@ -10,4 +10,99 @@ PORT = 5432
 
 # SQLALCHEMY_DATABASE_URI = f'{SCHEME}://{USER}:{PASSWORD}@{HOST}:{PORT}/{DATABASE_NAME}'
 SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
-SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Page sizes of the GET /actors and GET /movies listings
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+# Most ids a ?ids= lookup or a POST /batch request may ask for
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1000))
+
+# Soft delete: deletes only set deleted_at and `python manage.py purge`
+# hard-deletes the rows later, PURGE_BATCH_SIZE rows per transaction with
+# a pause of PURGE_PAUSE seconds between batches
+SOFT_DELETE = os.environ.get('SOFT_DELETE', 'false').lower() in ('1', 'true', 'yes')
+PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', 500))
+PURGE_PAUSE = float(os.environ.get('PURGE_PAUSE', 0.1))
+
+# Rows inserted per executemany/commit by POST /actors/bulk and POST /movies/bulk
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+MAX_BULK_BATCH_SIZE = int(os.environ.get('MAX_BULK_BATCH_SIZE', 10000))
+
+# Response cache of the read endpoints: 'redis', 'lru' or 'none'. The lru
+# backend lives in each process and is not invalidated by writes handled by
+# other workers, so it is only safe with a single worker; without REDIS_URL
+# the caches are off unless a backend is chosen explicitly.
+REDIS_URL = os.environ.get('REDIS_URL')
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'redis' if REDIS_URL else 'none')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+# Records kept by the lru backend of the GET /actors/<id> and /movies/<id> cache
+ROW_CACHE_SIZE = int(os.environ.get('ROW_CACHE_SIZE', 10000))
+
+# Connection pool of the database engine. The pool sizes only apply to
+# server databases; SQLite keeps the pool Flask-SQLAlchemy picks for it.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# Seconds a request waits for a free connection before failing with a 503
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Seconds after which a connection is replaced, below the server's idle timeout
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# Test connections on checkout so a failover does not surface as 500s
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# Milliseconds a PostgreSQL statement may run before it is cancelled, 0 for no limit
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))
+
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_pre_ping': DB_POOL_PRE_PING,
+    'pool_recycle': DB_POOL_RECYCLE
+}
+
+if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+    SQLALCHEMY_ENGINE_OPTIONS.update({
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT
+    })
+
+if SQLALCHEMY_DATABASE_URI.startswith('postgresql') and DB_STATEMENT_TIMEOUT:
+    SQLALCHEMY_ENGINE_OPTIONS['connect_args'] = {
+        'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+    }
+
+# Optional read replicas, a comma separated list of database URLs. GET
+# requests read from them in turn; everything else uses the primary.
+SQLALCHEMY_REPLICA_URIS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+# Seconds a client reads from the primary after one of its writes
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# Seconds between two health checks of a replica
+REPLICA_HEALTH_CHECK_INTERVAL = int(os.environ.get('REPLICA_HEALTH_CHECK_INTERVAL', 10))
+
+# SQL profiler for development and tests: logs the query count, repeated
+# statements and slow queries of each request and flags endpoints running
+# more queries than their budget
+SQL_PROFILER = os.environ.get('SQL_PROFILER', 'false').lower() in ('1', 'true', 'yes')
+SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', 100))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+# Most queries an endpoint may run; a change making a listing run one query
+# per row (N+1) shows up here first. Bulk imports and exports are left out
+# because they run one statement per batch.
+QUERY_BUDGETS = {
+    'get_actors': 3,
+    'get_movies': 4,
+    'get_actor_movies': 3,
+    'get_movie_actors': 3,
+    'get_actor': 1,
+    'get_movie': 2,
+    'post_batch': 2,
+    'post_actor': 3,
+    'post_movie': 3,
+    'patch_actor': 4,
+    'patch_movie': 4,
+    'delete_actor': 4,
+    'delete_movie': 4,
+    'delete_actors_bulk': 5,
+    'delete_movies_bulk': 5,
+    'post_movie_actor': 8,
+    'delete_movie_actor': 6
+}
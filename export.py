@@ -0,0 +1,85 @@
+import io
+import csv
+
+from sqlalchemy import select
+
+from models import db, Actor, Movie, ActorMovie
+from serializers import dumps
+
+# Tables which can be exported, by name
+EXPORT_TABLES = {
+    'actors': Actor.__table__,
+    'movies': Movie.__table__,
+    'castings': ActorMovie
+}
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+# Rows fetched from the server-side cursor per chunk
+EXPORT_CHUNK_SIZE = 1000
+
+
+def export_query(table):
+    '''
+    Returns the select of the exported columns of a table ordered by id,
+    leaving out soft-deleted records and the castings of soft-deleted
+    actors and movies
+    '''
+    query = select(*export_columns(table)).order_by(table.c.id)
+    if 'deleted_at' in table.c:
+        return query.where(table.c.deleted_at.is_(None))
+
+    if table is ActorMovie:
+        query = query.where(table.c.actor_id.in_(select(Actor.id).where(Actor.deleted_at.is_(None))),
+                            table.c.movie_id.in_(select(Movie.id).where(Movie.deleted_at.is_(None))))
+    return query
+
+
+def export_columns(table):
+    return [column for column in table.columns if column.name != 'deleted_at']
+
+
+def iter_chunks(table, chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+    Yields the rows of a table ordered by id, chunk_size rows at a time,
+    reading them through a server-side cursor
+    '''
+    query = export_query(table).execution_options(stream_results=True)
+    result = db.session.execute(query)
+
+    try:
+        for chunk in result.partitions(chunk_size):
+            yield chunk
+    finally:
+        result.close()
+
+
+def export_rows(name, fmt='ndjson', chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+    Yields a table as NDJSON or CSV, one bytes string per chunk of rows, so
+    memory use does not depend on the size of the table
+    '''
+    table = EXPORT_TABLES[name]
+    # plain str keys: orjson rejects the quoted_name subclass of Core tables
+    columns = [str(column.name) for column in export_columns(table)]
+
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+
+        for chunk in iter_chunks(table, chunk_size):
+            writer.writerows(chunk)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+        return
+
+    for chunk in iter_chunks(table, chunk_size):
+        yield b''.join(dumps(dict(zip(columns, row))) + b'\n' for row in chunk)
@@ -0,0 +1,11 @@
+'''
+gunicorn settings, read from the working directory by `gunicorn app:app`
+'''
+
+
+def post_worker_init(worker):
+    # load the Auth0 signing keys in the background and keep them fresh;
+    # started per worker once the app is loaded rather than when app.py is
+    # imported, so the tests, manage.py and the benchmarks make no fetches
+    from auth import jwks_store
+    jwks_store.start()
@@ -1,8 +1,13 @@
+import sys
+import time
+from datetime import datetime, timedelta
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, purge_deleted, Actor, Movie
+from export import export_rows, EXPORT_TABLES, EXPORT_FORMATS
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +15,47 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('table', choices=sorted(EXPORT_TABLES), help='Table to export')
+@manager.option('-f', '--format', dest='fmt', choices=sorted(EXPORT_FORMATS), default='ndjson', help='Output format')
+@manager.option('-o', '--output', dest='output', default=None, help='Output file, stdout when omitted')
+def export(table, fmt, output):
+    '''
+    Streams a table as NDJSON or CSV without loading it into memory
+    '''
+    out = open(output, 'wb') if output else sys.stdout.buffer
+    try:
+        for chunk in export_rows(table, fmt):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=None,
+                help='Rows deleted per transaction, PURGE_BATCH_SIZE by default')
+@manager.option('-p', '--pause', dest='pause', type=float, default=None,
+                help='Seconds to sleep between batches, PURGE_PAUSE by default')
+@manager.option('-a', '--older-than', dest='older_than', type=int, default=0,
+                help='Only purge rows soft-deleted at least this many seconds ago')
+@manager.option('-w', '--watch', dest='watch', type=int, default=0,
+                help='Keep running, purging again every this many seconds')
+def purge(batch_size, pause, older_than, watch):
+    '''
+    Hard-deletes soft-deleted actors and movies, and their castings, in
+    small throttled batches outside of request handling
+    '''
+    batch_size = batch_size or app.config['PURGE_BATCH_SIZE']
+    pause = app.config['PURGE_PAUSE'] if pause is None else pause
+
+    while True:
+        before = datetime.utcnow() - timedelta(seconds=older_than) if older_than else None
+        purged = purge_deleted([Movie, Actor], batch_size, before, pause)
+        print(' '.join('{}={}'.format(table, count) for table, count in purged.items()))
+
+        if not watch:
+            break
+        time.sleep(watch)
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -0,0 +1,189 @@
+import time
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Phases of a request recorded with timed(), in Server-Timing order
+PHASES = ('auth_header', 'auth_jwks', 'auth_verify', 'db', 'serialize')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    '''
+    Monotonic counter with one value per combination of label values
+    '''
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        for label_values, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Histogram:
+    '''
+    Cumulative histogram of observed durations. Observations only bump one
+    bucket count; the cumulative counts are computed when rendering.
+    '''
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # bucket counts (the last one is +Inf), sum
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        names = self.labels + ('le',)
+        for label_values, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(names, label_values + (bound,)), cumulative))
+            labels = format_labels(self.labels, label_values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, round(total, 9)))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    '''
+    The metrics exposed by GET /metrics. Collectors are callables returning
+    (name, type, help, value) samples read at scrape time from counters kept
+    elsewhere, e.g. the hits of the response cache.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for name, kind, help, value in collector():
+                lines.extend(['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, kind),
+                              '{} {}'.format(name, value)])
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    'http_requests_total', 'Requests handled, by endpoint, method and status.', ('endpoint', 'method', 'status')))
+REQUEST_DURATION = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time to build the response, by endpoint.', ('endpoint', 'method')))
+PHASE_DURATION = registry.register(Histogram(
+    'http_request_phase_duration_seconds',
+    'Time spent per request in auth_header, auth_jwks, auth_verify, db and serialize, by endpoint.',
+    ('endpoint', 'phase')))
+
+
+# Timings of the request the current thread is handling, set by
+# start_request. A thread local is much cheaper to reach than flask.g.
+current = threading.local()
+
+
+def record(phase, seconds):
+    '''
+    Adds seconds to the time the current request spent in phase
+    '''
+    timings = getattr(current, 'timings', None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+class timed:
+    '''
+    Records the time spent in a with block as phase of the current request.
+    A plain class rather than a contextmanager generator to keep it cheap.
+    '''
+    __slots__ = ('phase', 'start')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        record(self.phase, time.perf_counter() - self.start)
+
+
+def start_request():
+    current.start = time.perf_counter()
+    current.timings = {}
+
+
+def finish_request(response, endpoint, method):
+    '''
+    Observes the total and per-phase durations of the request and adds
+    them to the response as a Server-Timing header
+    '''
+    timings = getattr(current, 'timings', None)
+    if timings is None:
+        return response
+
+    total = time.perf_counter() - current.start
+    current.timings = None
+    endpoint = endpoint or 'unmatched'
+
+    REQUESTS.inc(endpoint, method, response.status_code)
+    REQUEST_DURATION.observe(total, endpoint, method)
+
+    entries = []
+    for phase in PHASES:
+        if phase in timings:
+            PHASE_DURATION.observe(timings[phase], endpoint, phase)
+            entries.append('{};dur={:.3f}'.format(phase, timings[phase] * 1000))
+    entries.append('total;dur={:.3f}'.format(total * 1000))
+    response.headers['Server-Timing'] = ', '.join(entries)
+
+    return response
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_start'] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record('db', time.perf_counter() - conn.info.pop('query_start', time.perf_counter()))
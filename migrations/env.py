@@ -79,6 +79,11 @@ def run_migrations_online():
     )
 
     with connectable.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            # batch operations copy and drop tables, which must not fire the
+            # ondelete cascades models.py enables on every SQLite connection
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
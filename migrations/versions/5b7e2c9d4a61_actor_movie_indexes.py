@@ -0,0 +1,35 @@
+"""actor_movie indexes and unique casting
+
+Revision ID: 5b7e2c9d4a61
+Revises: 88f2f41ebf19
+Create Date: 2026-10-18 10:12:03.412871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2c9d4a61'
+down_revision = '88f2f41ebf19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the oldest row of every duplicated casting so the unique index can be built
+    op.execute(
+        'DELETE FROM actor_movie WHERE id NOT IN '
+        '(SELECT MIN(id) FROM actor_movie GROUP BY actor_id, movie_id)'
+    )
+    op.create_index('ix_actor_movie_movie_id_actor_id', 'actor_movie', ['movie_id', 'actor_id'], unique=True)
+    op.create_index('ix_actor_movie_actor_id_movie_id', 'actor_movie', ['actor_id', 'movie_id'], unique=False)
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'], unique=False)
+    op.create_index('ix_actors_name', 'actors', ['name'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_name', table_name='actors')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_actor_movie_actor_id_movie_id', table_name='actor_movie')
+    op.drop_index('ix_actor_movie_movie_id_actor_id', table_name='actor_movie')
@@ -0,0 +1,39 @@
+"""full-text and trigram search indexes
+
+Revision ID: 9d3f6a1c2e47
+Revises: 5b7e2c9d4a61
+Create Date: 2026-10-18 11:40:27.905113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3f6a1c2e47'
+down_revision = '5b7e2c9d4a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite has no tsvector/trigram support, the models fall back to an
+    # in-process prefix index there
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute("CREATE INDEX ix_actors_name_tsv ON actors USING gin (to_tsvector('simple', name))")
+    op.execute('CREATE INDEX ix_actors_name_trgm ON actors USING gin (name gin_trgm_ops)')
+    op.execute("CREATE INDEX ix_movies_title_tsv ON movies USING gin (to_tsvector('simple', title))")
+    op.execute('CREATE INDEX ix_movies_title_trgm ON movies USING gin (title gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_movies_title_tsv', table_name='movies')
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
+    op.drop_index('ix_actors_name_tsv', table_name='actors')
@@ -0,0 +1,40 @@
+"""soft delete deleted_at columns and partial indexes
+
+Revision ID: a7d2e5f8c341
+Revises: e1a4d7c3b852
+Create Date: 2026-10-18 17:42:51.208316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d2e5f8c341'
+down_revision = 'e1a4d7c3b852'
+branch_labels = None
+depends_on = None
+
+LIVE = sa.text('deleted_at IS NULL')
+DELETED = sa.text('deleted_at IS NOT NULL')
+
+
+def upgrade():
+    for table in ('actors', 'movies'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+        # reads only scan the rows which are not soft-deleted, the purge
+        # only the ones which are
+        op.create_index(f'ix_{table}_live_id', table, ['id'], unique=False,
+                        postgresql_where=LIVE, sqlite_where=LIVE)
+        op.create_index(f'ix_{table}_deleted_at', table, ['deleted_at'], unique=False,
+                        postgresql_where=DELETED, sqlite_where=DELETED)
+
+
+def downgrade():
+    for table in ('movies', 'actors'):
+        op.drop_index(f'ix_{table}_deleted_at', table_name=table)
+        op.drop_index(f'ix_{table}_live_id', table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('deleted_at')
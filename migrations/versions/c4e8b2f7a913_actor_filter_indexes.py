@@ -0,0 +1,26 @@
+"""indexes for the actor age and gender filters
+
+Revision ID: c4e8b2f7a913
+Revises: 9d3f6a1c2e47
+Create Date: 2026-10-18 13:05:44.218790
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8b2f7a913'
+down_revision = '9d3f6a1c2e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actors_age', 'actors', ['age'], unique=False)
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
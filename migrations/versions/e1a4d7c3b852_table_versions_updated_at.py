@@ -0,0 +1,45 @@
+"""table version counters and updated_at columns
+
+Revision ID: e1a4d7c3b852
+Revises: c4e8b2f7a913
+Create Date: 2026-10-18 14:21:09.637154
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1a4d7c3b852'
+down_revision = 'c4e8b2f7a913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': 'actors', 'version': 1},
+        {'name': 'movies', 'version': 1},
+        {'name': 'actor_movie', 'version': 1}
+    ])
+
+    # added as nullable, filled, then made NOT NULL so existing rows get a value
+    for table in ('actors', 'movies'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+        op.execute(f'UPDATE {table} SET updated_at = CURRENT_TIMESTAMP')
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('updated_at', existing_type=sa.DateTime(), nullable=False)
+
+
+def downgrade():
+    for table in ('movies', 'actors'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+
+    op.drop_table('table_versions')
@@ -1,8 +1,280 @@
-from sqlalchemy import Integer, String, Boolean, DateTime, ARRAY, Column, ForeignKey
-from flask_sqlalchemy import SQLAlchemy
+import json
+import time
+import base64
+import binascii
+import sqlite3
+import operator
+import threading
+from datetime import datetime
+
+from sqlalchemy import Integer, String, Boolean, DateTime, ARRAY, Column, ForeignKey, func, literal_column, select, and_, or_
+from sqlalchemy import orm, text, event, delete, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
 
-db = SQLAlchemy()
+from search import PrefixIndex, tokenize
+
+
+## Read replicas
+'''
+ReplicaRouter
+Hands out the replica binds in round-robin order, skipping the ones whose
+last health check failed. Health checks run at most once per
+health_check_interval seconds per replica.
+'''
+class ReplicaRouter:
+    def __init__(self):
+        self.configure([])
+
+    def configure(self, binds, sticky_seconds=0, health_check_interval=10):
+        self.binds = list(binds)
+        self.sticky_seconds = sticky_seconds
+        self.health_check_interval = health_check_interval
+        self.health = {}
+        self.reads = dict.fromkeys(self.binds, 0)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def healthy(self, bind):
+        '''
+        Returns whether the replica answered its latest health check,
+        running a new one if the previous result is too old
+        '''
+        now = time.monotonic()
+        checked = self.health.get(bind)
+        if checked is not None and now - checked[1] < self.health_check_interval:
+            return checked[0]
+
+        try:
+            with db.get_engine(db.get_app(), bind=bind).connect() as connection:
+                connection.execute(text("SELECT 1"))
+            ok = True
+        except SQLAlchemyError:
+            ok = False
+
+        self.health[bind] = (ok, now)
+        return ok
+
+    def choose(self):
+        '''
+        Returns the next healthy replica bind, or None to read from the primary
+        '''
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.binds), 1)
+
+        for i in range(len(self.binds)):
+            bind = self.binds[(start + i) % len(self.binds)]
+            if self.healthy(bind):
+                with self._lock:
+                    self.reads[bind] += 1
+                return bind
+
+        return None
+
+    def status(self):
+        return [{
+            "bind": bind,
+            "healthy": self.health.get(bind, (None,))[0],
+            "reads": self.reads[bind]
+        } for bind in self.binds]
+
+
+replica_router = ReplicaRouter()
+
+
+def use_replica():
+    '''
+    Routes the reads of the current request to a replica, if one is healthy
+    '''
+    g.read_replica = replica_router.choose()
+
+
+def use_primary():
+    '''
+    Sends the remaining reads of the current request to the primary
+    '''
+    g.read_replica = None
+
+
+'''
+RoutingSession
+Sends the statements of a request marked with use_replica to its replica.
+Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('read_replica') if has_request_context() else None
+        if replica is None or self._flushing or getattr(clause, 'is_dml', False):
+            return super().get_bind(mapper, clause)
+
+        return db.get_engine(self.app, bind=replica)
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def hide_deleted(execute_state):
+    '''
+    Adds deleted_at IS NULL to every ORM select of the models, including the
+    relationship loads it triggers, unless executed with include_deleted
+    '''
+    if (execute_state.is_select and not execute_state.is_column_load
+            and not execute_state.is_relationship_load
+            and not execute_state.execution_options.get('include_deleted', False)):
+        execute_state.statement = execute_state.statement.options(
+            orm.with_loader_criteria(QueryMixin, lambda cls: cls.deleted_at.is_(None), include_aliases=True))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+# Callables run with the model class after records of that model changed
+change_listeners = []
+
+
+def notify_change(model):
+    '''
+    Tells the change listeners (e.g. search indexes and caches) that records
+    of model were inserted, updated or deleted
+    '''
+    for listener in change_listeners:
+        listener(model)
+
+
+# Callables run with the model class and primary key of a record after it
+# was updated or deleted. The insert, update, delete, add_actor and
+# remove_actor methods called with commit=False leave the commit and the
+# notifications to the caller, which batches several changes in one
+# transaction with commit_changes and notify_row_change.
+row_change_listeners = []
+
+
+def notify_row_change(model, id):
+    '''
+    Tells the row change listeners (e.g. the record cache) that the record
+    of model with primary key id was updated or deleted
+    '''
+    for listener in row_change_listeners:
+        listener(model, id)
+
+
+# Version counter of every table, bumped in the transaction of each change
+TableVersion = db.Table("table_versions",
+                        db.Column('name', db.String(50), primary_key=True),
+                        db.Column('version', db.Integer, nullable=False, default=0)
+                    )
+
+
+def table_name(model):
+    '''
+    Returns the table name of a model class or of a Table such as ActorMovie
+    '''
+    return getattr(model, '__tablename__', None) or model.name
+
+
+def bump_versions(*models):
+    '''
+    Increments the version counters of the tables of models in the current
+    transaction. The rows are updated in table name order, so concurrent
+    writers lock them in the same order whatever the order of models.
+    '''
+    for name in sorted({table_name(model) for model in models}):
+        result = db.session.execute(TableVersion.update()
+                                    .where(TableVersion.c.name == name)
+                                    .values(version=TableVersion.c.version + 1))
+        if result.rowcount == 0:
+            db.session.execute(TableVersion.insert().values(name=name, version=1))
+
+
+def table_versions(*models):
+    '''
+    Returns {table name: version} for the tables of models with a single primary key lookup
+    '''
+    names = [table_name(model) for model in models]
+    versions = dict.fromkeys(names, 0)
+    versions.update(db.session.execute(
+        select(TableVersion.c.name, TableVersion.c.version).where(TableVersion.c.name.in_(names))).all())
+    return versions
+
+
+def commit_changes(*models):
+    '''
+    Bumps the table versions of models, commits the session and then tells
+    the change listeners
+    '''
+    bump_versions(*models)
+    db.session.commit()
+    for model in models:
+        notify_change(model)
+
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    '''
+    SQLite only enforces foreign keys, and so the ondelete cascade of
+    actor_movie, when asked to on each connection
+    '''
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    QueuePool which records how long checkouts wait for a connection and
+    how many of them gave up after pool_timeout
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+
+def pool_status(pool):
+    '''
+    Returns the occupancy and wait statistics of an engine's pool
+    '''
+    status = {"class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+            "max_overflow": pool._max_overflow,
+            "timeout": pool.timeout()
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update({
+            "checkouts": pool.checkouts,
+            "timeouts": pool.timeouts,
+            "wait_time": round(pool.wait_time, 6),
+            "max_wait": round(pool.max_wait, 6)
+        })
+    return status
 
 
 def setup_db(app):
@@ -10,27 +282,424 @@ def setup_db(app):
     Connect to the database by reading database settings from the config file
     '''
     app.config.from_object('config')
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    if 'pool_size' in options:
+        options.setdefault('poolclass', InstrumentedQueuePool)
+
+    # replicas are registered as binds so they share the engine options
+    replicas = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    if replicas:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for i, uri in enumerate(replicas):
+            binds['replica_{}'.format(i)] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+    replica_router.configure(['replica_{}'.format(i) for i in range(len(replicas))],
+                             app.config.get('REPLICA_STICKY_SECONDS', 0),
+                             app.config.get('REPLICA_HEALTH_CHECK_INTERVAL', 10))
     db.app = app
     db.init_app(app)
     migrate = Migrate(app, db)
     return db
 
+# Conditions of the partial indexes on the rows which are not, or are, soft-deleted
+LIVE = text('deleted_at IS NULL')
+DELETED = text('deleted_at IS NOT NULL')
+
+
+def soft_delete():
+    '''
+    True when deletes only set deleted_at, leaving the rows to purge_deleted
+    '''
+    return db.get_app().config.get('SOFT_DELETE', False)
+
+# Comparison operators of the field[op]=value list filters
+FILTER_OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le
+}
+
+
+def keyset_condition(order, values):
+    '''
+    Returns the condition selecting the rows after values in the given
+    (column, descending) order: (a, b) > (x, y) is a > x OR (a = x AND b > y)
+    '''
+    clauses = []
+    for i, (column, descending) in enumerate(order):
+        after = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*[order[j][0] == values[j] for j in range(i)], after))
+    return or_(*clauses)
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class QueryMixin:
+    '''
+    Listing helpers shared by the Actor and Movie models
+    '''
+
+    # field name -> function converting a query string value, for the filters
+    filter_fields = {}
+    # fields the listings can be sorted by
+    sort_fields = ('id',)
+    # fields of format(), which the fields parameter can select from
+    public_fields = ('id',)
+
+    # set by a soft delete, the row is hidden from every read until purged
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def filtered_query(cls, filters=(), options=()):
+        '''
+        Returns a query of the records matching every (field, operator, value) filter
+        '''
+        query = cls.query.options(*options)
+        for field, op, value in filters:
+            query = query.filter(FILTER_OPERATORS[op](getattr(cls, field), value))
+        return query
+
+    @classmethod
+    def ordering(cls, sort=()):
+        '''
+        Returns the (column, descending) pairs of a sort. An explicit id keeps
+        its position and direction and ends the ordering, since it is unique;
+        otherwise id is appended as the tie-breaker, in the direction of the
+        first field.
+        '''
+        order = []
+        for field, descending in sort:
+            order.append((getattr(cls, field), descending))
+            if field == 'id':
+                return order
+
+        order.append((cls.id, order[0][1] if order else False))
+        return order
+
+    @classmethod
+    def cursor_fields(cls, sort=()):
+        '''
+        Returns the fields besides id, in ordering order, whose values a
+        cursor holds before the id
+        '''
+        fields = []
+        for field, descending in sort:
+            if field == 'id':
+                break
+            fields.append(field)
+        return fields
+
+    @classmethod
+    def parse_cursor(cls, cursor, sort=()):
+        '''
+        Returns the keyset values encoded in a cursor or raises ValueError.
+        Listings ordered by id use the id itself as cursor.
+        '''
+        fields = cls.cursor_fields(sort)
+        if not fields:
+            return [int(cursor)]
+
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode() + b'=' * (-len(cursor) % 4)))
+        except (TypeError, ValueError, binascii.Error):
+            raise ValueError('invalid cursor')
+
+        if not isinstance(values, list) or len(values) != len(fields) + 1:
+            raise ValueError('invalid cursor')
+
+        return [cls.filter_fields[field](value) for field, value in zip(fields, values)] + [int(values[-1])]
+
+    @classmethod
+    def make_cursor(cls, record, sort=()):
+        fields = cls.cursor_fields(sort)
+        if not fields:
+            return record.id
+
+        values = [str(getattr(record, field)) for field in fields] + [record.id]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+    @classmethod
+    def page(cls, limit, after=None, offset=None, options=(), filters=(), sort=(), fields=None):
+        '''
+        Returns one page of records and the cursor of the next page
+
+            Parameters:
+                limit (int): maximum number of records on the page
+                after (list): keyset values from parse_cursor, only records after them are returned
+                offset (int): number of records to skip, used when no cursor is given
+                options (list): loader options, e.g. selectinload of a relationship
+                filters (list): (field, operator, value) filters
+                sort (list): (field, descending) pairs, ordered by id when empty
+                fields (list): when given, only these columns are selected and
+                    the records are result tuples starting with them instead of
+                    ORM objects
+
+            Returns:
+                records (list): the records on the page
+                next_cursor: cursor to pass as after for the next page, None on the last page
+        '''
+        if fields is not None:
+            records = db.session.execute(cls.projection(limit, after, offset, filters, sort, fields)).all()
+            return cls.paginate(records, limit, sort)
+
+        order = cls.ordering(sort)
+        query = cls.filtered_query(filters, options).order_by(
+            *[column.desc() if descending else column for column, descending in order])
+
+        if after is not None:
+            query = query.filter(keyset_condition(order, after))
+        elif offset:
+            query = query.offset(offset)
+
+        return cls.paginate(query.limit(limit + 1).all(), limit, sort)
+
+    @classmethod
+    def projection(cls, limit, after=None, offset=None, filters=(), sort=(), fields=()):
+        '''
+        Returns the select of one page of the fields columns, followed by the
+        id and sort columns the cursor of the next page is read from. It
+        selects limit + 1 rows, which paginate trims.
+        '''
+        extra = [field for field, descending in sort if field not in fields]
+        if 'id' not in fields:
+            extra.append('id')
+
+        order = cls.ordering(sort)
+        statement = select(*[getattr(cls, field) for field in list(fields) + extra])
+        for field, op, value in filters:
+            statement = statement.where(FILTER_OPERATORS[op](getattr(cls, field), value))
+        statement = statement.order_by(*[column.desc() if descending else column for column, descending in order])
+
+        if after is not None:
+            statement = statement.where(keyset_condition(order, after))
+        elif offset:
+            statement = statement.offset(offset)
+
+        return statement.limit(limit + 1)
+
+    @classmethod
+    def paginate(cls, records, limit, sort=()):
+        '''
+        Trims the limit + 1 records read for a page and returns them with the
+        cursor of the next page, None on the last page
+        '''
+        next_cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_cursor = cls.make_cursor(records[-1], sort)
+
+        return records, next_cursor
+
+    @classmethod
+    def find(cls, id, options=()):
+        '''
+        Returns the record with primary key id, from the session's identity
+        map when it is already loaded, or None when there is no such record
+        or it was soft-deleted
+        '''
+        record = db.session.get(cls, id, options=options)
+        if record is None or record.deleted_at is not None:
+            return None
+        return record
+
+    @classmethod
+    def get_many(cls, ids, options=(), fields=None):
+        '''
+        Returns the records with the given ids, read with a single IN query
+
+            Parameters:
+                ids (list): primary keys, without duplicates
+                options (list): loader options, e.g. selectinload of a relationship
+                fields (list): when given, only these columns are selected and
+                    the records are result tuples starting with them instead of
+                    ORM objects
+
+            Returns:
+                records (list): the records found, in the order of ids
+                missing (list): the ids without a record
+        '''
+        if fields is not None:
+            columns = list(fields) if 'id' in fields else list(fields) + ['id']
+            rows = db.session.execute(select(*[getattr(cls, field) for field in columns])
+                                      .where(cls.id.in_(ids))).all()
+            by_id = {row.id: row for row in rows}
+        else:
+            by_id = {record.id: record for record in cls.query.options(*options).filter(cls.id.in_(ids))}
+
+        records = [by_id[id] for id in ids if id in by_id]
+        missing = [id for id in ids if id not in by_id]
+        return records, missing
+
+    @classmethod
+    def bulk_insert(cls, rows):
+        '''
+        Inserts a batch of validated rows with a single executemany and one commit
+        '''
+        db.session.execute(cls.__table__.insert(), rows)
+        commit_changes(cls)
+
+    @classmethod
+    def bulk_delete(cls, ids=None, filters=(), chunk_size=1000):
+        '''
+        Deletes records with set-based DELETE statements in one transaction.
+        Their castings are removed by the ondelete cascade of actor_movie.
+        With SOFT_DELETE the statements set deleted_at instead.
+
+            Parameters:
+                ids (list): primary keys of the records to delete
+                filters (list): (field, operator, value) filters selecting
+                    the records to delete when no ids are given
+                chunk_size (int): most ids bound to one DELETE statement
+
+            Returns:
+                deleted (int): number of records deleted
+        '''
+        if ids is None:
+            ids = [id for id, in cls.filtered_query(filters).with_entities(cls.id)]
+
+        soft = soft_delete()
+        deleted = 0
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            if soft:
+                statement = (update(cls).where(cls.id.in_(chunk), cls.deleted_at.is_(None))
+                             .values(deleted_at=datetime.utcnow()))
+            else:
+                statement = delete(cls).where(cls.id.in_(chunk))
+            deleted += db.session.execute(statement.execution_options(synchronize_session=False)).rowcount
+
+        if not deleted:
+            db.session.rollback()
+            return 0
+
+        commit_changes(*((cls,) if soft else (cls, ActorMovie)))
+        for id in ids:
+            notify_row_change(cls, id)
+
+        return deleted
+
+    @classmethod
+    def purge_deleted(cls, batch_size, before=None):
+        '''
+        Hard-deletes one batch of the soft-deleted records, those deleted
+        before the given datetime if any, in its own short transaction.
+        Their castings are removed by the ondelete cascade of actor_movie.
+        Returns the number of records deleted.
+        '''
+        query = select(cls.id).where(cls.deleted_at.isnot(None))
+        if before is not None:
+            query = query.where(cls.deleted_at < before)
+        ids = db.session.execute(query.order_by(cls.deleted_at).limit(batch_size)
+                                 .execution_options(include_deleted=True)).scalars().all()
+
+        if not ids:
+            db.session.rollback()
+            return 0
+
+        deleted = db.session.execute(delete(cls).where(cls.id.in_(ids), cls.deleted_at.isnot(None))
+                                     .execution_options(synchronize_session=False)).rowcount
+        # the rows were already hidden, so no version or cache changes
+        db.session.commit()
+        return deleted
+
+    @classmethod
+    def search(cls, q, limit, offset=0, options=(), filters=()):
+        '''
+        Returns one page of the records whose search field matches q, best
+        matches first, and the offset of the next page
+
+            Parameters:
+                q (str): words to search, each matched as a word prefix
+                limit (int): maximum number of records on the page
+                offset (int): number of matches to skip
+                options (list): loader options, e.g. selectinload of a relationship
+                filters (list): (field, operator, value) filters
+
+            Returns:
+                records (list): the matching records on the page
+                next_offset (int): offset of the next page, None on the last page
+        '''
+        if db.engine.dialect.name == 'postgresql':
+            records = cls._search_postgresql(q, limit + 1, offset, options, filters)
+        else:
+            ids = cls._prefix_index().search(q)
+            if filters:
+                allowed = {id for id, in cls.filtered_query(filters).with_entities(cls.id)}
+                ids = [id for id in ids if id in allowed]
+            ids = ids[offset:offset + limit + 1]
+            by_id = {record.id: record for record in cls.query.options(*options).filter(cls.id.in_(ids))}
+            records = [by_id[id] for id in ids if id in by_id]
+
+        next_offset = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_offset = offset + limit
+
+        return records, next_offset
+
+    @classmethod
+    def _search_postgresql(cls, q, limit, offset, options, filters):
+        '''
+        Ranks the matches of the tsvector and trigram indexes of migration 9d3f6a1c2e47
+        '''
+        words = tokenize(q)
+        if not words:
+            return []
+
+        column = getattr(cls, cls.search_field)
+        vector = func.to_tsvector(literal_column("'simple'"), column)
+        query = func.to_tsquery(literal_column("'simple'"), ' & '.join(word + ':*' for word in words))
+        rank = func.ts_rank(vector, query) + func.similarity(column, q)
+
+        return (cls.filtered_query(filters, options)
+                .filter(or_(vector.op('@@')(query), column.op('%')(q)))
+                .order_by(rank.desc(), cls.id)
+                .offset(offset)
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def _prefix_index(cls):
+        index = cls.__dict__.get('_search_index')
+        if index is None:
+            column = getattr(cls, cls.search_field)
+            index = PrefixIndex(lambda: db.session.query(cls.id, column).all())
+            cls._search_index = index
+        return index
+
+
 ActorMovie = db.Table("actor_movie",
                         db.Column('id', db.Integer, primary_key=True),
                         db.Column('actor_id', db.Integer, db.ForeignKey('actors.id', ondelete='cascade')),
-                        db.Column('movie_id', db.Integer, db.ForeignKey('movies.id', ondelete='cascade'))
+                        db.Column('movie_id', db.Integer, db.ForeignKey('movies.id', ondelete='cascade')),
+                        db.Index('ix_actor_movie_movie_id_actor_id', 'movie_id', 'actor_id', unique=True),
+                        db.Index('ix_actor_movie_actor_id_movie_id', 'actor_id', 'movie_id')
                     )
 
-class Actor(db.Model):
+class Actor(QueryMixin, db.Model):
     '''
     Model that defines an actor and his attributes
     '''
     __tablename__ = 'actors'
+    __table_args__ = (db.Index('ix_actors_gender_age', 'gender', 'age'),
+                      db.Index('ix_actors_live_id', 'id', postgresql_where=LIVE, sqlite_where=LIVE),
+                      db.Index('ix_actors_deleted_at', 'deleted_at', postgresql_where=DELETED, sqlite_where=DELETED))
+    search_field = 'name'
+    filter_fields = {'name': str, 'age': int, 'gender': str}
+    sort_fields = ('id', 'name', 'age')
+    public_fields = ('id', 'name', 'age', 'gender')
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), nullable=False)
-    age = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(120), nullable=False, index=True)
+    age = db.Column(db.Integer, nullable=False, index=True)
     gender = db.Column(db.String(20), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # movies =  db.relationship("Movie", secondary=ActorMovie, backref=db.backref("actors"))
 
@@ -39,16 +708,54 @@ class Actor(db.Model):
         self.age = age
         self.gender = gender
 
-    def insert(self):
+    @staticmethod
+    def parse(data):
+        '''
+        Returns the column values of an actor from request data or raises ValueError
+        '''
+        if not isinstance(data, dict):
+            raise ValueError('actor must be an object')
+
+        name = data.get('name')
+        if not isinstance(name, str) or not name.strip() or len(name) > 120:
+            raise ValueError('name must be a non-empty string of at most 120 characters')
+
+        age = data.get('age')
+        # bool is an int subclass, so true would otherwise be stored as 1
+        if type(age) is not int:
+            raise ValueError('age must be an integer')
+        if age < 0:
+            raise ValueError('age must not be negative')
+
+        gender = data.get('gender')
+        if not isinstance(gender, str) or not gender.strip() or len(gender) > 20:
+            raise ValueError('gender must be a non-empty string of at most 20 characters')
+
+        return {'name': name, 'age': age, 'gender': gender}
+
+    def insert(self, commit=True):
         db.session.add(self)
-        db.session.commit()
+        if commit:
+            commit_changes(type(self))
 
-    def update(self):
-        db.session.commit()
+    def update(self, commit=True):
+        if commit:
+            # read before the commit expires the attributes
+            id = self.id
+            commit_changes(type(self))
+            notify_row_change(type(self), id)
 
-    def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+    def delete(self, commit=True):
+        id = self.id
+        if soft_delete():
+            self.deleted_at = datetime.utcnow()
+            tables = (type(self),)
+        else:
+            db.session.delete(self)
+            tables = (type(self), ActorMovie)
+        if commit:
+            commit_changes(*tables)
+            notify_row_change(type(self), id)
 
     def format(self):
         return {
@@ -58,36 +765,87 @@ class Actor(db.Model):
         'gender': self.gender
         }
 
+    def format_movies(self):
+        '''
+        Formats the actor with its filmography. Load the movies relationship
+        eagerly (selectinload) when formatting many actors.
+        '''
+        data = self.format()
+        data['movies'] = [movie.format() for movie in self.movies]
+        return data
+
     def __repr__(self):
         return f'<Actor ID: {self.id}, Actor Name: {self.name}>'
 
 
-class Movie(db.Model):
+class Movie(QueryMixin, db.Model):
     '''
     Model that defines a movie and its attributes
     '''
     __tablename__ = 'movies'
+    __table_args__ = (db.Index('ix_movies_live_id', 'id', postgresql_where=LIVE, sqlite_where=LIVE),
+                      db.Index('ix_movies_deleted_at', 'deleted_at', postgresql_where=DELETED, sqlite_where=DELETED))
+    search_field = 'title'
+    filter_fields = {'title': str, 'release_date': parse_date}
+    sort_fields = ('id', 'title', 'release_date')
+    public_fields = ('id', 'title', 'release_date')
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(500), nullable=False)
-    release_date = db.Column(db.Date, nullable=False)
+    release_date = db.Column(db.Date, nullable=False, index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    actors = db.relationship("Actor", secondary=ActorMovie, backref=db.backref("movies"))
+    # castings are deleted by the ondelete cascade of actor_movie, without
+    # loading them first
+    actors = db.relationship("Actor", secondary=ActorMovie, passive_deletes=True,
+                             backref=db.backref("movies", passive_deletes=True))
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
-    def insert(self):
+    @staticmethod
+    def parse(data):
+        '''
+        Returns the column values of a movie from request data or raises ValueError
+        '''
+        if not isinstance(data, dict):
+            raise ValueError('movie must be an object')
+
+        title = data.get('title')
+        if not isinstance(title, str) or not title.strip() or len(title) > 500:
+            raise ValueError('title must be a non-empty string of at most 500 characters')
+
+        try:
+            release_date = parse_date(data.get('release_date'))
+        except (TypeError, ValueError):
+            raise ValueError('release_date must be a date formatted as YYYY-MM-DD')
+
+        return {'title': title, 'release_date': release_date}
+
+    def insert(self, commit=True):
         db.session.add(self)
-        db.session.commit()
+        if commit:
+            commit_changes(type(self))
 
-    def update(self):
-        db.session.commit()
+    def update(self, commit=True):
+        if commit:
+            # read before the commit expires the attributes
+            id = self.id
+            commit_changes(type(self))
+            notify_row_change(type(self), id)
 
-    def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+    def delete(self, commit=True):
+        id = self.id
+        if soft_delete():
+            self.deleted_at = datetime.utcnow()
+            tables = (type(self),)
+        else:
+            db.session.delete(self)
+            tables = (type(self), ActorMovie)
+        if commit:
+            commit_changes(*tables)
+            notify_row_change(type(self), id)
 
     def format(self):
         return {
@@ -96,10 +854,56 @@ class Movie(db.Model):
         'release_date': self.release_date
         }
 
+    def format_actors(self):
+        '''
+        Formats the movie with its cast. Load the actors relationship
+        eagerly (selectinload) when formatting many movies.
+        '''
+        data = self.format()
+        data['actors'] = [actor.format() for actor in self.actors]
+        return data
+
+    def add_actor(self, actor, commit=True):
+        self.actors.append(actor)
+        if commit:
+            commit_changes(ActorMovie)
+
+    def remove_actor(self, actor, commit=True):
+        self.actors.remove(actor)
+        if commit:
+            commit_changes(ActorMovie)
+
     def __repr__(self):
         return f'<Movie ID: {self.id}, Movie Title: {self.title}>'
 
 
+def purge_deleted(models, batch_size=500, before=None, pause=0.1, sleep=time.sleep):
+    '''
+    Hard-deletes every soft-deleted record of models in batches of
+    batch_size, sleeping pause seconds between batches so the purge does
+    not hold locks or saturate the database for long. Returns
+    {table name: records deleted}.
+    '''
+    purged = {}
+    for model in models:
+        purged[table_name(model)] = 0
+        while True:
+            deleted = model.purge_deleted(batch_size, before)
+            purged[table_name(model)] += deleted
+            if deleted < batch_size:
+                break
+            sleep(pause)
+    return purged
+
+
+def invalidate_search_index(model):
+    index = getattr(model, '_search_index', None)
+    if index is not None:
+        index.invalidate()
+
+change_listeners.append(invalidate_search_index)
+
+
 # class ActorMovie(db.Model):
 #     '''
 #     Helper association model for many-to-many relationships
@@ -0,0 +1,145 @@
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    '''
+    Raised by QueryProfiler.profile when more queries ran than its budget allows
+    '''
+
+
+class RequestProfile:
+    '''
+    The statements executed while a profile was active, with their durations
+    '''
+
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.queries = []
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(duration for statement, duration in self.queries)
+
+    def duplicates(self):
+        '''
+        Returns {statement: executions} of the statements executed more than
+        once, most repeated first. A statement repeated once per row of a
+        listing is the signature of an N+1 query.
+        '''
+        counts = Counter(statement for statement, duration in self.queries)
+        return {statement: count for statement, count in counts.most_common() if count > 1}
+
+    def slowest(self, n=3):
+        return sorted(self.queries, key=lambda query: query[1], reverse=True)[:n]
+
+    def report(self):
+        lines = ['{} queries in {:.1f} ms'.format(self.count, self.total_time * 1000)]
+        for statement, count in self.duplicates().items():
+            lines.append('  {}x {}'.format(count, ' '.join(statement.split())))
+        return '\n'.join(lines)
+
+
+class QueryProfiler:
+    '''
+    Opt-in profiler of the SQL executed per request, built on the engine's
+    cursor events. While enabled it logs the slowest queries, statements
+    repeated n_plus_one_threshold times or more and the endpoints which ran
+    more queries than their budget, which are also kept in violations.
+    '''
+
+    def __init__(self, budgets=None, slow_query_ms=100, n_plus_one_threshold=5, enabled=False):
+        self.budgets = dict(budgets or {})
+        self.slow_query_ms = slow_query_ms
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.enabled = enabled
+        self.violations = []
+        self._local = threading.local()
+
+    def _active(self):
+        profiles = getattr(self._local, 'profiles', None)
+        if profiles is None:
+            profiles = self._local.profiles = []
+        return profiles
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._active():
+            conn.info['profiler_start'] = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profiles = self._active()
+        start = conn.info.pop('profiler_start', None)
+        if profiles and start is not None:
+            duration = time.perf_counter() - start
+            for profile in profiles:
+                profile.queries.append((statement, duration))
+
+    def start(self, endpoint=None):
+        profile = RequestProfile(endpoint)
+        self._active().append(profile)
+        return profile
+
+    def stop(self, profile):
+        profiles = self._active()
+        if profile in profiles:
+            profiles.remove(profile)
+        return profile
+
+    @contextmanager
+    def profile(self, budget=None):
+        '''
+        Records the queries of the with block, raising QueryBudgetExceeded
+        when more than budget ran
+        '''
+        profile = self.start()
+        try:
+            yield profile
+        finally:
+            self.stop(profile)
+
+        if budget is not None and profile.count > budget:
+            raise QueryBudgetExceeded('expected at most {} queries, got {}'.format(budget, profile.report()))
+
+    def start_request(self):
+        if self.enabled:
+            self._local.request = self.start()
+
+    def finish_request(self, endpoint):
+        '''
+        Stops the profile of the current request, logs what it found and
+        returns it, or None when the profiler is disabled
+        '''
+        profile = getattr(self._local, 'request', None)
+        if profile is None:
+            return None
+
+        self._local.request = None
+        self.stop(profile)
+        profile.endpoint = endpoint
+
+        logger.debug('%s: %s', endpoint, profile.report())
+
+        for statement, duration in profile.slowest():
+            if duration * 1000 >= self.slow_query_ms:
+                logger.warning('%s: slow query (%.1f ms): %s', endpoint, duration * 1000, ' '.join(statement.split()))
+
+        for statement, count in profile.duplicates().items():
+            if count >= self.n_plus_one_threshold:
+                logger.warning('%s: possible N+1, statement executed %d times: %s',
+                               endpoint, count, ' '.join(statement.split()))
+
+        budget = self.budgets.get(endpoint)
+        if budget is not None and profile.count > budget:
+            self.violations.append((endpoint, budget, profile))
+            logger.warning('%s: query budget of %d exceeded, %s', endpoint, budget, profile.report())
+
+        return profile
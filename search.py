@@ -0,0 +1,86 @@
+import re
+import bisect
+import threading
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    '''
+    Splits text into lower-case word tokens
+    '''
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class PrefixIndex:
+    '''
+    In-process prefix index over one text column, used to search when the
+    database has no full-text support (SQLite). It is built lazily from
+    (id, text) rows and rebuilt after invalidate() is called.
+    '''
+
+    def __init__(self, load_rows):
+        self.load_rows = load_rows
+        self.tokens = []
+        self.texts = {}
+        self.stale = True
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self.stale = True
+
+    def build(self):
+        tokens = []
+        texts = {}
+        for id, text in self.load_rows():
+            texts[id] = text.lower()
+            tokens.extend((token, id) for token in set(tokenize(text)))
+        tokens.sort()
+
+        self.tokens = tokens
+        self.texts = texts
+        self.stale = False
+
+    def prefix_ids(self, prefix):
+        '''
+        Returns the ids of the rows with a token starting with prefix
+        '''
+        start = bisect.bisect_left(self.tokens, (prefix,))
+        ids = set()
+        for token, id in self.tokens[start:]:
+            if not token.startswith(prefix):
+                break
+            ids.add(id)
+        return ids
+
+    def search(self, q):
+        '''
+        Returns the ids of the rows matching every word of q as a prefix,
+        best matches first: whole text starting with q, then the number of
+        words matched exactly, then id
+        '''
+        words = tokenize(q)
+        if not words:
+            return []
+
+        with self._lock:
+            if self.stale:
+                self.build()
+
+            ids = None
+            for word in words:
+                matches = self.prefix_ids(word)
+                ids = matches if ids is None else ids & matches
+                if not ids:
+                    return []
+
+            texts = self.texts
+
+        q = q.strip().lower()
+
+        def rank(id):
+            text_tokens = set(tokenize(texts[id]))
+            exact = sum(1 for word in words if word in text_tokens)
+            return (not texts[id].startswith(q), -exact, id)
+
+        return sorted(ids, key=rank)
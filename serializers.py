@@ -0,0 +1,53 @@
+import json
+from datetime import date, datetime
+
+from flask import Response
+
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_MIMETYPE = 'application/json'
+
+
+def default(value):
+    '''
+    Serializes the values the JSON encoder does not know natively
+    '''
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(data):
+    '''
+    Returns data encoded as JSON bytes, with dates in ISO 8601 format.
+    orjson is used when it is installed, the standard library otherwise.
+    '''
+    if orjson is not None:
+        return orjson.dumps(data, default=default)
+    return json.dumps(data, default=default, separators=(',', ':')).encode()
+
+
+def rows_to_dicts(keys, rows):
+    '''
+    Turns result tuples into dicts without building ORM objects
+    '''
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def json_response(data, status=200, etag=None):
+    '''
+    Returns data as an application/json response, optionally tagged with an ETag
+    '''
+    with metrics.timed('serialize'):
+        body = dumps(data)
+    response = Response(body, status=status, mimetype=JSON_MIMETYPE)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
@@ -1,10 +1,38 @@
 import os
+import time
+import asyncio
+import datetime
+import fnmatch
 import unittest
 import json
 import random
+import tempfile
+import threading
+from unittest import mock
+import rsa
+from jose import jwt, jwk
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
+
+# the tests run in a single process, where the per-process lru caches are safe
+os.environ.setdefault('RESPONSE_CACHE_BACKEND', 'lru')
+
+import auth
+import app as app_module
 from app import app
-from models import setup_db, Actor, Movie
+from cache import ResponseCache, RowCache, LRUBackend, RedisBackend, create_backend
+import serializers
+import metrics
+from profiler import QueryBudgetExceeded
+from models import setup_db, replica_router, purge_deleted, InstrumentedQueuePool, Actor, Movie, ActorMovie
+
+try:
+    import aiosqlite
+    import asgi
+except ImportError:
+    # the async entry point needs requirements-asgi.txt
+    asgi = None
 
 # Get JWTs stored in environment variables
 assistant = os.getenv('ASSISTANT')
@@ -12,6 +40,41 @@ director = os.getenv('DIRECTOR')
 producer = os.getenv('PRODUCER')
 
 
+class LocalSigner:
+    '''
+    Signs tokens with a locally generated RSA key and publishes the matching
+    key set as a JWKS file, standing in for the Auth0 tenant
+    '''
+    _private_key = None
+
+    def __init__(self, kid='local-test-key'):
+        if LocalSigner._private_key is None:
+            LocalSigner._private_key = rsa.newkeys(2048)[1].save_pkcs1().decode()
+
+        self.kid = kid
+        self.private_key = LocalSigner._private_key
+
+        public_key = jwk.construct(self.private_key, 'RS256').public_key().to_dict()
+        public_key.update({'kid': kid, 'use': 'sig'})
+
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        json.dump({'keys': [public_key]}, self.jwks_file)
+        self.jwks_file.close()
+
+    def token(self, permissions, expires_in=3600, **claims):
+        claims.setdefault('sub', 'local|tester')
+        claims.update({
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'aud': auth.API_AUDIENCE,
+            'exp': int(time.time()) + expires_in,
+            'permissions': list(permissions)
+        })
+        return jwt.encode(claims, self.private_key, algorithm='RS256', headers={'kid': self.kid})
+
+    def cleanup(self):
+        os.unlink(self.jwks_file.name)
+
+
 class CastingAgencyTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -537,6 +600,1785 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['code'], 'authorization_header_missing')
 
 
+ASSISTANT_PERMISSIONS = ['view:actor', 'view:movie']
+DIRECTOR_PERMISSIONS = ASSISTANT_PERMISSIONS + ['post:actor', 'delete:actor', 'patch:actor', 'patch:movie']
+PRODUCER_PERMISSIONS = DIRECTOR_PERMISSIONS + ['post:movie', 'delete:movie']
+
+
+class LocalAuthTestCase(unittest.TestCase):
+    '''
+    Base test case which authenticates with locally signed tokens
+    '''
+
+    def setUp(self):
+        self.app = app
+        self.client = self.app.test_client
+        self.db = setup_db(self.app)
+        self.db.create_all()
+
+        # every request made by these tests must stay within QUERY_BUDGETS
+        app_module.profiler.enabled = True
+        app_module.profiler.violations.clear()
+
+        self.signer = LocalSigner()
+        self.original_store = auth.jwks_store
+        auth.jwks_store = auth.JWKSKeyStore(path=self.signer.jwks_file.name)
+
+        self.assistant = self.signer.token(ASSISTANT_PERMISSIONS)
+        self.director = self.signer.token(DIRECTOR_PERMISSIONS)
+        self.producer = self.signer.token(PRODUCER_PERMISSIONS)
+
+    def tearDown(self):
+        auth.jwks_store = self.original_store
+        self.signer.cleanup()
+        app_module.profiler.enabled = False
+
+        violations = ['{} ran more than {} queries: {}'.format(endpoint, budget, profile.report())
+                      for endpoint, budget, profile in app_module.profiler.violations]
+        self.assertEqual(violations, [])
+
+    def headers(self, token):
+        return {"Authorization": "Bearer {}".format(token)}
+
+
+class PaginationTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            Actor(name="Page Actor {}".format(i), age=30 + i, gender="Female").insert()
+
+    def test_keyset_pages_cover_all_actors(self):
+        ids = [actor.id for actor in Actor.query.order_by(Actor.id).all()]
+
+        seen = []
+        url = '/actors?limit=2'
+        while True:
+            res = self.client().get(url, headers=self.headers(self.assistant))
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertLessEqual(len(data['actors']), 2)
+            seen.extend(actor['id'] for actor in data['actors'])
+
+            if data['next_cursor'] is None:
+                break
+            url = '/actors?limit=2&after={}'.format(data['next_cursor'])
+
+        self.assertEqual(seen, ids)
+
+    def test_offset_fallback(self):
+        ids = [actor.id for actor in Actor.query.order_by(Actor.id).all()]
+
+        res = self.client().get('/actors?limit=2&offset=1', headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual([actor['id'] for actor in data['actors']], ids[1:3])
+
+    def test_page_size_is_capped(self):
+        app.config['MAX_PAGE_SIZE'], max_page_size = 3, app.config['MAX_PAGE_SIZE']
+        try:
+            res = self.client().get('/actors?limit=1000', headers=self.headers(self.assistant))
+        finally:
+            app.config['MAX_PAGE_SIZE'] = max_page_size
+        data = json.loads(res.data)
+
+        self.assertEqual(len(data['actors']), 3)
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_invalid_limit_400_error(self):
+        res = self.client().get('/movies?limit=abc', headers=self.headers(self.assistant))
+
+        self.assertEqual(res.status_code, 400)
+
+
+class MinimalResponseTestCase(LocalAuthTestCase):
+
+    def test_post_actor_return_minimal(self):
+        res = self.client().post('/actors', headers=dict(self.headers(self.director), Prefer='return=minimal'), json={
+                                          "name": "Minimal Actor",
+                                          "gender": "Female",
+                                          "age": 41
+                                      })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('actors', data)
+        self.assertEqual(data['actor']['name'], "Minimal Actor")
+        self.assertEqual(data['actor']['id'], data['id'])
+        self.assertIsNotNone(res.headers.get('ETag'))
+
+    def test_patch_movie_return_minimal_query_param(self):
+        movie = Movie(title="Minimal Movie", release_date=datetime.date(2001, 1, 1))
+        movie.insert()
+
+        res = self.client().patch('/movies/{}?return=minimal'.format(movie.id), headers=self.headers(self.producer), json={
+                                          "title": "Minimal Movie Patched",
+                                          "release_date": "2002-02-02"
+                                      })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('movies', data)
+        self.assertEqual(data['movie']['title'], "Minimal Movie Patched")
+
+    def test_conditional_get_actors(self):
+        last = Actor.query.order_by(Actor.id.desc()).first()
+        url = '/actors?after={}'.format(last.id if last else 0)
+
+        res = self.client().get(url, headers=self.headers(self.assistant))
+        etag = res.headers.get('ETag')
+
+        res = self.client().get(url, headers=dict(self.headers(self.assistant), **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        self.client().post('/actors?return=minimal', headers=self.headers(self.director), json={
+                                          "name": "Conditional Actor",
+                                          "gender": "Male",
+                                          "age": 33
+                                      })
+
+        res = self.client().get(url, headers=dict(self.headers(self.assistant), **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+
+
+class BulkImportTestCase(LocalAuthTestCase):
+
+    def test_bulk_import_actors_json(self):
+        num_actors = Actor.query.count()
+        rows = [{"name": "Bulk Actor {}".format(i), "age": 20 + i, "gender": "Male"} for i in range(7)]
+        rows.insert(3, {"name": "", "age": 20, "gender": "Male"})
+        rows.append({"name": "No Age", "gender": "Female"})
+
+        res = self.client().post('/actors/bulk?batch_size=3', headers=self.headers(self.director), json=rows)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 7)
+        self.assertEqual([error['row'] for error in data['errors']], [3, 8])
+        self.assertEqual(Actor.query.count(), num_actors + 7)
+
+    def test_bulk_import_rejects_non_integer_age(self):
+        num_actors = Actor.query.count()
+        rows = [{"name": "Bulk Age {}".format(i), "age": age, "gender": "Male"}
+                for i, age in enumerate((30, True, 30.7, "30"))]
+
+        res = self.client().post('/actors/bulk', headers=self.headers(self.director), json=rows)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual([(error['row'], error['error']) for error in data['errors']],
+                         [(row, 'age must be an integer') for row in (1, 2, 3)])
+        self.assertEqual(Actor.query.count(), num_actors + 1)
+
+    def test_bulk_import_movies_ndjson(self):
+        num_movies = Movie.query.count()
+        body = '\n'.join([
+            json.dumps({"title": "Bulk Movie 1", "release_date": "2001-01-01"}),
+            '{not json',
+            json.dumps({"title": "Bulk Movie 2", "release_date": "01/01/2001"}),
+            json.dumps({"title": "Bulk Movie 3", "release_date": "2003-03-03"}),
+        ])
+
+        res = self.client().post('/movies/bulk', headers=self.headers(self.producer),
+                                 data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual(Movie.query.count(), num_movies + 2)
+
+    def test_bulk_import_movies_by_director_401_error(self):
+        res = self.client().post('/movies/bulk', headers=self.headers(self.director), json=[])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['code'], 'invalid_permissions')
+
+    def test_bulk_import_400_error(self):
+        res = self.client().post('/actors/bulk', headers=self.headers(self.director), json={"name": "Not A List"})
+
+        self.assertEqual(res.status_code, 400)
+
+
+class ExportTestCase(LocalAuthTestCase):
+
+    def test_export_actors_ndjson(self):
+        Actor(name="Export Actor", age=50, gender="Male").insert()
+
+        res = self.client().get('/actors/export', headers=self.headers(self.assistant))
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), Actor.query.count())
+        self.assertIn("Export Actor", [row['name'] for row in rows])
+
+    def test_export_movies_csv(self):
+        Movie(title="Export Movie", release_date=datetime.date(1999, 9, 9)).insert()
+
+        res = self.client().get('/movies/export?format=csv', headers=self.headers(self.assistant))
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'title', 'release_date'])
+        self.assertEqual(len(lines), Movie.query.count() + 1)
+        self.assertTrue(any(',Export Movie,1999-09-09' in line for line in lines))
+
+    def test_export_castings_ndjson(self):
+        actor = Actor(name="Export Cast", age=40, gender="Female")
+        actor.insert()
+        movie = Movie(title="Export Cast Movie", release_date=datetime.date(2005, 5, 5))
+        movie.insert()
+        movie.add_actor(actor)
+        actor_id, movie_id = actor.id, movie.id
+
+        res = self.client().get('/castings/export', headers=self.headers(self.assistant))
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn({'actor_id': actor_id, 'movie_id': movie_id},
+                      [{'actor_id': row['actor_id'], 'movie_id': row['movie_id']} for row in rows])
+
+    def test_export_chunks(self):
+        from export import export_rows
+
+        for i in range(3):
+            Actor(name="Chunk Actor {}".format(i), age=20, gender="Male").insert()
+
+        with app.app_context():
+            chunks = list(export_rows('actors', 'ndjson', chunk_size=1))
+
+        self.assertEqual(len(chunks), Actor.query.count())
+
+    def test_export_unknown_format_400_error(self):
+        res = self.client().get('/castings/export?format=xml', headers=self.headers(self.assistant))
+
+        self.assertEqual(res.status_code, 400)
+
+
+class CastingTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.movie = Movie(title="Casting Movie", release_date=datetime.date(2015, 5, 5))
+        self.movie.insert()
+        self.actor = Actor(name="Casting Actor", age=40, gender="Female")
+        self.actor.insert()
+
+    def count_queries(self, callback):
+        with app_module.profiler.profile() as profile:
+            callback()
+        return profile.count
+
+    def test_add_and_remove_cast_member(self):
+        res = self.client().post('/movies/{}/actors'.format(self.movie.id), headers=self.headers(self.director),
+                                 json={"actor_id": self.actor.id})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['movie']['actors']], [self.actor.id])
+
+        res = self.client().get('/actors/{}/movies'.format(self.actor.id), headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+        self.assertEqual([movie['id'] for movie in data['actor']['movies']], [self.movie.id])
+
+        res = self.client().delete('/movies/{}/actors/{}'.format(self.movie.id, self.actor.id),
+                                   headers=self.headers(self.director))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['actors'], [])
+
+    def test_duplicate_cast_member_422_error(self):
+        url = '/movies/{}/actors'.format(self.movie.id)
+        self.client().post(url, headers=self.headers(self.director), json={"actor_id": self.actor.id})
+        res = self.client().post(url, headers=self.headers(self.director), json={"actor_id": self.actor.id})
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_duplicate_casting_rejected_by_database(self):
+        self.movie.add_actor(self.actor)
+
+        with self.assertRaises(IntegrityError):
+            self.db.session.execute(ActorMovie.insert().values(actor_id=self.actor.id, movie_id=self.movie.id))
+            self.db.session.commit()
+        self.db.session.rollback()
+
+    def test_add_cast_member_by_assistant_401_error(self):
+        res = self.client().post('/movies/{}/actors'.format(self.movie.id), headers=self.headers(self.assistant),
+                                 json={"actor_id": self.actor.id})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['code'], 'invalid_permissions')
+
+    def test_get_cast_404_error(self):
+        res = self.client().get('/movies/0/actors', headers=self.headers(self.assistant))
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_movies_with_cast_use_constant_queries(self):
+        for i in range(4):
+            movie = Movie(title="Cast Query Movie {}".format(i), release_date=datetime.date(2010, 1, 1))
+            movie.insert()
+            movie.add_actor(self.actor)
+
+        def get_movies(limit):
+            res = self.client().get('/movies?include=actors&limit={}'.format(limit), headers=self.headers(self.assistant))
+            self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(self.count_queries(lambda: get_movies(1)), self.count_queries(lambda: get_movies(50)))
+        # table versions for the ETag, the page of movies and their casts
+        self.assertLessEqual(self.count_queries(lambda: get_movies(50)), 3)
+
+
+class SearchTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tag = 'srch{}'.format(random.randint(0, 10 ** 9))
+        for title in ("{} Apollo", "Zeta {}", "{}ing Voyage", "Other Movie"):
+            Movie(title=title.format(self.tag), release_date=datetime.date(1995, 6, 30)).insert()
+
+    def test_search_movies_ranked_by_prefix(self):
+        res = self.client().get('/movies?q={}'.format(self.tag), headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+        titles = [movie['title'] for movie in data['movies']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(titles, ["{} Apollo".format(self.tag), "{}ing Voyage".format(self.tag), "Zeta {}".format(self.tag)])
+
+    def test_search_requires_every_word(self):
+        res = self.client().get('/movies?q={}+apo'.format(self.tag), headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual([movie['title'] for movie in data['movies']], ["{} Apollo".format(self.tag)])
+
+    def test_search_is_paginated(self):
+        res = self.client().get('/movies?q={}&limit=2'.format(self.tag), headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+        self.assertEqual(len(data['movies']), 2)
+        self.assertEqual(data['next_offset'], 2)
+
+        res = self.client().get('/movies?q={}&limit=2&offset=2'.format(self.tag), headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertIsNone(data['next_offset'])
+
+    def test_search_sees_new_and_changed_actors(self):
+        actor = Actor(name="{} Star".format(self.tag), age=30, gender="Female")
+        actor.insert()
+
+        res = self.client().get('/actors?q={}'.format(self.tag), headers=self.headers(self.assistant))
+        self.assertEqual([a['id'] for a in json.loads(res.data)['actors']], [actor.id])
+
+        self.client().patch('/actors/{}'.format(actor.id), headers=self.headers(self.director), json={
+                                          "name": "Renamed Star",
+                                          "gender": "Female",
+                                          "age": 30
+                                      })
+
+        res = self.client().get('/actors?q={}'.format(self.tag), headers=self.headers(self.assistant))
+        self.assertEqual(json.loads(res.data)['actors'], [])
+
+
+class FilterSortTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tag = 'flt{}'.format(random.randint(0, 10 ** 9))
+        self.movies = []
+        for i, release_date in enumerate(["2001-01-01", "2003-03-03", "2003-03-03", "2005-05-05"]):
+            movie = Movie(title="{} {}".format(self.tag, i), release_date=datetime.date.fromisoformat(release_date))
+            movie.insert()
+            self.movies.append(movie.id)
+
+    def get(self, url):
+        res = self.client().get(url, headers=self.headers(self.assistant))
+        return res, json.loads(res.data)
+
+    def test_filter_movies_by_release_date_range(self):
+        res, data = self.get('/movies?q={}&release_date[gte]=2002-01-01&release_date[lt]=2005-01-01'.format(self.tag))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(movie['id'] for movie in data['movies']), self.movies[1:3])
+
+    def test_filter_actors_by_age_and_gender(self):
+        young = Actor(name="{} Young".format(self.tag), age=7, gender="Other{}".format(self.tag[-6:]))
+        young.insert()
+        Actor(name="{} Old".format(self.tag), age=80, gender="Other{}".format(self.tag[-6:])).insert()
+
+        res, data = self.get('/actors?age[lt]=10&gender=Other{}'.format(self.tag[-6:]))
+
+        self.assertEqual([actor['name'] for actor in data['actors']], ["{} Young".format(self.tag)])
+
+    def pages(self, sort):
+        url = '/movies?title[gte]={0}&title[lt]={0}~&sort={1}&limit=1'.format(self.tag, sort)
+        seen = []
+        while True:
+            res, data = self.get(url)
+            self.assertEqual(res.status_code, 200)
+            seen.extend(movie['id'] for movie in data['movies'])
+            if data['next_cursor'] is None:
+                break
+            url = url.split('&after=')[0] + '&after={}'.format(data['next_cursor'])
+        return seen
+
+    def test_sort_with_keyset_pages(self):
+        self.assertEqual(self.pages('-release_date'), [self.movies[3], self.movies[2], self.movies[1], self.movies[0]])
+
+    def test_sort_by_id_descending(self):
+        self.assertEqual(self.pages('-id'), self.movies[::-1])
+        self.assertEqual(self.pages('-id,release_date'), self.movies[::-1])
+
+    def test_sort_with_explicit_id_direction(self):
+        self.assertEqual(self.pages('release_date,-id'), [self.movies[0], self.movies[2], self.movies[1], self.movies[3]])
+        self.assertEqual(self.pages('-release_date,id'), [self.movies[3], self.movies[1], self.movies[2], self.movies[0]])
+
+    def test_unknown_filter_400_error(self):
+        res, data = self.get('/movies?budget[gt]=10')
+        self.assertEqual(res.status_code, 400)
+
+    def test_unknown_operator_400_error(self):
+        res, data = self.get('/actors?age[like]=10')
+        self.assertEqual(res.status_code, 400)
+
+    def test_unsortable_field_400_error(self):
+        res, data = self.get('/actors?sort=gender')
+        self.assertEqual(res.status_code, 400)
+
+    def test_invalid_cursor_400_error(self):
+        res, data = self.get('/movies?sort=title&after=not-a-cursor')
+        self.assertEqual(res.status_code, 400)
+
+
+class QueryPlanTestCase(LocalAuthTestCase):
+    '''
+    Checks that the list filters and sorts are answered from indexes
+    '''
+
+    def setUp(self):
+        super().setUp()
+        if self.db.engine.dialect.name != 'sqlite':
+            self.skipTest('query plans are checked on SQLite')
+
+    def plan(self, query):
+        sql = str(query.statement.compile(self.db.engine, compile_kwargs={"literal_binds": True}))
+        return ' | '.join(row[-1] for row in self.db.session.execute(text('EXPLAIN QUERY PLAN ' + sql)))
+
+    def test_release_date_range_uses_index(self):
+        query = Movie.filtered_query([('release_date', 'gte', datetime.date(2000, 1, 1)),
+                                      ('release_date', 'lt', datetime.date(2001, 1, 1))])
+
+        self.assertIn('INDEX ix_movies_release_date', self.plan(query))
+
+    def test_sort_by_release_date_uses_index(self):
+        order = Movie.ordering([('release_date', True)])
+        query = Movie.query.order_by(*[column.desc() if descending else column for column, descending in order]).limit(10)
+        plan = self.plan(query)
+
+        self.assertIn('INDEX ix_movies_release_date', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_age_range_uses_index(self):
+        self.assertIn('INDEX ix_actors_age', self.plan(Actor.filtered_query([('age', 'lt', 30)])))
+
+    def test_gender_and_age_use_index(self):
+        query = Actor.filtered_query([('gender', 'eq', 'Female'), ('age', 'gte', 30)])
+
+        self.assertIn('INDEX ix_actors_gender_age', self.plan(query))
+
+    def test_soft_delete_partial_indexes(self):
+        live = Actor.query.filter(Actor.deleted_at.is_(None)).order_by(Actor.id).limit(10)
+        deleted = Actor.query.filter(Actor.deleted_at.isnot(None)).order_by(Actor.deleted_at).limit(10)
+
+        self.assertIn('INDEX ix_actors_live_id', self.plan(live))
+        self.assertIn('INDEX ix_actors_deleted_at', self.plan(deleted))
+
+
+class ConditionalGetTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.actor = Actor(name="Versioned Actor", age=44, gender="Male")
+        self.actor.insert()
+        self.movie = Movie(title="Versioned Movie", release_date=datetime.date(2012, 12, 12))
+        self.movie.insert()
+        self.actor_id, self.movie_id = self.actor.id, self.movie.id
+
+    def etag(self, url):
+        res = self.client().get(url, headers=self.headers(self.assistant))
+        self.assertEqual(res.status_code, 200)
+        return res.headers['ETag'].strip('"')
+
+    def assert_invalidates(self, url, mutate):
+        etag = self.etag(url)
+        headers = dict(self.headers(self.assistant), **{'If-None-Match': '"{}"'.format(etag)})
+        self.assertEqual(self.client().get(url, headers=headers).status_code, 304)
+
+        mutate()
+
+        self.assertEqual(self.client().get(url, headers=headers).status_code, 200)
+        self.assertNotEqual(self.etag(url), etag)
+
+    def test_304_does_not_read_rows(self):
+        url = '/movies?include=actors'
+        etag = self.etag(url)
+
+        with app_module.profiler.profile() as profile:
+            res = self.client().get(url, headers=dict(self.headers(self.assistant), **{'If-None-Match': '"{}"'.format(etag)}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertTrue(all('table_versions' in statement for statement, duration in profile.queries))
+
+    def test_post_actor_invalidates(self):
+        self.assert_invalidates('/actors', lambda: self.client().post('/actors', headers=self.headers(self.director), json={
+            "name": "New Versioned Actor", "gender": "Female", "age": 22}))
+
+    def test_patch_actor_invalidates(self):
+        self.assert_invalidates('/actors', lambda: self.client().patch('/actors/{}'.format(self.actor_id), headers=self.headers(self.director), json={
+            "name": "Versioned Actor", "gender": "Male", "age": 45}))
+
+    def test_delete_actor_invalidates(self):
+        self.assert_invalidates('/actors', lambda: self.client().delete('/actors/{}'.format(self.actor_id), headers=self.headers(self.director)))
+
+    def test_post_movie_invalidates(self):
+        self.assert_invalidates('/movies', lambda: self.client().post('/movies', headers=self.headers(self.producer), json={
+            "title": "New Versioned Movie", "release_date": "2013-01-01"}))
+
+    def test_patch_movie_invalidates(self):
+        self.assert_invalidates('/movies', lambda: self.client().patch('/movies/{}'.format(self.movie_id), headers=self.headers(self.producer), json={
+            "title": "Versioned Movie", "release_date": "2013-01-01"}))
+
+    def test_delete_movie_invalidates(self):
+        self.assert_invalidates('/movies', lambda: self.client().delete('/movies/{}'.format(self.movie_id), headers=self.headers(self.producer)))
+
+    def test_bulk_import_invalidates(self):
+        self.assert_invalidates('/movies', lambda: self.client().post('/movies/bulk', headers=self.headers(self.producer), json=[
+            {"title": "Bulk Versioned Movie", "release_date": "2014-01-01"}]))
+
+    def test_casting_invalidates_cast_listings(self):
+        url = '/movies/{}/actors'.format(self.movie_id)
+        self.assert_invalidates(url, lambda: self.client().post(url, headers=self.headers(self.director), json={"actor_id": self.actor_id}))
+        self.assert_invalidates('/actors?include=movies', lambda: self.client().delete(
+            '/movies/{}/actors/{}'.format(self.movie_id, self.actor_id), headers=self.headers(self.director)))
+
+    def test_minimal_response_etag_tracks_updated_at(self):
+        res = self.client().patch('/actors/{}?return=minimal'.format(self.actor_id), headers=self.headers(self.director), json={
+            "name": "Versioned Actor", "gender": "Male", "age": 46})
+        actor = Actor.query.get(self.actor_id)
+
+        self.assertEqual(res.headers['ETag'].strip('"'), '{}-{}'.format(actor.id, actor.updated_at.isoformat()))
+
+
+class FakeRedis:
+    '''
+    Minimal in-memory stand-in for the redis client methods used by RedisBackend
+    '''
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def set(self, name, value, ex=None):
+        self.data[name] = value
+
+    def delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+    def sadd(self, name, *values):
+        self.data.setdefault(name, set()).update(values)
+
+    def smembers(self, name):
+        return set(self.data.get(name, set()))
+
+    def expire(self, name, seconds):
+        self.expiry[name] = seconds
+
+    def incr(self, name):
+        self.data[name] = int(self.data.get(name, 0)) + 1
+        return self.data[name]
+
+    def scan_iter(self, match='*', count=None):
+        return [name for name in list(self.data) if fnmatch.fnmatchcase(name, match)]
+
+
+class ResponseCacheTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.original_cache = app_module.response_cache
+        app_module.response_cache = ResponseCache(LRUBackend(maxsize=100))
+
+    def tearDown(self):
+        app_module.response_cache = self.original_cache
+        super().tearDown()
+
+    def count_queries(self, url, token):
+        with app_module.profiler.profile() as profile:
+            res = self.client().get(url, headers=self.headers(token))
+
+        self.assertEqual(res.status_code, 200)
+        return profile.count, json.loads(res.data)
+
+    def test_repeat_read_served_from_cache(self):
+        first, data = self.count_queries('/movies?limit=5', self.assistant)
+        second, cached = self.count_queries('/movies?limit=5', self.assistant)
+
+        self.assertGreater(first, 0)
+        self.assertEqual(second, 0)
+        self.assertEqual(cached, data)
+        self.assertEqual(app_module.response_cache.hits, 1)
+
+    def test_cache_keyed_by_permissions(self):
+        self.count_queries('/actors', self.assistant)
+        queries, data = self.count_queries('/actors', self.producer)
+
+        self.assertGreater(queries, 0)
+
+    def test_write_invalidates_only_affected_tables(self):
+        self.count_queries('/actors', self.assistant)
+        self.count_queries('/movies', self.assistant)
+
+        Movie(title="Cache Movie", release_date=datetime.date(2020, 2, 2)).insert()
+
+        self.assertEqual(self.count_queries('/actors', self.assistant)[0], 0)
+        self.assertGreater(self.count_queries('/movies', self.assistant)[0], 0)
+
+    def test_casting_invalidates_included_listings(self):
+        movie = Movie(title="Cache Cast Movie", release_date=datetime.date(2020, 2, 2))
+        movie.insert()
+        actor = Actor(name="Cache Cast Actor", age=30, gender="Male")
+        actor.insert()
+        movie_id, actor_id = movie.id, actor.id
+        url = '/movies?include=actors&after={}'.format(movie_id - 1)
+        self.count_queries(url, self.assistant)
+
+        self.client().post('/movies/{}/actors'.format(movie_id), headers=self.headers(self.director), json={"actor_id": actor_id})
+
+        queries, data = self.count_queries(url, self.assistant)
+        self.assertGreater(queries, 0)
+        self.assertEqual(len(data['movies'][0]['actors']), 1)
+
+    def test_lru_eviction_metrics(self):
+        backend = LRUBackend(maxsize=2)
+        for key in ('a', 'b', 'c'):
+            backend.set(key, b'value', ['actors'])
+
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.evictions, 1)
+
+    def test_write_during_build_is_not_cached(self):
+        cache = ResponseCache(LRUBackend())
+        generations = cache.generations(['movies'])
+        cache.invalidate('movies')
+        cache.set('key', 'etag', b'body', ['movies'], generations)
+
+        self.assertIsNone(cache.get('key'))
+
+    def test_redis_backend_with_fake_client(self):
+        app_module.response_cache = ResponseCache(RedisBackend(FakeRedis()))
+
+        self.count_queries('/actors', self.assistant)
+        self.assertEqual(self.count_queries('/actors', self.assistant)[0], 0)
+
+        Actor(name="Redis Cache Actor", age=30, gender="Female").insert()
+
+        self.assertGreater(self.count_queries('/actors', self.assistant)[0], 0)
+
+    def test_redis_backend_clear_and_tag_expiry(self):
+        client = FakeRedis()
+        client.set('other:key', b'kept')
+        cache = ResponseCache(RedisBackend(client, ttl=30))
+        cache.invalidate('movies')
+        cache.set('key', 'etag', b'body', ['movies'], cache.generations(['movies']))
+
+        self.assertEqual(client.expiry['casting:cache:tag:movies'], 30)
+
+        cache.clear()
+
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(sorted(client.data), ['casting:cache:generation:movies', 'other:key'])
+        self.assertEqual(cache.generations(['movies']), [1])
+
+    def test_redis_backend_requires_client_package(self):
+        config = {'RESPONSE_CACHE_BACKEND': 'redis', 'REDIS_URL': 'redis://localhost:6379/0'}
+        with mock.patch.dict('sys.modules', {'redis': None}):
+            with self.assertRaisesRegex(RuntimeError, 'redis package is not installed'):
+                create_backend(config, 100, 'casting:cache:')
+
+    def test_cache_health(self):
+        self.count_queries('/actors', self.assistant)
+        self.count_queries('/actors', self.assistant)
+
+        res = self.client().get('/health/cache')
+        data = json.loads(res.data)
+
+        self.assertEqual(data['response_cache']['hits'], 1)
+        self.assertEqual(data['response_cache']['misses'], 1)
+
+
+class RowCacheTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.original_cache = app_module.row_cache
+        app_module.row_cache = RowCache(LRUBackend(maxsize=100))
+
+        actor = Actor(name="Row Actor", age=40, gender="Male")
+        actor.insert()
+        movie = Movie(title="Row Movie", release_date=datetime.date(2021, 1, 1))
+        movie.insert()
+        movie.add_actor(actor)
+        self.actor_id, self.movie_id = actor.id, movie.id
+
+    def tearDown(self):
+        app_module.row_cache = self.original_cache
+        super().tearDown()
+
+    def get(self, url, token=None, headers=None):
+        headers = dict(self.headers(token or self.assistant), **(headers or {}))
+        with app_module.profiler.profile() as profile:
+            res = self.client().get(url, headers=headers)
+
+        return res, profile.count
+
+    def test_get_actor(self):
+        res, queries = self.get('/actors/{}'.format(self.actor_id))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor'], {'id': self.actor_id, 'name': 'Row Actor', 'age': 40, 'gender': 'Male'})
+        self.assertIsNotNone(res.headers.get('ETag'))
+
+    def test_cache_hit_makes_no_queries(self):
+        self.db.session.expunge_all()
+        first, first_queries = self.get('/actors/{}'.format(self.actor_id))
+        second, second_queries = self.get('/actors/{}'.format(self.actor_id))
+
+        self.assertEqual(first_queries, 1)
+        self.assertEqual(second_queries, 0)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(app_module.row_cache.hits, 1)
+
+    def test_cache_hit_not_modified(self):
+        first, queries = self.get('/actors/{}'.format(self.actor_id))
+        res, queries = self.get('/actors/{}'.format(self.actor_id), headers={'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(queries, 0)
+
+    def test_missing_record(self):
+        res, queries = self.get('/actors/999999')
+        self.assertEqual(res.status_code, 404)
+
+        res, queries = self.get('/movies/not-an-id')
+        self.assertEqual(res.status_code, 404)
+
+    def test_update_invalidates_record(self):
+        first, queries = self.get('/actors/{}'.format(self.actor_id))
+
+        self.client().patch('/actors/{}'.format(self.actor_id), headers=self.headers(self.director),
+                            json={"name": "Renamed Row Actor", "age": 41, "gender": "Male"})
+
+        res, queries = self.get('/actors/{}'.format(self.actor_id))
+        self.assertGreater(queries, 0)
+        self.assertEqual(json.loads(res.data)['actor']['name'], 'Renamed Row Actor')
+        self.assertNotEqual(res.headers['ETag'], first.headers['ETag'])
+
+    def test_delete_invalidates_record(self):
+        self.get('/movies/{}'.format(self.movie_id))
+
+        self.client().delete('/movies/{}'.format(self.movie_id), headers=self.headers(self.producer))
+
+        res, queries = self.get('/movies/{}'.format(self.movie_id))
+        self.assertEqual(res.status_code, 404)
+
+    def test_movie_with_cast(self):
+        url = '/movies/{}?include=actors'.format(self.movie_id)
+        res, queries = self.get(url)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['movie']['actors']], [self.actor_id])
+        self.assertEqual(self.get(url)[1], 0)
+
+        # the plain view is cached separately
+        res, queries = self.get('/movies/{}'.format(self.movie_id))
+        self.assertNotIn('actors', json.loads(res.data)['movie'])
+
+    def test_cast_changes_invalidate_movie_with_cast(self):
+        url = '/movies/{}?include=actors'.format(self.movie_id)
+        first, queries = self.get(url)
+
+        self.client().patch('/actors/{}'.format(self.actor_id), headers=self.headers(self.director),
+                            json={"name": "Recast Row Actor", "age": 40, "gender": "Male"})
+        res, queries = self.get(url)
+        self.assertEqual(json.loads(res.data)['movie']['actors'][0]['name'], 'Recast Row Actor')
+        self.assertNotEqual(res.headers['ETag'], first.headers['ETag'])
+
+        self.client().delete('/movies/{}/actors/{}'.format(self.movie_id, self.actor_id),
+                             headers=self.headers(self.director))
+        res, queries = self.get(url)
+        self.assertEqual(json.loads(res.data)['movie']['actors'], [])
+
+    def test_row_cache_health(self):
+        self.get('/actors/{}'.format(self.actor_id))
+        self.get('/actors/{}'.format(self.actor_id))
+
+        data = json.loads(self.client().get('/health/cache').data)
+
+        self.assertEqual(data['row_cache']['hits'], 1)
+        self.assertEqual(data['row_cache']['misses'], 1)
+
+
+class MultiGetTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        actors = [Actor(name="Multi Actor {}".format(i), age=30 + i, gender="Female") for i in range(3)]
+        for actor in actors:
+            actor.insert()
+        movie = Movie(title="Multi Movie", release_date=datetime.date(2022, 2, 2))
+        movie.insert()
+        movie.add_actor(actors[0])
+        self.actor_ids = [actor.id for actor in actors]
+        self.movie_id = movie.id
+
+    def test_ids_keep_requested_order(self):
+        ids = [self.actor_ids[2], self.actor_ids[0], self.actor_ids[1]]
+        res = self.client().get('/actors?ids={}'.format(','.join(map(str, ids))), headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], ids)
+        self.assertEqual(data['missing'], [])
+
+    def test_ids_report_missing(self):
+        url = '/actors?ids={},999999,{}&fields=name'.format(self.actor_ids[1], self.actor_ids[1])
+        res = self.client().get(url, headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(data['actors'], [{'name': 'Multi Actor 1'}])
+        self.assertEqual(data['missing'], [999999])
+
+    def test_ids_with_include(self):
+        url = '/movies?ids={}&include=actors'.format(self.movie_id)
+        res = self.client().get(url, headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual([actor['id'] for actor in data['movies'][0]['actors']], [self.actor_ids[0]])
+
+    def test_invalid_ids(self):
+        for ids in ('', 'a,b', ','.join(str(i) for i in range(app.config['MAX_BATCH_SIZE'] + 1))):
+            res = self.client().get('/actors?ids=' + ids, headers=self.headers(self.assistant))
+            self.assertEqual(res.status_code, 400)
+
+    def test_batch(self):
+        res = self.client().post('/batch', headers=self.headers(self.assistant), json={
+            "actors": [self.actor_ids[1], 999999, self.actor_ids[0]],
+            "movies": [self.movie_id]
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [self.actor_ids[1], self.actor_ids[0]])
+        self.assertEqual(data['movies'][0]['title'], 'Multi Movie')
+        self.assertEqual(data['missing'], {'actors': [999999], 'movies': []})
+
+    def test_batch_one_query_per_type(self):
+        with app_module.profiler.profile(budget=2):
+            self.client().post('/batch', headers=self.headers(self.assistant),
+                               json={"actors": self.actor_ids, "movies": [self.movie_id]})
+
+    def test_batch_checks_every_permission(self):
+        permissions = [permission for permission in ASSISTANT_PERMISSIONS if permission != 'view:movie']
+        token = self.signer.token(permissions)
+
+        res = self.client().post('/batch', headers=self.headers(token), json={"actors": self.actor_ids})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().post('/batch', headers=self.headers(token), json={"movies": [self.movie_id]})
+        self.assertEqual(res.status_code, 401)
+
+    def test_batch_requires_token(self):
+        res = self.client().post('/batch', json={"actors": self.actor_ids})
+        self.assertEqual(res.status_code, 401)
+
+    def test_invalid_batch(self):
+        too_many = list(range(app.config['MAX_BATCH_SIZE'] + 1))
+        for body in ({}, {"castings": [1]}, {"actors": "1,2"}, {"actors": ["a"]}, {"actors": ["1"]},
+                     {"actors": [True]}, {"actors": [1.5]}, {"actors": too_many}):
+            res = self.client().post('/batch', headers=self.headers(self.assistant), json=body)
+            self.assertEqual(res.status_code, 400)
+
+
+class MutationBatchTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        actor = Actor(name="Mutation Actor", age=50, gender="Female")
+        actor.insert()
+        movie = Movie(title="Mutation Movie", release_date=datetime.date(2019, 9, 9))
+        movie.insert()
+        self.actor_id, self.movie_id = actor.id, movie.id
+
+    def mutate(self, operations, token=None):
+        commits = []
+        listener = lambda conn: commits.append(conn)
+        event.listen(self.db.engine, 'commit', listener)
+        try:
+            res = self.client().post('/batch/mutations', headers=self.headers(token or self.producer),
+                                     json={"operations": operations})
+        finally:
+            event.remove(self.db.engine, 'commit', listener)
+        return res, json.loads(res.data), len(commits)
+
+    def test_mixed_operations_single_commit(self):
+        res, data, commits = self.mutate([
+            {"op": "create", "type": "actors", "data": {"name": "Batch Actor", "age": 22, "gender": "Male"}},
+            {"op": "patch", "type": "movies", "id": self.movie_id,
+             "data": {"title": "Batch Movie", "release_date": "2019-10-10"}},
+            {"op": "create", "type": "castings", "data": {"movie_id": self.movie_id, "actor_id": self.actor_id}},
+            {"op": "delete", "type": "actors", "id": self.actor_id}
+        ])
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(commits, 1)
+        self.assertEqual([result['op'] for result in data['results']], ['create', 'patch', 'create', 'delete'])
+
+        created = Actor.query.filter_by(id=data['results'][0]['id']).one()
+        self.assertEqual(created.name, 'Batch Actor')
+        movie = Movie.query.filter_by(id=self.movie_id).one()
+        self.assertEqual(movie.title, 'Batch Movie')
+        self.assertEqual(movie.actors, [])
+        self.assertIsNone(Actor.query.filter_by(id=self.actor_id).one_or_none())
+
+    def test_failed_operation_rolls_back_batch(self):
+        res, data, commits = self.mutate([
+            {"op": "patch", "type": "actors", "id": self.actor_id,
+             "data": {"name": "Rolled Back Actor", "age": 51, "gender": "Female"}},
+            {"op": "delete", "type": "movies", "id": 999999}
+        ])
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['operation'], 1)
+        self.assertEqual(commits, 0)
+        self.assertEqual(Actor.query.filter_by(id=self.actor_id).one().name, 'Mutation Actor')
+
+    def test_invalid_operations(self):
+        res, data, commits = self.mutate([
+            {"op": "create", "type": "actors", "data": {"name": "Valid", "age": 30, "gender": "Male"}},
+            {"op": "create", "type": "actors", "data": {"name": "Invalid", "age": "old", "gender": "Male"}}
+        ])
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['operation'], 1)
+
+        res, data, commits = self.mutate([{"op": "rename", "type": "actors", "id": self.actor_id}])
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['operation'], 0)
+
+    def test_ids_must_be_integers(self):
+        for bad_id in (True, self.actor_id + 0.9, str(self.actor_id)):
+            for operation in ({"op": "delete", "type": "actors", "id": bad_id},
+                              {"op": "patch", "type": "actors", "id": bad_id,
+                               "data": {"name": "Wrong Actor", "age": 50, "gender": "Female"}},
+                              {"op": "create", "type": "castings",
+                               "data": {"movie_id": self.movie_id, "actor_id": bad_id}}):
+                res, data, commits = self.mutate([operation])
+
+                self.assertEqual(res.status_code, 400)
+                self.assertEqual(data['operation'], 0)
+                self.assertEqual(commits, 0)
+
+        actor = Actor.query.filter_by(id=self.actor_id).one()
+        self.assertEqual(actor.name, 'Mutation Actor')
+        self.assertEqual(actor.movies, [])
+
+    def test_every_permission_checked_first(self):
+        res, data, commits = self.mutate([
+            {"op": "patch", "type": "actors", "id": self.actor_id,
+             "data": {"name": "Director Actor", "age": 50, "gender": "Female"}},
+            {"op": "delete", "type": "movies", "id": self.movie_id}
+        ], self.director)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(commits, 0)
+        self.assertEqual(Actor.query.filter_by(id=self.actor_id).one().name, 'Mutation Actor')
+
+    def test_versions_bumped_in_table_order(self):
+        execute = self.db.session.execute
+        with mock.patch.object(self.db.session, 'execute', wraps=execute) as spy:
+            res, data, commits = self.mutate([
+                {"op": "patch", "type": "actors", "id": self.actor_id,
+                 "data": {"name": "Ordered Actor", "age": 50, "gender": "Female"}},
+                {"op": "create", "type": "castings", "data": {"movie_id": self.movie_id, "actor_id": self.actor_id}}
+            ])
+
+        bumped = [call.args[0].compile().params['name_1'] for call in spy.call_args_list
+                  if str(call.args[0]).startswith('UPDATE table_versions')]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(bumped, ['actor_movie', 'actors'])
+
+    def test_batch_invalidates_records(self):
+        url = '/actors/{}'.format(self.actor_id)
+        self.client().get(url, headers=self.headers(self.assistant))
+
+        self.mutate([{"op": "patch", "type": "actors", "id": self.actor_id,
+                      "data": {"name": "Cached Batch Actor", "age": 50, "gender": "Female"}}])
+
+        res = self.client().get(url, headers=self.headers(self.assistant))
+        self.assertEqual(json.loads(res.data)['actor']['name'], 'Cached Batch Actor')
+
+
+class BulkDeleteTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        movies = [Movie(title="Doomed Movie {}".format(i), release_date=datetime.date(1901, 1, 1 + i)) for i in range(3)]
+        for movie in movies:
+            movie.insert()
+        actor = Actor(name="Doomed Cast", age=60, gender="Male")
+        actor.insert()
+        movies[0].add_actor(actor)
+        self.movie_ids = [movie.id for movie in movies]
+        self.actor_id = actor.id
+
+    def test_delete_by_ids(self):
+        url = '/movies?ids={},{},999999'.format(*self.movie_ids[:2])
+        res = self.client().delete(url, headers=self.headers(self.producer))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 2)
+        self.assertEqual([movie.id for movie in Movie.query.filter(Movie.id.in_(self.movie_ids))], self.movie_ids[2:])
+
+    def test_delete_cascades_to_castings(self):
+        self.client().delete('/movies?ids={}'.format(self.movie_ids[0]), headers=self.headers(self.producer))
+
+        castings = self.db.session.execute(ActorMovie.select().where(ActorMovie.c.actor_id == self.actor_id)).all()
+        self.assertEqual(castings, [])
+        self.assertIsNotNone(Actor.query.filter_by(id=self.actor_id).one_or_none())
+
+    def test_delete_by_filters(self):
+        url = '/movies?release_date[lt]=1901-01-03&release_date[gte]=1901-01-01'
+        res = self.client().delete(url, headers=self.headers(self.producer))
+
+        self.assertEqual(json.loads(res.data)['deleted'], 2)
+        self.assertEqual(Movie.query.filter(Movie.id.in_(self.movie_ids)).count(), 1)
+
+    def test_delete_invalidates_records(self):
+        url = '/actors/{}'.format(self.actor_id)
+        self.client().get(url, headers=self.headers(self.assistant))
+
+        res = self.client().delete('/actors?ids={}'.format(self.actor_id), headers=self.headers(self.producer))
+        self.assertEqual(json.loads(res.data)['deleted'], 1)
+
+        res = self.client().get(url, headers=self.headers(self.assistant))
+        self.assertEqual(res.status_code, 404)
+
+    def test_requires_ids_or_filters(self):
+        for url in ('/movies', '/movies?ids=1&title=x', '/movies?ids=a'):
+            res = self.client().delete(url, headers=self.headers(self.producer))
+            self.assertEqual(res.status_code, 400)
+
+    def test_requires_permission(self):
+        res = self.client().delete('/movies?ids={}'.format(self.movie_ids[0]), headers=self.headers(self.director))
+        self.assertEqual(res.status_code, 401)
+
+
+class SoftDeleteTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        app.config['SOFT_DELETE'] = True
+
+        actors = [Actor(name="Tombstone Actor {}".format(i), age=70, gender="Female") for i in range(3)]
+        for actor in actors:
+            actor.insert()
+        movie = Movie(title="Tombstone Movie", release_date=datetime.date(1950, 5, 5))
+        movie.insert()
+        for actor in actors:
+            movie.add_actor(actor)
+        self.actor_ids = [actor.id for actor in actors]
+        self.movie_id = movie.id
+
+    def tearDown(self):
+        app.config['SOFT_DELETE'] = False
+        super().tearDown()
+
+    def stored(self, model, id):
+        return self.db.session.execute(model.__table__.select().where(model.__table__.c.id == id)).one_or_none()
+
+    def test_delete_hides_record(self):
+        actor_id = self.actor_ids[0]
+        self.client().get('/actors/{}'.format(actor_id), headers=self.headers(self.assistant))
+
+        res = self.client().delete('/actors/{}'.format(actor_id), headers=self.headers(self.director))
+        self.assertEqual(res.status_code, 200)
+
+        self.assertIsNotNone(self.stored(Actor, actor_id).deleted_at)
+        self.assertEqual(self.client().get('/actors/{}'.format(actor_id), headers=self.headers(self.assistant)).status_code, 404)
+
+        res = self.client().get('/actors?ids={}'.format(','.join(map(str, self.actor_ids))), headers=self.headers(self.assistant))
+        self.assertEqual(json.loads(res.data)['missing'], [actor_id])
+
+        res = self.client().get('/movies/{}?include=actors'.format(self.movie_id), headers=self.headers(self.assistant))
+        self.assertEqual([actor['id'] for actor in json.loads(res.data)['movie']['actors']], self.actor_ids[1:])
+
+        res = self.client().delete('/actors/{}'.format(actor_id), headers=self.headers(self.director))
+        self.assertEqual(res.status_code, 404)
+
+    def test_bulk_delete_is_soft(self):
+        res = self.client().delete('/actors?ids={}'.format(','.join(map(str, self.actor_ids))),
+                                   headers=self.headers(self.producer))
+
+        self.assertEqual(json.loads(res.data)['deleted'], 3)
+        self.assertTrue(all(self.stored(Actor, id).deleted_at for id in self.actor_ids))
+        self.assertEqual(Actor.query.filter(Actor.id.in_(self.actor_ids)).count(), 0)
+
+    def test_export_leaves_out_deleted(self):
+        Actor.query.filter_by(id=self.actor_ids[0]).one().delete()
+
+        res = self.client().get('/castings/export', headers=self.headers(self.assistant))
+        castings = [json.loads(line) for line in res.data.splitlines()]
+        actor_ids = [casting['actor_id'] for casting in castings if casting['movie_id'] == self.movie_id]
+
+        self.assertEqual(actor_ids, self.actor_ids[1:])
+
+    def test_purge_in_batches(self):
+        for id in self.actor_ids:
+            Actor.query.filter_by(id=id).one().delete()
+        Movie.query.filter_by(id=self.movie_id).one().delete()
+
+        pauses = []
+        purged = purge_deleted([Movie, Actor], batch_size=2, pause=0.5, sleep=pauses.append)
+
+        self.assertGreaterEqual(purged['actors'], 3)
+        self.assertGreaterEqual(purged['movies'], 1)
+        self.assertIn(0.5, pauses)
+        self.assertIsNone(self.stored(Actor, self.actor_ids[0]))
+        self.assertIsNone(self.stored(Movie, self.movie_id))
+        castings = self.db.session.execute(ActorMovie.select().where(ActorMovie.c.movie_id == self.movie_id)).all()
+        self.assertEqual(castings, [])
+
+    def test_purge_keeps_recent_tombstones(self):
+        Actor.query.filter_by(id=self.actor_ids[0]).one().delete()
+
+        before = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        purge_deleted([Actor], before=before, sleep=lambda seconds: None)
+
+        self.assertIsNotNone(self.stored(Actor, self.actor_ids[0]))
+
+
+class SerializerTestCase(LocalAuthTestCase):
+
+    def test_list_is_application_json(self):
+        Movie(title="Serialized Movie", release_date=datetime.date(1987, 6, 5)).insert()
+
+        res = self.client().get('/movies?title=Serialized+Movie', headers=self.headers(self.assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(data['movies'][0]['release_date'], '1987-06-05')
+
+    def test_dumps_iso_dates(self):
+        data = {'day': datetime.date(2020, 1, 2), 'at': datetime.datetime(2020, 1, 2, 3, 4, 5)}
+
+        self.assertEqual(json.loads(serializers.dumps(data)), {'day': '2020-01-02', 'at': '2020-01-02T03:04:05'})
+
+    def test_dumps_without_orjson(self):
+        original, serializers.orjson = serializers.orjson, None
+        try:
+            encoded = serializers.dumps(serializers.rows_to_dicts(('id', 'release_date'), [(1, datetime.date(2020, 1, 2))]))
+        finally:
+            serializers.orjson = original
+
+        self.assertEqual(json.loads(encoded), [{'id': 1, 'release_date': '2020-01-02'}])
+
+
+class ProjectionTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tag = 'prj{}'.format(random.randint(0, 10 ** 9))
+        for i in range(3):
+            Actor(name="{} {}".format(self.tag, i), age=60 - i, gender="Female").insert()
+
+    def get(self, url):
+        res = self.client().get(url, headers=self.headers(self.assistant))
+        return res, json.loads(res.data)
+
+    def test_sparse_fieldset(self):
+        res, data = self.get('/actors?name={} 0&fields=name,age'.format(self.tag))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [{'name': '{} 0'.format(self.tag), 'age': 60}])
+
+    def test_sparse_fieldset_with_sorted_keyset(self):
+        url = '/actors?name[gte]={0}&name[lt]={0}~&sort=age&limit=2&fields=name'.format(self.tag)
+        res, data = self.get(url)
+        res, rest = self.get(url + '&after={}'.format(data['next_cursor']))
+
+        names = [actor['name'] for actor in data['actors'] + rest['actors']]
+        self.assertEqual(names, ['{} {}'.format(self.tag, i) for i in (2, 1, 0)])
+        self.assertEqual(set(data['actors'][0]), {'name'})
+
+    def test_listing_does_not_build_orm_objects(self):
+        loaded = []
+
+        def on_load(target, context):
+            loaded.append(target)
+
+        event.listen(Actor, 'load', on_load)
+        try:
+            res, data = self.get('/actors?name[gte]={0}&name[lt]={0}~'.format(self.tag))
+        finally:
+            event.remove(Actor, 'load', on_load)
+
+        self.assertEqual(len(data['actors']), 3)
+        self.assertEqual(loaded, [])
+
+    def test_fields_with_search(self):
+        res, data = self.get('/actors?q={}&fields=id'.format(self.tag))
+
+        self.assertEqual(len(data['actors']), 3)
+        self.assertEqual(set(data['actors'][0]), {'id'})
+
+    def test_unknown_field_400_error(self):
+        res, data = self.get('/actors?fields=id,salary')
+
+        self.assertEqual(res.status_code, 400)
+
+
+class ConnectionPoolTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        self.db_file.close()
+        self.engine = create_engine('sqlite:///' + self.db_file.name, poolclass=InstrumentedQueuePool,
+                                    pool_size=2, max_overflow=1, pool_timeout=0.1,
+                                    connect_args={'check_same_thread': False})
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.unlink(self.db_file.name)
+        super().tearDown()
+
+    def get_health(self):
+        with mock.patch.object(type(self.db), 'engine', new_callable=mock.PropertyMock,
+                               return_value=self.engine):
+            res = self.client().get('/health/db')
+        return res, json.loads(res.data)
+
+    def test_health_reports_pool(self):
+        res, data = self.get_health()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['pool']['class'], 'InstrumentedQueuePool')
+        self.assertEqual(data['pool']['size'], 2)
+        self.assertEqual(data['pool']['checked_out'], 0)
+        self.assertEqual(data['pool']['timeouts'], 0)
+
+    def test_exhausted_pool_times_out_and_recovers(self):
+        held = [self.engine.connect() for i in range(3)]
+
+        res, data = self.get_health()
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['pool']['checked_out'], 3)
+        self.assertEqual(data['pool']['overflow'], 1)
+        self.assertEqual(data['pool']['timeouts'], 1)
+        self.assertGreaterEqual(data['pool']['max_wait'], 0.1)
+
+        for connection in held:
+            connection.close()
+
+        res, data = self.get_health()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['pool']['checked_out'], 0)
+
+    def test_waiting_checkout_gets_released_connection(self):
+        held = [self.engine.connect() for i in range(3)]
+        timer = threading.Timer(0.02, held[0].close)
+        timer.start()
+        try:
+            with self.engine.connect() as connection:
+                self.assertEqual(connection.execute(text('SELECT 1')).scalar(), 1)
+        finally:
+            timer.join()
+            for connection in held[1:]:
+                connection.close()
+
+        self.assertEqual(self.engine.pool.timeouts, 0)
+
+    def test_pool_timeout_returns_503(self):
+        with mock.patch.object(app_module, 'collection_etag',
+                               side_effect=PoolTimeoutError('QueuePool limit reached')):
+            res = self.client().get('/actors?limit=3', headers=self.headers(self.assistant))
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+
+class ReplicaRoutingTestCase(LocalAuthTestCase):
+    '''
+    Two SQLite files stand in for the replicas, each holding one actor the
+    primary does not have
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.tag = 'rep{}'.format(random.randint(0, 10 ** 9))
+        Actor(name="{} primary".format(self.tag), age=40, gender="Male").insert()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.original_binds = self.app.config.get('SQLALCHEMY_BINDS')
+        binds = dict(self.original_binds or {})
+        for replica in ('a', 'b'):
+            uri = 'sqlite:///' + os.path.join(self.directory.name, replica + '.db')
+            engine = create_engine(uri)
+            self.db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(Actor.__table__.insert(),
+                                   {"name": "{} {}".format(self.tag, replica), "age": 30, "gender": "Female"})
+            engine.dispose()
+            binds['replica_test_' + replica] = uri
+        binds['replica_test_down'] = 'sqlite:///' + os.path.join(self.directory.name, 'missing', 'down.db')
+        self.app.config['SQLALCHEMY_BINDS'] = binds
+
+        replica_router.configure(['replica_test_a', 'replica_test_b'], sticky_seconds=5, health_check_interval=60)
+        self.original_cache = app_module.response_cache
+        app_module.response_cache = None
+
+    def tearDown(self):
+        for bind in ('replica_test_a', 'replica_test_b', 'replica_test_down'):
+            self.db.get_engine(self.app, bind=bind).dispose()
+        replica_router.configure([])
+        self.app.config['SQLALCHEMY_BINDS'] = self.original_binds
+        app_module.response_cache = self.original_cache
+        self.directory.cleanup()
+        super().tearDown()
+
+    def names(self, client):
+        res = client.get('/actors?name[gte]={0}&name[lt]={0}~'.format(self.tag),
+                         headers=self.headers(self.director))
+        self.assertEqual(res.status_code, 200)
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def test_reads_alternate_between_replicas(self):
+        client = self.client()
+
+        self.assertEqual(self.names(client), ['{} a'.format(self.tag)])
+        self.assertEqual(self.names(client), ['{} b'.format(self.tag)])
+        self.assertEqual(self.names(client), ['{} a'.format(self.tag)])
+        self.assertEqual([replica['reads'] for replica in replica_router.status()], [2, 1])
+
+    def test_writes_go_to_primary_and_stick(self):
+        client = self.client()
+        res = client.post('/actors', json={"name": "{} new".format(self.tag), "age": 20, "gender": "Male"},
+                          headers=self.headers(self.director))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('read_primary=1', res.headers['Set-Cookie'])
+        self.assertEqual(self.names(client), ['{} primary'.format(self.tag), '{} new'.format(self.tag)])
+        # a client that did not write keeps reading from the replicas
+        self.assertEqual(self.names(self.client()), ['{} a'.format(self.tag)])
+
+    def test_batch_read_does_not_stick(self):
+        actor_id = Actor.query.filter_by(name='{} primary'.format(self.tag)).one().id
+        res = self.client().post('/batch', json={"actors": [actor_id]}, headers=self.headers(self.director))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Set-Cookie', res.headers)
+
+    def test_cache_misses_read_from_primary(self):
+        app_module.response_cache = ResponseCache(LRUBackend(maxsize=100))
+
+        self.assertEqual(self.names(self.client()), ['{} primary'.format(self.tag)])
+        self.assertEqual(self.names(self.client()), ['{} primary'.format(self.tag)])
+        self.assertEqual(app_module.response_cache.hits, 1)
+
+    def test_unhealthy_replica_is_skipped(self):
+        replica_router.configure(['replica_test_down', 'replica_test_b'], health_check_interval=60)
+        client = self.client()
+
+        self.assertEqual(self.names(client), ['{} b'.format(self.tag)])
+        self.assertEqual(self.names(client), ['{} b'.format(self.tag)])
+        self.assertEqual(replica_router.status()[0]['healthy'], False)
+
+    def test_primary_used_when_all_replicas_down(self):
+        replica_router.configure(['replica_test_down'], health_check_interval=60)
+
+        self.assertEqual(self.names(self.client()), ['{} primary'.format(self.tag)])
+
+
+@unittest.skipIf(asgi is None, 'requirements-asgi.txt is not installed')
+class AsyncEntryPointTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tag = 'asg{}'.format(random.randint(0, 10 ** 9))
+        for i in range(3):
+            Actor(name="{} {}".format(self.tag, i), age=30 + i, gender="Female").insert()
+        self.original_cache = app_module.response_cache
+        app_module.response_cache = None
+
+    def tearDown(self):
+        app_module.response_cache = self.original_cache
+        super().tearDown()
+
+    def async_get(self, url, headers):
+        async def get():
+            async with asgi.async_app.test_app() as test_app:
+                res = await test_app.test_client().get(url, headers=headers)
+                return res.status_code, res.headers, await res.get_data()
+
+        return asyncio.run(get())
+
+    def test_listing_matches_sync_app(self):
+        url = '/actors?name[gte]={0}&name[lt]={0}~&sort=-age&limit=2&fields=name,age'.format(self.tag)
+        res = self.client().get(url, headers=self.headers(self.assistant))
+        status, headers, body = self.async_get(url, self.headers(self.assistant))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), json.loads(res.data))
+        self.assertEqual(headers['ETag'], res.headers['ETag'])
+
+    def test_not_modified(self):
+        url = '/actors?name={} 0'.format(self.tag)
+        status, headers, body = self.async_get(url, self.headers(self.assistant))
+        headers = dict(self.headers(self.assistant), **{'If-None-Match': headers['ETag']})
+
+        self.assertEqual(self.async_get(url, headers)[0], 304)
+
+    def test_auth_semantics(self):
+        status, headers, body = self.async_get('/actors', {})
+        self.assertEqual(status, 401)
+        self.assertEqual(json.loads(body)['code'], 'authorization_header_missing')
+
+        token = self.signer.token(['view:movie'])
+        self.assertEqual(self.async_get('/actors', self.headers(token))[0], 401)
+        self.assertEqual(self.async_get('/movies', self.headers(token))[0], 200)
+
+    def test_invalid_filter(self):
+        status, headers, body = self.async_get('/actors?age[gt]=old', self.headers(self.assistant))
+
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(body)['message'], 'Bad request')
+
+    def test_dispatch(self):
+        def scope(method, path, query=b''):
+            return {'type': 'http', 'method': method, 'path': path, 'query_string': query}
+
+        self.assertTrue(asgi.serves_async(scope('GET', '/actors', b'limit=5')))
+        self.assertFalse(asgi.serves_async(scope('GET', '/actors', b'q=tom')))
+        self.assertFalse(asgi.serves_async(scope('GET', '/movies', b'include=actors')))
+        self.assertFalse(asgi.serves_async(scope('POST', '/actors')))
+        self.assertFalse(asgi.serves_async(scope('GET', '/actors/1/movies')))
+
+    def test_async_database_url(self):
+        self.assertEqual(asgi.async_database_url('postgresql://u:p@h/capstone'), 'postgresql+asyncpg://u:p@h/capstone')
+        self.assertEqual(asgi.async_database_url('sqlite:////tmp/t.db'), 'sqlite+aiosqlite:////tmp/t.db')
+
+
+class MetricsTestCase(LocalAuthTestCase):
+
+    def test_server_timing_breakdown(self):
+        token = self.signer.token(ASSISTANT_PERMISSIONS, sub='timing')
+        res = self.client().get('/actors?limit=2', headers=self.headers(token))
+
+        self.assertEqual(res.status_code, 200)
+        phases = [entry.split(';')[0] for entry in res.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['auth_header', 'auth_jwks', 'auth_verify', 'db', 'serialize', 'total'])
+
+        # the verified token is cached and the keys are loaded
+        res = self.client().get('/actors?limit=2', headers=self.headers(token))
+        phases = [entry.split(';')[0] for entry in res.headers['Server-Timing'].split(', ')]
+        self.assertNotIn('auth_verify', phases)
+        self.assertNotIn('auth_jwks', phases)
+
+    def test_metrics_endpoint(self):
+        self.client().get('/movies?limit=1', headers=self.headers(self.assistant))
+        self.client().get('/movies', headers=self.headers('not-a-token'))
+        res = self.client().get('/metrics')
+        text = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn('http_requests_total{endpoint="get_movies",method="GET",status="200"}', text)
+        self.assertIn('http_requests_total{endpoint="get_movies",method="GET",status="400"}', text)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint="get_movies",method="GET",le="+Inf"}', text)
+        self.assertIn('http_request_phase_duration_seconds_count{endpoint="get_movies",phase="db"}', text)
+        for name in ('jwks_fetches_total', 'token_cache_hits_total', 'response_cache_hits_total'):
+            self.assertIn('# TYPE {} counter'.format(name), text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('endpoint',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value, 'x')
+
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{endpoint="x",le="0.1"} 1',
+            'test_seconds_bucket{endpoint="x",le="1.0"} 3',
+            'test_seconds_bucket{endpoint="x",le="+Inf"} 4',
+            'test_seconds_sum{endpoint="x"} 4.25',
+            'test_seconds_count{endpoint="x"} 4'
+        ])
+
+
+class ProfilerTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.profiler = app_module.profiler
+        self.original_budgets = dict(self.profiler.budgets)
+        self.original_slow_query_ms = self.profiler.slow_query_ms
+        self.tag = 'prf{}'.format(random.randint(0, 10 ** 9))
+
+        actor = Actor(name="{} actor".format(self.tag), age=30, gender="Female")
+        actor.insert()
+        for i in range(6):
+            movie = Movie(title="{} {}".format(self.tag, i), release_date=datetime.date(2001, 1, 1))
+            movie.insert()
+            movie.add_actor(actor)
+
+    def tearDown(self):
+        self.profiler.budgets = self.original_budgets
+        self.profiler.slow_query_ms = self.original_slow_query_ms
+        super().tearDown()
+
+    def test_lazy_relationship_loop_is_reported(self):
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            with self.profiler.profile(budget=3) as profile:
+                movies = Movie.query.filter(Movie.title.startswith(self.tag)).all()
+                [movie.format_actors() for movie in movies]
+
+        self.assertEqual(profile.count, 7)
+        self.assertEqual(list(profile.duplicates().values()), [6])
+        self.assertIn('6x SELECT actors.', str(context.exception))
+
+    def test_embedded_listing_stays_within_budget(self):
+        url = '/movies?title[gte]={0}&title[lt]={0}~&include=actors'.format(self.tag)
+        with self.profiler.profile(budget=4) as profile:
+            res = self.client().get(url, headers=self.headers(self.assistant))
+
+        self.assertEqual(len(json.loads(res.data)['movies']), 6)
+        self.assertEqual(profile.duplicates(), {})
+
+    def test_request_over_budget_is_recorded(self):
+        self.profiler.budgets['get_movies'] = 1
+        with self.assertLogs('profiler', 'WARNING') as logs:
+            self.client().get('/movies?limit=2', headers=self.headers(self.assistant))
+
+        self.assertIn('get_movies: query budget of 1 exceeded', logs.output[0])
+        self.assertEqual([endpoint for endpoint, budget, profile in self.profiler.violations], ['get_movies'])
+        self.profiler.violations.clear()
+
+    def test_profile_finishes_when_after_request_is_skipped(self):
+        # a propagated exception skips after_request but not teardown_request
+        with mock.patch.dict(self.app.config, PROPAGATE_EXCEPTIONS=True), \
+                mock.patch.object(app_module, 'collection_etag', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.client().get('/actors?limit=2', headers=self.headers(self.assistant))
+
+        self.assertIsNone(getattr(self.profiler._local, 'request', None))
+        self.assertEqual(self.profiler._active(), [])
+
+    def test_slow_queries_are_logged(self):
+        self.profiler.slow_query_ms = 0
+        with self.assertLogs('profiler', 'WARNING') as logs:
+            self.client().get('/actors?limit=2', headers=self.headers(self.assistant))
+
+        self.assertTrue(any('slow query' in line for line in logs.output))
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.signer = LocalSigner()
+        self.original_store = auth.jwks_store
+        auth.jwks_store = auth.JWKSKeyStore(path=self.signer.jwks_file.name, min_refresh_interval=60)
+        self.client = app.test_client
+
+    def tearDown(self):
+        auth.jwks_store = self.original_store
+        self.signer.cleanup()
+
+    def test_keys_indexed_by_kid(self):
+        auth.jwks_store.refresh()
+
+        self.assertIn(self.signer.kid, auth.jwks_store.keys)
+        self.assertEqual(auth.jwks_store.fetch_count, 1)
+
+    def test_verify_uses_stored_keys(self):
+        token = self.signer.token(['view:actor'])
+
+        auth.verify_decode_jwt(token)
+        auth.verify_decode_jwt(token)
+
+        self.assertEqual(auth.jwks_store.fetch_count, 1)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        auth.jwks_store.refresh()
+        token = jwt.encode({'permissions': []}, self.signer.private_key,
+                           algorithm='RS256', headers={'kid': 'rotated-key'})
+
+        for _ in range(3):
+            with self.assertRaises(auth.AuthError):
+                auth.verify_decode_jwt(token)
+
+        self.assertEqual(auth.jwks_store.fetch_count, 1)
+
+    def test_keys_survive_failed_refresh(self):
+        auth.jwks_store.refresh()
+        auth.jwks_store.path = os.path.join(tempfile.gettempdir(), 'missing-jwks.json')
+        auth.jwks_store.last_fetch = 0
+
+        self.assertIsNone(auth.jwks_store.get_key('another-key'))
+        self.assertIsNotNone(auth.jwks_store.get_key(self.signer.kid))
+
+    def test_fetch_runs_outside_the_lock(self):
+        store = auth.jwks_store
+        fetch = store.fetch
+        locked = []
+        fetched = threading.Event()
+
+        def checking_fetch():
+            locked.append(store._lock.locked())
+            fetched.set()
+            return fetch()
+
+        with mock.patch.object(store, 'fetch', side_effect=checking_fetch):
+            store.start()
+            try:
+                self.assertTrue(fetched.wait(5))
+            finally:
+                store.stop()
+
+        self.assertEqual(locked, [False])
+        self.assertIn(self.signer.kid, store.keys)
+
+    def test_cold_start_miss_waits_for_fetch(self):
+        store = auth.jwks_store
+        fetch = store.fetch
+        started, release = threading.Event(), threading.Event()
+
+        def slow_fetch():
+            started.set()
+            release.wait(5)
+            return fetch()
+
+        with mock.patch.object(store, 'fetch', side_effect=slow_fetch):
+            store.start()
+            try:
+                self.assertTrue(started.wait(5))
+                threading.Timer(0.1, release.set).start()
+                key = store.get_key(self.signer.kid)
+            finally:
+                store.stop()
+
+        self.assertIsNotNone(key)
+        self.assertEqual(store.fetch_count, 1)
+
+    def test_miss_refetches_after_failed_first_fetch(self):
+        store = auth.jwks_store
+        with mock.patch.object(store, 'fetch', side_effect=[OSError('unreachable'), store.fetch()]):
+            with self.assertRaises(OSError):
+                store.refresh()
+
+            self.assertIsNotNone(store.get_key(self.signer.kid))
+
+        self.assertEqual(store.fetch_count, 2)
+
+    def test_restart_keeps_one_refresh_thread(self):
+        store = auth.jwks_store
+        running = lambda: [thread for thread in threading.enumerate() if thread.name == 'jwks-refresh']
+        others = running()
+        store.start()
+        first = store._thread
+        store.stop()
+        store.start()
+
+        try:
+            self.assertFalse(first.is_alive())
+            self.assertEqual(running(), others + [store._thread])
+        finally:
+            store.stop()
+
+    def test_get_actors_with_local_token(self):
+        res = self.client().get('/actors', headers={
+            "Authorization": "Bearer {}".format(self.signer.token(['view:actor']))
+        })
+
+        self.assertNotEqual(res.status_code, 401)
+        self.assertNotEqual(res.status_code, 400)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.signer = LocalSigner()
+        self.original_store = auth.jwks_store
+        auth.jwks_store = auth.JWKSKeyStore(path=self.signer.jwks_file.name)
+        self.original_cache = auth.token_cache
+        auth.token_cache = auth.TokenCache(maxsize=2)
+
+    def tearDown(self):
+        auth.jwks_store = self.original_store
+        auth.token_cache = self.original_cache
+        self.signer.cleanup()
+
+    def test_repeat_token_skips_verification(self):
+        token = self.signer.token(['view:actor'])
+
+        payload, permissions = auth.get_verified_payload(token)
+        auth.get_verified_payload(token)
+
+        self.assertEqual(auth.token_cache.misses, 1)
+        self.assertEqual(auth.token_cache.hits, 1)
+        self.assertEqual(permissions, frozenset(['view:actor']))
+        self.assertTrue(auth.check_permissions('view:actor', payload, permissions))
+
+    def test_entry_expires_with_token(self):
+        token = self.signer.token(['view:actor'])
+        auth.token_cache.put(token, {'exp': time.time() - 1, 'permissions': []})
+
+        self.assertIsNone(auth.token_cache.get(token))
+
+    def test_cache_is_bounded(self):
+        tokens = [self.signer.token(['view:actor'], sub=str(i)) for i in range(3)]
+        for token in tokens:
+            auth.get_verified_payload(token)
+
+        self.assertEqual(len(auth.token_cache.entries), 2)
+        self.assertIsNone(auth.token_cache.get(tokens[0]))
+
+    def test_cached_payload_still_checks_permissions(self):
+        token = self.signer.token(['view:actor'])
+        auth.get_verified_payload(token)
+        payload, permissions = auth.get_verified_payload(token)
+
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions('delete:actor', payload, permissions)
+
+    def test_empty_permission_is_not_granted(self):
+        payload, permissions = auth.get_verified_payload(self.signer.token(['view:actor']))
+
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions('', payload, permissions)
+
+
 if __name__ == '__main__':
     unittest.main()
 